@@ -0,0 +1,159 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import tempfile
+
+class BinaryCache(object):
+    """A BinaryCache keeps compiled kernel binaries in a directory, so that
+    later startups can skip compilation.
+
+    Entries are written to a temporary file and renamed into place, so another
+    process starting at the same time never reads a partial binary. Reading an
+    entry touches it, and once the directory grows past maxSize bytes the
+    least recently used entries are removed.
+
+    Failing to write to the directory (for example on a read-only install) is
+    not an error; the binary just isn't cached.
+    """
+
+    SUFFIX = '.elf'
+
+    def __init__(self, interface, directory, maxSize):
+        self.interface = interface
+        self.directory = directory
+        self.maxSize = maxSize
+
+        self.hits = 0
+        self.misses = 0
+        self.compileTime = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """Return the cached binary for key, or None if there isn't one."""
+        if self.maxSize <= 0:
+            return None
+
+        path = self._path(key)
+        try:
+            binary = open(path, 'rb')
+            try:
+                data = binary.read()
+            finally:
+                binary.close()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        # Reading counts as a use as far as eviction is concerned.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        self.interface.debug('Kernel cache hit: %s (%d hits, %d misses)' %
+            (os.path.basename(path), self.hits, self.misses))
+        return data
+
+    def put(self, key, data, compileTime=None):
+        """Store the binary for key, then evict old entries if the cache has
+        grown too large.
+        """
+        if compileTime is not None:
+            self.compileTime += compileTime
+            self.interface.debug('Kernel cache miss: compiled in %.2fs '
+                '(%d hits, %d misses, %.2fs compiling in total)' %
+                (compileTime, self.hits, self.misses, self.compileTime))
+
+        if self.maxSize <= 0:
+            return
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tempPath = tempfile.mkstemp(self.SUFFIX + '.tmp',
+                dir=self.directory)
+            try:
+                # A file object keeps writing until all of the data is out,
+                # and closing it before the rename flushes it.
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                # mkstemp only makes the file readable by its owner.
+                os.chmod(tempPath, 0644)
+            except:
+                self._remove(tempPath)
+                raise
+        except (IOError, OSError), e:
+            self.interface.debug('Could not write to kernel cache: %s' % e)
+            return
+
+        try:
+            os.rename(tempPath, self._path(key))
+        except OSError:
+            # On Windows, rename won't replace an existing file, which means
+            # another process has already cached this binary.
+            self._remove(tempPath)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        maxSize bytes.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        entries = []
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxSize:
+                break
+            if self._remove(path):
+                self.interface.debug('Evicted %s from kernel cache' %
+                    os.path.basename(path))
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            # Most likely another process got to it first.
+            return False
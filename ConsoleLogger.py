@@ -48,6 +48,9 @@ class ConsoleLogger(object):
     
     UPDATE_TIME = 1.0
     
+    # How often the execution time distribution is logged in verbose mode.
+    LATENCY_LOG_TIME = 30.0
+    
     def __init__(self, miner, verbose=False, statusfile=None, blkfound=None):
         self.verbose = verbose
         self.miner = miner
@@ -58,6 +61,8 @@ class ConsoleLogger(object):
         self.lineLength = 0
         self.connectionType = None
         self.idle = False
+        self.lastLatencyLog = time()
+        self.verifyStalls = 0
         
         self.statushandler = None
         if statusfile:
@@ -74,6 +79,59 @@ class ConsoleLogger(object):
         if update:
             self.updateStatus()
     
+    def reportLatency(self, latency):
+        """Used to tell the logger how long recent kernel executions took.
+        latency is a dict of milliseconds at a few percentiles, along with
+        how many samples they came from.
+        """
+        if self.statushandler:
+            self.statushandler.update('ExecutionTime', latency)
+        if self.verbose and self.lastLatencyLog+self.LATENCY_LOG_TIME < time():
+            self.lastLatencyLog = time()
+            self.log('Execution times: %(p50).1fms median, %(p90).1fms p90, '
+                '%(p99).1fms p99, %(max).1fms max (%(samples)d samples)' %
+                latency)
+    
+    def reportVerifyQueue(self, depth, stalls):
+        """Used to tell the logger how many batches of found nonces are
+        waiting to be verified, and how many times kernels have had to wait
+        for room to queue more.
+        """
+        if self.statushandler:
+            self.statushandler.update('VerifyQueue', depth)
+            self.statushandler.update('VerifyStalls', stalls)
+        if stalls > self.verifyStalls:
+            self.verifyStalls = stalls
+            self.reportDebug('Share verification is falling behind (%d '
+                'batches queued)' % depth)
+    
+    def reportBlockSwitch(self, dt):
+        """Used to tell the logger how many seconds passed between a new block
+        coming out and a core starting on work for it.
+        """
+        if self.statushandler:
+            self.statushandler.update('BlockSwitchTime', dt*1000)
+        self.reportDebug('Started on the new block after %.1fms' % (dt*1000))
+    
+    def reportPoolSwitch(self, names, reason):
+        """Used to tell the logger that work now comes from other pools,
+        and why.
+        """
+        if self.statushandler:
+            self.statushandler.update('Pool', ', '.join(names))
+        self.log('Switching to %s (%s)' % (', '.join(names), reason))
+    
+    def reportPoolRates(self, rates):
+        """Used to tell the logger how hashing has been split between pools,
+        as a list of (name, khash/sec).
+        """
+        if self.statushandler:
+            self.statushandler.update('PoolRates', dict(rates))
+        total = sum(rate for name, rate in rates) or 1.0
+        self.reportDebug('Pool hashrates: ' + ', '.join(
+            '%s %shash/sec (%d%%)' % (name, formatNumber(rate), rate*100/total)
+            for name, rate in rates))
+    
     def reportType(self, type):
         self.connectionType = type
     
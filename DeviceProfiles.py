@@ -0,0 +1,78 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import os
+import tempfile
+
+class DeviceProfiles(object):
+    """DeviceProfiles is a small JSON file of tuned kernel settings, keyed by
+    whatever identifies a device to the kernel that tuned it (normally the
+    device name, driver version and kernel revision).
+
+    The file is rewritten through a temporary file and a rename, so a miner
+    starting while a profile is being saved never sees a partial file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                profiles = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(profiles, dict):
+            return {}
+        return profiles
+
+    def get(self, key):
+        """Return the profile stored for key, or None if there isn't one."""
+        return self._load().get(key)
+
+    def put(self, key, profile):
+        """Store the profile for key, replacing any existing one. Raises
+        IOError or OSError if the file can't be written.
+        """
+        profiles = self._load()
+        profiles[key] = profile
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tempPath = tempfile.mkstemp('.tmp', dir=directory)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(json.dumps(profiles, indent=4, sort_keys=True))
+            finally:
+                f.close()
+            os.chmod(tempPath, 0644)
+            if os.name == 'nt' and os.path.exists(self.path):
+                # Windows won't rename over an existing file.
+                os.remove(self.path)
+            os.rename(tempPath, self.path)
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
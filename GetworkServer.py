@@ -0,0 +1,269 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+from collections import OrderedDict, deque
+from struct import unpack
+from time import time
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from WorkQueue import NonceRange
+
+class GetworkResource(resource.Resource):
+    """Answers getwork JSON-RPC calls, and long polls, for a GetworkServer."""
+    
+    isLeaf = True
+    
+    def __init__(self, server):
+        resource.Resource.__init__(self)
+        self.server = server
+    
+    def render(self, request):
+        # Most calls are answered later, by which time the miner may have
+        # hung up; marking the request finished then keeps anything from
+        # being written to it.
+        def hungUp(failure):
+            request.finished = True
+        request.notifyFinish().addErrback(hungUp)
+        return resource.Resource.render(self, request)
+    
+    def render_GET(self, request):
+        if request.path == self.server.LONGPOLL_PATH:
+            return self.server.longPoll(request)
+        request.setResponseCode(405)
+        return 'Only JSON-RPC over POST is served here.'
+    
+    def render_POST(self, request):
+        if request.path == self.server.LONGPOLL_PATH:
+            return self.server.longPoll(request)
+        
+        try:
+            call = json.loads(request.content.read())
+            method = call['method']
+            params = call.get('params') or []
+            id = call.get('id')
+        except (ValueError, KeyError, TypeError):
+            request.setResponseCode(400)
+            return 'Malformed JSON-RPC call.'
+        
+        if method != 'getwork':
+            return self.server.respond(request, id,
+                error={'code': -32601, 'message': 'Method not found'})
+        if params:
+            return self.server.submit(request, id, params[0])
+        return self.server.getwork(request, id)
+
+class GetworkServer(object):
+    """Serves the getwork JSON-RPC interface, with long polling, to
+    downstream miners, in place of a mining kernel. Every request is given
+    its own work out of the WorkQueue. Results are checked, deduplicated and
+    passed upstream like any kernel's.
+    
+    Plain getwork always hashes a unit's whole nonce space, so those miners
+    only ever get whole WorkUnits that nobody else has touched. Miners that
+    offer the noncerange extension share units instead, which are split
+    here and never handed to plain miners.
+    
+    Every whole unit still has to come from somewhere: the WorkQueue rolls
+    them when the upstream allows ntime or version rolling, and Stratum and
+    getblocktemplate upstreams make them locally. A plain getwork upstream
+    that allows neither still sees one request per plain downstream request,
+    since getwork gives no other way to make distinct work.
+    """
+    
+    LONGPOLL_PATH = '/LP'
+    
+    # How many nonces a miner that supports noncerange gets at once.
+    NONCERANGE_SIZE = 2**30
+    
+    # How many handed-out WorkUnits are remembered for taking results.
+    MAX_UNITS = 4096
+    
+    # How often the downstream hashrate is worked out, and over how many
+    # seconds of accepted results.
+    RATE_INTERVAL = 10
+    RATE_WINDOW = 300
+    
+    # The second half of the SHA-256 padding, as getwork's data carries it.
+    PADDING = '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00'
+    HASH1 = '00'*32 + '00000080' + '00'*24 + '00010000'
+    
+    def __init__(self, interface, port, host=''):
+        self.interface = interface
+        self.port = port
+        self.host = host
+        self.listener = None
+        
+        self.core = self.interface.addCore()
+        self.units = OrderedDict()
+        self.submitted = set()
+        self.waiting = []
+        self.splitting = None # What's left of the unit being split.
+        self.shares = deque()
+        self.rateCall = task.LoopingCall(self.updateRate)
+        
+        self.applyMeta()
+    
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'getwork server')
+        self.interface.setMeta('device', 'port %d' % self.port)
+    
+    def start(self):
+        """Phoenix wants the kernel to start."""
+        self.interface.addStaleCallback(self.newBlock)
+        self.listener = reactor.listenTCP(self.port,
+            server.Site(GetworkResource(self)), interface=self.host)
+        self.rateCall.start(self.RATE_INTERVAL, now=False)
+        self.interface.log('Serving getwork on port %d' % self.port)
+    
+    def stop(self):
+        """Phoenix wants this kernel to stop. Returns a Deferred that fires
+        once the port is closed.
+        """
+        self.interface.removeStaleCallback(self.newBlock)
+        if self.rateCall.running:
+            self.rateCall.stop()
+        if self.listener is not None:
+            d = self.listener.stopListening()
+            self.listener = None
+            return d
+    
+    def respond(self, request, id, result=None, error=None):
+        """Finish a JSON-RPC response, unless the miner has hung up."""
+        if request.finished:
+            return server.NOT_DONE_YET
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('X-Long-Polling', self.LONGPOLL_PATH)
+        request.write(json.dumps({'result': result, 'error': error,
+                                  'id': id}))
+        request.finish()
+        return server.NOT_DONE_YET
+    
+    def getwork(self, request, id):
+        """Answer a request for work, once the WorkQueue has some."""
+        extensions = (request.getHeader('X-Mining-Extensions') or '').lower()
+        splits = 'noncerange' in extensions.split()
+        
+        # This is the WorkQueue's only consumer, and always takes whole
+        # units, so it never hands out one that's partly used.
+        if splits:
+            d = self.fetchSlice()
+        else:
+            d = self.interface.fetchRange(2**32)
+        d.addCallback(self._sendWork, request, id, splits)
+        return server.NOT_DONE_YET
+    
+    def fetchSlice(self):
+        """Take the next NONCERANGE_SIZE nonces of the unit being split
+        for noncerange miners, starting on a new whole unit once it's used
+        up.
+        """
+        if self.splitting is not None and self.splitting.size:
+            return defer.succeed(self._slice())
+        
+        def gotRange(nr):
+            self.splitting = nr
+            return self._slice()
+        d = self.interface.fetchRange(2**32)
+        d.addCallback(gotRange)
+        return d
+    
+    def _slice(self):
+        nr = self.splitting
+        size = min(self.NONCERANGE_SIZE, nr.size)
+        self.splitting = NonceRange(nr.unit, nr.base + size, nr.size - size)
+        return NonceRange(nr.unit, nr.base, size)
+    
+    def longPoll(self, request):
+        """Hold a long poll until the next block."""
+        self.waiting.append(request)
+        def hungUp(failure):
+            if request in self.waiting:
+                self.waiting.remove(request)
+        request.notifyFinish().addErrback(hungUp)
+        return server.NOT_DONE_YET
+    
+    def newBlock(self):
+        """The WorkQueue says there's a new block: forget the old work and
+        answer every long poll with fresh work.
+        """
+        self.units.clear()
+        self.submitted.clear()
+        self.splitting = None
+        waiting, self.waiting = self.waiting, []
+        for request in waiting:
+            self.getwork(request, 0)
+    
+    def _sendWork(self, nr, request, id, splits):
+        unit = nr.unit
+        key = unit.data[:76]
+        self.units.pop(key, None)
+        self.units[key] = unit
+        if len(self.units) > self.MAX_UNITS:
+            self.units.popitem(last=False)
+        
+        work = {'data': (unit.data[:80] + self.PADDING).encode('hex'),
+                'midstate': unit.midstate.encode('hex'),
+                'hash1': self.HASH1,
+                'target': unit.target.encode('hex')}
+        if splits:
+            work['noncerange'] = '%08x%08x' % (nr.base, nr.base + nr.size - 1)
+        return self.respond(request, id, work)
+    
+    def submit(self, request, id, data):
+        """Check a miner's result and pass it upstream, answering with
+        whether it was accepted.
+        """
+        try:
+            data = data.decode('hex')[:80]
+        except (TypeError, ValueError, AttributeError):
+            return self.respond(request, id, False)
+        unit = self.units.get(data[:76])
+        if len(data) < 80 or unit is None:
+            self.interface.debug('Result for unknown work, not sending')
+            return self.respond(request, id, False)
+        if data in self.submitted:
+            self.interface.debug('Duplicate result, not sending')
+            return self.respond(request, id, False)
+        self.submitted.add(data)
+        
+        nonce, = unpack('<I', data[76:80])
+        d = self.interface.submitNonce(NonceRange(unit, nonce, 1), nonce)
+        def callback(accepted):
+            if accepted:
+                self.shares.append((time(), unit.difficulty))
+            self.respond(request, id, bool(accepted))
+        d.addCallback(callback)
+        return server.NOT_DONE_YET
+    
+    def updateRate(self):
+        """Estimate the downstream hashrate from the results accepted over
+        the last RATE_WINDOW seconds, each of which took difficulty * 2**32
+        hashes on average.
+        """
+        cutoff = time() - self.RATE_WINDOW
+        while self.shares and self.shares[0][0] < cutoff:
+            self.shares.popleft()
+        hashes = sum(difficulty for t, difficulty in self.shares) * 2**32
+        self.core.updateRate(int(hashes/self.RATE_WINDOW/1000))
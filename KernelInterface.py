@@ -20,10 +20,13 @@
 # THE SOFTWARE.
 
 import os
+from collections import deque
 from struct import pack, unpack
 from hashlib import sha256
 from twisted.internet import defer, reactor
 
+from ShareVerifier import ShareVerifier
+
 # I'm using this as a sentinel value to indicate that an option has no default;
 # it must be specified.
 REQUIRED = object()
@@ -61,9 +64,13 @@ class CoreInterface(object):
     Only KernelInterface should create this.
     """
     
+    # How many execution times are kept for reporting their distribution.
+    EXECUTION_SAMPLES = 256
+    
     def __init__(self, kernelInterface):
         self.kernelInterface = kernelInterface
         self.averageSamples = []
+        self.executionTimes = deque(maxlen=self.EXECUTION_SAMPLES)
         
         self.kernelInterface.miner._addCore(self)
     
@@ -85,6 +92,17 @@ class CoreInterface(object):
         
         return sum(self.averageSamples)/len(self.averageSamples)
     
+    def reportExecution(self, dt):
+        """Called with how long each execution took this core, so that the
+        distribution of execution times can be reported.
+        """
+        self.executionTimes.append(dt)
+        self.kernelInterface.miner.updateLatency()
+    
+    def getExecutionTimes(self):
+        """Retrieve the most recent execution times for this core."""
+        return list(self.executionTimes)
+    
     def getKernelInterface(self):
         return self.kernelInterface
         
@@ -93,11 +111,18 @@ class KernelInterface(object):
     framework.
     """
     
+    # How many threads verify found nonces, and how many batches of them may
+    # wait for those threads before kernels are made to wait instead.
+    VERIFY_THREADS = 1
+    VERIFY_QUEUE = 64
+    
     def __init__(self, miner):
         self.miner = miner
         
         self._core = None
         self.workFactor = 1
+        self.verifier = ShareVerifier(self.verifyNonces, self._noncesVerified,
+            self.VERIFY_THREADS, self.VERIFY_QUEUE)
         
     def _getOption(self, name, type, default):
         """KernelOption uses this to read the actual value of the option."""
@@ -170,6 +195,21 @@ class KernelInterface(object):
         if callback in self.miner.queue.staleCallbacks:
             self.miner.queue.staleCallbacks.remove(callback)
     
+    def getGeneration(self):
+        """Returns a counter that goes up every time a new block comes out.
+        A NonceRange is stale once this no longer matches its
+        unit.generation. This is safe to call from the kernel's own threads.
+        """
+        return self.miner.queue.generation
+    
+    def reportNewWork(self, nr, startedAt):
+        """Called when a core starts on the first NonceRange of a new block,
+        so that the time lost switching over to it can be reported.
+        """
+        queue = self.miner.queue
+        if nr.unit.generation == queue.generation and queue.blockTime:
+            self.miner.logger.reportBlockSwitch(startedAt - queue.blockTime)
+    
     def updateRate(self, rate):
         """Used by kernels to declare their hashrate.
         
@@ -193,14 +233,20 @@ class KernelInterface(object):
         intended to be used in hardware sanity-checks.
         """
         
-        # This for loop compares the bytes of the target and hash in reverse
-        # order, because both are 256-bit little endian.
-        for t,h in zip(target[::-1], hash[::-1]):
-            if ord(t) > ord(h):
-                return True
-            elif ord(t) < ord(h):
-                return False
-        return True
+        # Both are 256-bit little endian, so comparing their 64-bit words
+        # from the last one back compares them as integers.
+        return unpack('<4Q', hash)[::-1] <= unpack('<4Q', target)[::-1]
+    
+    def _prepareTarget(self, unit):
+        """Work out the integer form and difficulty of a WorkUnit's target,
+        once per unit.
+        """
+        if unit.targetWords is None:
+            unit.targetWords = unpack('<4Q', unit.target)[::-1]
+            target = 0
+            for word in unit.targetWords:
+                target = target << 64 | word
+            unit.difficulty = (0xffff * 16**52) / float(max(1, target))
  
     def calculateHash(self, nr, nonce):
         """Given a NonceRange and a nonce, calculate the SHA-256 hash of the
@@ -211,40 +257,135 @@ class KernelInterface(object):
         # accidentally set bits outside of the 32-bit space. If the resulting
         # nonce is invalid, it will be caught anyway...
         nonce &= 0xFFFFFFFF
+        
+        # The byteswapped header and the hash of its first 64 bytes are the
+        # same for every nonce, so they're kept on the WorkUnit.
+        unit = nr.unit
+        if unit.headerHash is None:
+            unit.header = pack('>' + 'I'*19,
+                *unpack('<' + 'I'*19, unit.data[:76]))
+            unit.headerHash = sha256(unit.header[:64])
+        
+        h = unit.headerHash.copy()
+        h.update(unit.header[64:] + pack('>I', nonce))
+        return sha256(h.digest()).digest()
+    
+    def verifyNonces(self, nr, nonces):
+        """Given a NonceRange and a sequence of candidate nonces from it, hash
+        each of them and sort them out by the unit's target. Returns
+        (winners, invalid): winners is a list of (nonce, hash) pairs that
+        meet the target, and invalid lists the nonces whose hash doesn't even
+        end in 32 zero bits, which usually means a hardware problem. The
+        unit's difficulty is left in nr.unit.difficulty.
+        
+        This doesn't touch the rest of Phoenix, so it's safe to call from any
+        thread.
+        """
+        unit = nr.unit
+        self._prepareTarget(unit)
+        targetWords = unit.targetWords
+        
+        winners = []
+        invalid = []
+        for nonce in nonces:
+            # Sometimes kernels send weird nonces down the pipe. We can assume
+            # they accidentally set bits outside of the 32-bit space. If the
+            # resulting nonce is invalid, it will be caught anyway...
+            nonce = int(nonce) & 0xFFFFFFFF
+            hash = self.calculateHash(nr, nonce)
+            words = unpack('<4Q', hash)
+            if words[3] >> 32:
+                invalid.append(nonce)
+            elif words[::-1] <= targetWords:
+                winners.append((nonce, hash))
+        return winners, invalid
+    
+    def queueNonces(self, nr, nonces, onInvalid=None):
+        """Called from a kernel's own thread with the candidate nonces it
+        found in a NonceRange. They are verified off the reactor, and only
+        those that meet the target come back to it to be sent. If any look
+        like hardware errors, onInvalid is called with them on the reactor.
+        
+        This blocks while too many nonces are already waiting to be verified.
+        """
+        self.verifier.put(nr, nonces, onInvalid)
+    
+    def _noncesVerified(self, nr, nonces, result, onInvalid):
+        """The ShareVerifier calls this on the reactor once a batch from
+        queueNonces has been verified.
+        """
+        self.miner.logger.reportVerifyQueue(self.verifier.depth(),
+            self.verifier.stalls)
+        winners, invalid = result
+        if not self.miner.queue.isRangeStale(nr):
+            self._sendVerified(nr, nonces, winners, invalid)
+        elif winners:
+            self.miner.connection.reportStale(nr)
+        if invalid and onInvalid:
+            onInvalid(invalid)
     
-        staticDataUnpacked = unpack('<' + 'I'*19, nr.unit.data[:76])
-        staticData = pack('>' + 'I'*19, *staticDataUnpacked)
-        hashInput = pack('>76sI', staticData, nonce)
-        return sha256(sha256(hashInput).digest()).digest()
+    def _sendVerified(self, nr, nonces, winners, invalid):
+        """Send the nonces verifyNonces picked out, and note how many didn't
+        quite make it.
+        """
+        for nonce, hash in winners:
+            self._sendResult(nr, nonce, hash)
+        for i in range(len(nonces) - len(winners) - len(invalid)):
+            self.miner.logger.reportDebug("Result didn't meet full "
+                   "difficulty, not sending")
+    
+    def foundNonces(self, nr, nonces):
+        """The batch form of foundNonce. Sends every nonce that meets the
+        target and returns the ones that looked like hardware errors, as
+        verifyNonces does. This verifies on the reactor, so threaded kernels
+        should use queueNonces instead.
+        """
+        
+        # Check if the block has changed while this NonceRange was being
+        # processed by the kernel. If so, don't send anything to the server.
+        if self.miner.queue.isRangeStale(nr):
+            return []
+        
+        winners, invalid = self.verifyNonces(nr, nonces)
+        self._sendVerified(nr, nonces, winners, invalid)
+        return invalid
     
     def foundNonce(self, nr, nonce):
         """Called by kernels when they may have found a nonce."""
         
-        # Sometimes kernels send weird nonces down the pipe. We can assume they
-        # accidentally set bits outside of the 32-bit space. If the resulting
-        # nonce is invalid, it will be caught anyway...
-        nonce &= 0xFFFFFFFF
-        
         # Check if the block has changed while this NonceRange was being
         # processed by the kernel. If so, don't send it to the server.
         if self.miner.queue.isRangeStale(nr):
             return False
         
         # Check if the hash meets the full difficulty before sending.
-        hash = self.calculateHash(nr, nonce)
- 
-        if self.checkTarget(hash, nr.unit.target):
-            formattedResult = pack('<76sI', nr.unit.data[:76], nonce)
-            d = self.miner.connection.sendResult(formattedResult)
-            def callback(accepted):
-                diff = (0xffff * 16**52) / float(int(''.join(reversed([nr.unit.target.encode('hex')[2*i:2*i+2] for i in xrange(len(nr.unit.target.encode('hex'))/2)])),16))
-                self.miner.logger.reportFound(hash, accepted, diff=diff)
-            d.addCallback(callback)
-            return True
-        else:
-            self.miner.logger.reportDebug("Result didn't meet full "
-                   "difficulty, not sending")
-            return False
+        winners, invalid = self.verifyNonces(nr, [nonce])
+        self._sendVerified(nr, [nonce], winners, invalid)
+        return bool(winners)
+    
+    def submitNonce(self, nr, nonce):
+        """Like foundNonce, but returns a Deferred that fires with whether
+        the server accepted the nonce. It fires with False right away if the
+        NonceRange is stale or the nonce doesn't meet the target.
+        """
+        winners, invalid = self.verifyNonces(nr, [nonce])
+        if not winners:
+            return defer.succeed(False)
+        if self.miner.queue.isRangeStale(nr):
+            self.miner.connection.reportStale(nr)
+            return defer.succeed(False)
+        return self._sendResult(nr, *winners[0])
+    
+    def _sendResult(self, nr, nonce, hash):
+        """Send a verified nonce to the server and report how it went."""
+        formattedResult = pack('<76sI', nr.unit.data[:76], nonce)
+        d = nr.unit.source.sendResult(formattedResult)
+        def callback(accepted):
+            self.miner.logger.reportFound(hash, accepted,
+                diff=nr.unit.difficulty)
+            return accepted
+        d.addCallback(callback)
+        return d
     
     def debug(self, msg):
         """Log information as debug so that it can be viewed only when -v is
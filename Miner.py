@@ -25,6 +25,8 @@ import platform
 from twisted.internet import reactor
 
 from minerutil.MMPProtocol import MMPClient
+from minerutil.StratumProtocol import StratumClient
+from minerutil.PoolManager import PoolManager
 from KernelInterface import KernelInterface
 
 class Miner(object):
@@ -45,6 +47,7 @@ class Miner(object):
         self.cores = []
         self.lastMetaRate = 0.0
         self.lastRateUpdate = time()
+        self.lastLatencyUpdate = 0.0
     
     # Connection callbacks...
     def onFailure(self):
@@ -64,6 +67,13 @@ class Miner(object):
         self.logger.reportType('RPC' + (' (+LP)' if lp else ''))
     def onPush(self, ignored):
         self.logger.log('LP: New work pushed')
+    def onSwitch(self, pools, reason):
+        self.logger.reportPoolSwitch([pool.name for pool in pools], reason)
+        self.reportType(pools[0].client, pools[0].longpoll)
+    def onDrop(self, pool):
+        self.queue.dropSource(pool)
+    def onRates(self, rates):
+        self.logger.reportPoolRates(rates)
 
     def start(self, options):
         """Configures the Miner via the options specified and begins mining."""
@@ -78,11 +88,10 @@ class Miner(object):
         #log a message to let the user know that phoenix is starting
         self.logger.log("Phoenix %s starting..." % self.VERSION)
         
-        #this will need to be changed to add new protocols
-        if isinstance(self.connection, MMPClient):
-            self.logger.reportType('MMP')
+        if isinstance(self.connection, PoolManager):
+            self.reportType(self.connection.active.client)
         else:
-            self.logger.reportType('RPC')
+            self.reportType(self.connection)
         
         self.applyMeta()
         
@@ -91,6 +100,17 @@ class Miner(object):
         self.kernel.start()
         reactor.addSystemEventTrigger('before', 'shutdown', self.kernel.stop)
     
+    def reportType(self, connection, longpoll=False):
+        """Tell the logger what kind of connection work is coming from."""
+        
+        #this will need to be changed to add new protocols
+        if isinstance(connection, MMPClient):
+            self.logger.reportType('MMP')
+        elif isinstance(connection, StratumClient):
+            self.logger.reportType('Stratum')
+        else:
+            self.logger.reportType('RPC' + (' (+LP)' if longpoll else ''))
+    
     def applyMeta(self):
         """Applies any static metafields to the connection, such as version,
         kernel, hardware, etc.
@@ -146,3 +166,28 @@ class Miner(object):
         if self.lastMetaRate+30 < time():
             self.connection.setMeta('rate', total)
             self.lastMetaRate = time()
+    
+    def updateLatency(self):
+        """Summarize how long the recent executions of all cores took, as
+        milliseconds at a few percentiles, and pass that on to the logger.
+        """
+        
+        # Once a second is plenty.
+        if self.lastLatencyUpdate+1 > time():
+            return
+        self.lastLatencyUpdate = time()
+        
+        times = []
+        for core in self.cores:
+            times.extend(core.getExecutionTimes())
+        if not times:
+            return
+        times.sort()
+        
+        percentile = lambda p: times[min(len(times)-1, int(len(times)*p))]
+        self.logger.reportLatency({
+            'samples': len(times),
+            'p50': percentile(0.5)*1000,
+            'p90': percentile(0.9)*1000,
+            'p99': percentile(0.99)*1000,
+            'max': times[-1]*1000})
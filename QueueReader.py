@@ -25,6 +25,21 @@ from twisted.internet import reactor, defer
 
 from KernelInterface import CoreInterface
 
+def resizeExecution(launch, step, executionTime, time, size):
+    """Work out how many nonces a kernel should run per execution so that
+    each takes about executionTime seconds, given that size nonces took time
+    seconds recently and executions are currently launch nonces.
+    
+    The correction is applied as the square root of the ratio, so that a
+    single slow or fast sample can't swing the execution size all at once.
+    The result is always a multiple of step, and never more than 2**32
+    nonces.
+    """
+    ideal = size * executionTime / time
+    launch = launch * (ideal / launch) ** 0.5
+    launch = step * max(1, round(launch / step))
+    return int(min(launch, step * ((1 << 32) // step)))
+
 class QueueReader(object):
     """A QueueReader is a very efficient WorkQueue reader that keeps the next
     nonce range available at all times. The benefit is that threaded mining
@@ -58,8 +73,9 @@ class QueueReader(object):
         # This shuttles work to the dedicated thread.
         self.dataQueue = Queue()
         
-        # Used in averaging the last execution times.
+        # Used in averaging the last execution times and sizes.
         self.executionTimeSamples = []
+        self.executionSizeSamples = []
         self.averageExecutionTime = None
         
         # This gets changed by _updateWorkSize.
@@ -68,6 +84,7 @@ class QueueReader(object):
         # Statistics accessed by the dedicated thread.
         self.currentData = None
         self.startedAt = None
+        self.generation = None
         
     def start(self):
         """Called by the kernel when it's actually starting."""
@@ -88,23 +105,49 @@ class QueueReader(object):
                 pass
         self.dataQueue.put(StopIteration())
     
-    def _ranExecution(self, dt, nr):
-        """An internal function called after an execution completes, with the
-        time it took. Used to keep track of the time so kernels can use it to
-        tune their execution times.
+    def skipTiming(self):
+        """Called by the dedicated thread when the range it just took is only
+        being queued up behind another one, so the time until the next
+        iteration says nothing about how long it took to execute.
+        """
+        self.currentData = None
+    
+    def isStale(self):
+        """Called by the dedicated thread between executions of the current
+        range, to check whether a new block has come out since it was
+        fetched. If so, the rest of the range is useless and should be
+        dropped; call skipTiming first so it isn't counted as an execution.
+        """
+        if self.currentData is None:
+            return False
+        return (self.currentData[1].unit.generation !=
+                self.interface.getGeneration())
+    
+    def _ranExecution(self, dt, nr, executions=1):
+        """An internal function called after a range completes, with the
+        time it took and how many executions the kernel split it into. Used
+        to keep track of the time so kernels can use it to tune their
+        execution times.
         """
         
         if dt > 0:
             self.core.updateRate(int(nr.size/dt/1000))
+        self.core.reportExecution(dt / max(1, executions))
         
         self.executionTimeSamples.append(dt)
         self.executionTimeSamples = self.executionTimeSamples[-self.SAMPLES:]
+        self.executionSizeSamples.append(nr.size)
+        self.executionSizeSamples = self.executionSizeSamples[-self.SAMPLES:]
         
         if len(self.executionTimeSamples) == self.SAMPLES:
             averageExecutionTime = (sum(self.executionTimeSamples) /
                                     len(self.executionTimeSamples))
+            # The sizes are averaged too, since they may have changed within
+            # the samples.
+            averageExecutionSize = (sum(self.executionSizeSamples) /
+                                    len(self.executionSizeSamples))
 
-            self._updateWorkSize(averageExecutionTime, nr.size)
+            self._updateWorkSize(averageExecutionTime, averageExecutionSize)
     
     def _updateWorkSize(self, time, size):
         """An internal function that tunes the executionSize to that specified
@@ -175,7 +218,8 @@ class QueueReader(object):
         if self.currentData:
             dt = now - self.startedAt
             # self.currentData[1] is the un-preprocessed NonceRange.
-            reactor.callFromThread(self._ranExecution, dt, self.currentData[1])
+            reactor.callFromThread(self._ranExecution, dt, self.currentData[1],
+                getattr(self.currentData[0], 'iterations', 1))
         self.startedAt = now
         
         # Block for more data from the main thread. In 99% of cases, though,
@@ -190,5 +234,13 @@ class QueueReader(object):
         # We just took the only item in the queue. It needs to be restocked.
         reactor.callFromThread(self._requestMore)
         
+        # Note how long it took to get onto the new block, if there is one.
+        nr = self.currentData[1]
+        if nr.unit.generation != self.generation:
+            if self.generation is not None:
+                reactor.callFromThread(self.interface.reportNewWork, nr,
+                    time())
+            self.generation = nr.unit.generation
+        
         # currentData is actually a tuple, with item 0 intended for the kernel.
         return self.currentData[0]
\ No newline at end of file
@@ -0,0 +1,81 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+from Queue import Queue, Full
+from twisted.internet import reactor
+from twisted.python import log
+
+class ShareVerifier(object):
+    """A ShareVerifier checks candidate nonces on threads of its own, so that
+    a burst of them can't hold up the reactor, which also has to keep up
+    with getwork requests, longpolls and submissions. The verify function
+    runs on those threads; only its results go back to the reactor, where
+    callback is called with them.
+    
+    The queue in front of the threads is bounded. Once it's full, put blocks,
+    which slows down the kernel that found the nonces instead of the reactor.
+    """
+    
+    def __init__(self, verify, callback, threads=1, maxDepth=64):
+        self.verify = verify
+        self.callback = callback
+        self.maxDepth = maxDepth
+        self.jobs = Queue(maxDepth)
+        
+        # How many times a kernel had to wait for room in the queue. Several
+        # kernels' threads may stall at once.
+        self.stalls = 0
+        self.stallLock = threading.Lock()
+        
+        for i in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+    
+    def depth(self):
+        """How many batches of nonces are waiting to be verified."""
+        return self.jobs.qsize()
+    
+    def put(self, nr, nonces, *args):
+        """Queue a batch of nonces from a NonceRange to be verified. Any
+        further arguments are passed along to the callback. This is meant to
+        be called from a kernel's own threads, as it blocks while the queue is
+        full.
+        """
+        job = (nr, list(nonces), args)
+        try:
+            self.jobs.put(job, False)
+        except Full:
+            with self.stallLock:
+                self.stalls += 1
+            self.jobs.put(job)
+    
+    def _run(self):
+        while True:
+            nr, nonces, args = self.jobs.get()
+            # Don't let one bad batch take the thread down with it.
+            try:
+                result = self.verify(nr, nonces)
+            except Exception:
+                log.err()
+                continue
+            reactor.callFromThread(self.callback, nr, nonces, result, *args)
@@ -19,9 +19,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from minerutil.Midstate import calculateMidstate
+from minerutil.Midstate import calculateMidstate, calculateMidstates
 from twisted.internet import defer
-from collections import deque
+from collections import deque, OrderedDict
+from struct import pack, unpack
+from time import time
 
 """A WorkUnit is a single unit containing 2^32 nonces. A single getWork
 request returns a WorkUnit.
@@ -33,6 +35,14 @@ class WorkUnit(object):
     nonces = None
     base = None
     work = None
+    generation = None # Which block this WorkUnit belongs to; see WorkQueue.
+    precomputed = None # Left for the kernel to cache per-unit data in.
+    header = None # The first 76 header bytes in SHA-256 byte order...
+    headerHash = None # ...and a sha256 that has been fed the first 64.
+    targetWords = None # The target as 64-bit words, most significant first.
+    difficulty = None # The share difficulty that the target works out to.
+    source = None # The connection that results for this unit go to.
+    expires = None # When rolled work stops being good, if it was rolled.
 
 """A NonceRange is a range of nonces from a WorkUnit, to be dispatched in a
 single execution of a mining kernel. The size of the NonceRange can be
@@ -55,6 +65,14 @@ class WorkQueue(object):
     by the miner. WorkQueues dispatch deffereds when they runs out of nonces.
     """
     
+    # How many midstates are remembered, keyed by the header bytes they were
+    # calculated from.
+    MIDSTATE_CACHE_SIZE = 256
+    
+    # How many seconds work is rolled for when the server allows version
+    # rolling but didn't say how long its work stays good.
+    ROLL_EXPIRE = 60
+    
     def __init__(self, miner, options):
     
         self.miner = miner
@@ -68,6 +86,25 @@ class WorkQueue(object):
         self.lastBlock = None
         self.test = False
         
+        # This counts block changes, so that kernels can cheaply tell from
+        # another thread whether a WorkUnit is still current. blockTime is
+        # when the current block was first seen.
+        self.generation = 0
+        self.blockTime = None
+        
+        # Work that only differs after the first 64 bytes of the header has
+        # the same midstate, so recent ones are kept around.
+        self.midstates = OrderedDict()
+        self.midstateHits = 0
+        self.midstateMisses = 0
+        
+        # The last WorkUnit the server let us roll, if any, and how.
+        self.template = None
+        self.templateRollNTime = 0
+        self.templateVersionMask = 0
+        self.templateExpires = None
+        self.rolls = 0
+        
         # This is set externally. Not the best practice, but it can be changed
         # in the future.
         self.staleCallbacks = []
@@ -76,6 +113,22 @@ class WorkQueue(object):
     def isRangeStale(self, nr):
         return (nr.unit.data[4:36] != self.block)
         
+    def getMidstate(self, data):
+        """Return the midstate of the first 64 bytes of data, only
+        calculating it if none of the recent WorkUnits shared them.
+        """
+        prefix = data[:64]
+        midstate = self.midstates.pop(prefix, None)
+        if midstate is None:
+            self.midstateMisses += 1
+            midstate = calculateMidstate(prefix)
+            if len(self.midstates) >= self.MIDSTATE_CACHE_SIZE:
+                self.midstates.popitem(last=False)
+        else:
+            self.midstateHits += 1
+        self.midstates[prefix] = midstate
+        return midstate
+    
     def storeWork(self, wu):
         
         #check if this work matches the previous block
@@ -83,17 +136,18 @@ class WorkQueue(object):
             self.logger.reportDebug('Server gave work from the previous '
                                     'block, ignoring.')
             #if the queue is too short request more work
-            if (len(self.queue)) < (self.queueSize):
-                self.miner.connection.requestWork()
+            self.refill()
             return
         
         #create a WorkUnit
         work = WorkUnit()
         work.data = wu.data
         work.target = wu.target
-        work.midstate = calculateMidstate(work.data[:64])
+        work.midstate = self.getMidstate(work.data)
         work.nonces = 2 ** wu.mask
         work.base = 0
+        work.source = (wu.source if wu.source is not None else
+                       self.miner.connection)
         
         #check if there is a new block, if so reset queue
         newBlock = (wu.data[4:36] != self.block)
@@ -102,7 +156,12 @@ class WorkQueue(object):
             self.currentUnit = None
             self.lastBlock = self.block
             self.block = wu.data[4:36]
+            self.generation += 1
+            self.blockTime = time()
             self.logger.reportDebug("New block (WorkQueue)")
+            self.logger.reportDebug('Midstate cache: %d hits, %d misses' %
+                (self.midstateHits, self.midstateMisses))
+        work.generation = self.generation
         
         #clear the idle flag since we just added work to queue
         self.miner.reportIdle(False)
@@ -110,10 +169,21 @@ class WorkQueue(object):
         #add new WorkUnit to queue
         if work.data and work.target and work.midstate and work.nonces:
             self.queue.append(work)
+            
+            #work that may be rolled becomes the template for more units
+            if wu.rollNTime or wu.versionMask:
+                self.template = work
+                self.templateRollNTime = wu.rollNTime
+                self.templateVersionMask = wu.versionMask
+                self.templateExpires = time() + (wu.rollNTime or
+                                                 self.ROLL_EXPIRE)
+                self.rolls = 0
+                work.expires = self.templateExpires
+            else:
+                self.template = None
         
         #if the queue is too short request more work
-        if (len(self.queue)) < (self.queueSize):
-            self.miner.connection.requestWork()
+        self.refill()
         
         #if there is a new block notify kernels that their work is now stale
         if newBlock:
@@ -128,15 +198,116 @@ class WorkQueue(object):
             d = self.fetchRange(size)
             d.chainDeferred(df)
    
+    def dropSource(self, source):
+        """Drop all queued work from source, since it is no longer being
+        mined for. Results already found in its work are still sent to it.
+        """
+        for work in [w for w in self.queue if w.source is source]:
+            self.queue.remove(work)
+        if self.currentUnit is not None and self.currentUnit.source is source:
+            self.currentUnit = None
+        if self.template is not None and self.template.source is source:
+            self.template = None
+    
     #gets the next WorkUnit from queue
     def getNext(self):
         
-        #check if the queue will fall below desired size
-        if (len(self.queue) - 1) < (self.queueSize):
+        #take the next WorkUnit, then make sure the queue doesn't stay short
+        work = self.queue.popleft()
+        self.refill()
+        
+        #return next WorkUnit
+        return work
+    
+    def dropExpired(self):
+        """Drop queued WorkUnits from a template that has expired, since the
+        server won't take results for them any more.
+        """
+        now = time()
+        for work in [w for w in self.queue
+                     if w.expires is not None and w.expires <= now]:
+            self.queue.remove(work)
+    
+    def refill(self):
+        """Keep queueSize WorkUnits in the queue, rolling them from the
+        template while it lasts and asking the server for more otherwise.
+        """
+        self.dropExpired()
+        self.rollQueue()
+        if len(self.queue) < self.queueSize:
             self.miner.connection.requestWork()
     
-        #return next WorkUnit
-        return self.queue.popleft()
+    def rollWork(self):
+        """Make the next WorkUnit from the template by changing its ntime
+        and version. Every allowed version is used before ntime is advanced,
+        and ntime never goes more than templateRollNTime seconds past the
+        template's. The midstate is left for rollQueue to fill in. Returns
+        None once the template is used up or expired.
+        """
+        if self.template is None:
+            return None
+        if time() >= self.templateExpires:
+            self.template = None
+            return None
+        
+        self.rolls += 1
+        versions = 1 << bin(self.templateVersionMask).count('1')
+        variant, offset = self.rolls % versions, self.rolls // versions
+        if offset > self.templateRollNTime:
+            self.template = None
+            return None
+        
+        # Spread the variant over the bits that the version mask allows.
+        versionBits = 0
+        mask = self.templateVersionMask
+        while variant and mask:
+            bit = mask & -mask
+            if variant & 1:
+                versionBits |= bit
+            variant >>= 1
+            mask ^= bit
+        
+        # The header words are byteswapped in getwork data, so both fields
+        # read as big-endian here.
+        t = self.template
+        version, = unpack('>I', t.data[0:4])
+        ntime, = unpack('>I', t.data[68:72])
+        work = WorkUnit()
+        work.data = (pack('>I', version ^ versionBits) + t.data[4:68] +
+                     pack('>I', (ntime + offset) & 0xFFFFFFFF) + t.data[72:])
+        work.target = t.target
+        work.nonces = t.nonces
+        work.base = 0
+        work.generation = t.generation
+        work.source = t.source
+        work.expires = t.expires
+        return work
+    
+    def rollQueue(self):
+        """Top the queue up to queueSize with WorkUnits rolled from the
+        template. Units whose version changed need new midstates, which are
+        calculated together.
+        """
+        template = self.template
+        units = []
+        while len(self.queue) + len(units) < self.queueSize:
+            work = self.rollWork()
+            if work is None:
+                break
+            units.append(work)
+        if not units:
+            return
+        
+        prefix = template.data[:64]
+        rolled = [w for w in units if w.data[:64] != prefix]
+        for w in units:
+            if w.data[:64] == prefix:
+                w.midstate = template.midstate
+        for w, midstate in zip(rolled,
+                calculateMidstates([w.data[:64] for w in rolled])):
+            w.midstate = midstate
+        
+        self.queue.extend(units)
     
     def getRangeFromUnit(self, size):
         
@@ -159,6 +330,9 @@ class WorkQueue(object):
                 self.currentUnit, self.currentUnit.base, noncesLeft)
             self.currentUnit = None
         
+        #let the connection account for the nonces
+        self.miner.connection.reportRange(nr)
+        
         #return the range
         return nr
     
@@ -185,6 +359,11 @@ class WorkQueue(object):
             
         #if there is no current unit
         else:
+            #roll a new unit from the template if the queue has run dry
+            self.dropExpired()
+            if not self.queue:
+                self.rollQueue()
+            
             #if there is another unit in queue
             if len(self.queue) >= 1:
             
@@ -0,0 +1,161 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import mmap
+import multiprocessing
+from struct import Struct, pack, unpack
+
+class WorkDescriptor(object):
+    """A WorkDescriptor is the fixed-layout form of a NonceRange that crosses
+    into worker processes. The header is the first 76 bytes of the block
+    header in SHA-256 byte order, followed by the unit's target, the range's
+    base and size, the unit's generation, and finally how many results the
+    worker wrote back.
+    """
+    header = None
+    target = None
+    base = None
+    size = None
+    generation = None
+    nr = None # Kept on the producer side only; never written to the ring.
+
+    @classmethod
+    def fromRange(cls, nr):
+        wd = cls()
+        wd.header = pack('>' + 'I'*19,
+            *unpack('<' + 'I'*19, nr.unit.data[:76]))
+        wd.target = nr.unit.target
+        wd.base = nr.base
+        wd.size = nr.size
+        wd.generation = nr.unit.generation or 0
+        wd.nr = nr
+        return wd
+
+class WorkRing(object):
+    """A WorkRing is a ring buffer of WorkDescriptors in anonymous shared
+    memory, connecting one producer (a kernel's mining thread) to one worker
+    process. Descriptors and results are written in place, so nothing is
+    pickled and the cost of dispatching a range does not depend on its size.
+
+    The ring must be created before the worker process is forked.
+    """
+
+    SLOT = Struct('<76s32sIIII')
+    FLAGS = Struct('<I')
+    GENERATION = Struct('<I')
+    NONCE = Struct('<I')
+
+    def __init__(self, slots=2, maxResults=16):
+        self.slots = slots
+        self.maxResults = maxResults
+        self.slotSize = self.SLOT.size + self.NONCE.size*maxResults
+
+        # The first word holds the closed flag and the second the current
+        # generation; the slots follow.
+        self.buffer = mmap.mmap(-1, self._offset(slots))
+
+        self.free = multiprocessing.Semaphore(slots)
+        self.filled = multiprocessing.Semaphore(0)
+        self.done = multiprocessing.Semaphore(0)
+
+        # Each side only ever touches its own indices, and each process gets
+        # its own copy of this object when the worker is forked.
+        self.putIndex = 0
+        self.collectIndex = 0
+        self.getIndex = 0
+
+    def _offset(self, index):
+        return self.FLAGS.size + self.GENERATION.size + index*self.slotSize
+
+    def isClosed(self):
+        return bool(self.FLAGS.unpack_from(self.buffer, 0)[0])
+
+    def close(self):
+        """Wake up both sides and tell them to stop."""
+        self.FLAGS.pack_into(self.buffer, 0, 1)
+        self.filled.release()
+        self.done.release()
+
+    def getGeneration(self):
+        return self.GENERATION.unpack_from(self.buffer, self.FLAGS.size)[0]
+
+    # Producer side...
+    def setGeneration(self, generation):
+        """Tell the worker which generation is current, so that it can give
+        up on descriptors from older ones.
+        """
+        self.GENERATION.pack_into(self.buffer, self.FLAGS.size, generation)
+
+    def put(self, wd):
+        """Write a WorkDescriptor into the next free slot, blocking while the
+        ring is full.
+        """
+        self.free.acquire()
+        self.SLOT.pack_into(self.buffer, self._offset(self.putIndex),
+            wd.header, wd.target, wd.base, wd.size, wd.generation, 0)
+        self.putIndex = (self.putIndex + 1) % self.slots
+        self.filled.release()
+
+    def collect(self, timeout=None):
+        """Wait for the oldest outstanding descriptor to be finished and
+        return (results, count). count may exceed len(results) if the worker
+        found more than maxResults nonces. Returns None if the ring was closed
+        or the timeout expired.
+        """
+        if not self.done.acquire(True, timeout) or self.isClosed():
+            return None
+        offset = self._offset(self.collectIndex) + self.SLOT.size
+        count = self.NONCE.unpack_from(self.buffer,
+            offset - self.NONCE.size)[0]
+        results = [self.NONCE.unpack_from(self.buffer,
+            offset + i*self.NONCE.size)[0]
+            for i in range(min(count, self.maxResults))]
+        self.collectIndex = (self.collectIndex + 1) % self.slots
+        self.free.release()
+        return results, count
+
+    # Worker side...
+    def get(self):
+        """Block until a descriptor is available, then return it along with
+        the slot it lives in. Returns None once the ring is closed.
+        """
+        self.filled.acquire()
+        if self.isClosed():
+            return None
+        index = self.getIndex
+        self.getIndex = (self.getIndex + 1) % self.slots
+
+        wd = WorkDescriptor()
+        (wd.header, wd.target, wd.base, wd.size, wd.generation,
+            count) = self.SLOT.unpack_from(self.buffer, self._offset(index))
+        return index, wd
+
+    def finish(self, index, results):
+        """Write the results for the descriptor in the given slot and hand
+        the slot back to the producer.
+        """
+        offset = self._offset(index) + self.SLOT.size
+        self.NONCE.pack_into(self.buffer, offset - self.NONCE.size,
+            len(results))
+        for i, nonce in enumerate(results[:self.maxResults]):
+            self.NONCE.pack_into(self.buffer, offset + i*self.NONCE.size,
+                nonce)
+        self.done.release()
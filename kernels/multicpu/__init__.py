@@ -0,0 +1,219 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import multiprocessing
+import platform
+import signal
+
+from collections import deque
+from hashlib import sha256
+from struct import Struct
+from twisted.internet import reactor
+
+from QueueReader import QueueReader
+from WorkRing import WorkRing, WorkDescriptor
+from KernelInterface import *
+
+# How many nonces a worker hashes between checks for a new block.
+STALE_CHECK = 0x1000
+
+def hashWorker(ring):
+    """The loop run by each worker process. It takes WorkDescriptors off its
+    WorkRing and hands back the nonces whose hash meets the unit's target.
+    """
+    # Ctrl+C reaches the whole process group; let Phoenix shut us down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    packNonce = Struct('>I').pack
+    lastHeader = None
+    while True:
+        job = ring.get()
+        if job is None:
+            return
+        index, wd = job
+
+        # The first 64 bytes are hashed only once per header; each nonce then
+        # just copies the primed context.
+        if wd.header != lastHeader:
+            lastHeader = wd.header
+            primed = sha256(wd.header[:64])
+            tail = wd.header[64:76]
+
+        # Hashes and targets are 256-bit little endian, so reversed they
+        # compare as strings. Most hashes fail the cheaper check first.
+        target = wd.target[::-1]
+        found = []
+        end = wd.base + wd.size
+        for start in xrange(wd.base, end, STALE_CHECK):
+            # Give up on the rest of the range once a new block has made it
+            # stale.
+            if ring.getGeneration() != wd.generation:
+                break
+            for nonce in xrange(start, min(start + STALE_CHECK, end)):
+                h = primed.copy()
+                h.update(tail + packNonce(nonce))
+                hash = sha256(h.digest()).digest()
+                if (hash.endswith('\x00\x00\x00\x00') and
+                    hash[::-1] <= target):
+                    found.append(nonce)
+        ring.finish(index, found)
+
+class Worker(object):
+    """One worker process, along with the CoreInterface and QueueReader that
+    feed it from the Phoenix side.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.core = kernel.interface.addCore()
+        self.qr = QueueReader(self.core, WorkDescriptor.fromRange,
+                                lambda x,y: kernel.workSize(x, y))
+
+        # Two slots let the next range be written while the worker is still
+        # hashing the current one.
+        self.ring = WorkRing(2)
+        self.process = multiprocessing.Process(target=hashWorker,
+                                               args=(self.ring,))
+        self.process.daemon = True
+        self.stopped = False
+
+    def start(self):
+        self.process.start()
+        self.qr.start()
+        self.kernel.interface.addStaleCallback(self.newBlock)
+        reactor.callInThread(self.mineThread)
+
+    def stop(self):
+        self.stopped = True
+        self.kernel.interface.removeStaleCallback(self.newBlock)
+        self.qr.stop()
+        self.ring.close()
+
+    def newBlock(self):
+        """Called on the reactor when a new block comes out, so that the
+        worker stops hashing ranges it has made stale.
+        """
+        self.ring.setGeneration(self.kernel.interface.getGeneration())
+
+    def collect(self, nr):
+        """Wait for the worker to finish the oldest range in the ring."""
+        while True:
+            result = self.ring.collect(1.0)
+            if result is not None:
+                break
+            if self.stopped or self.ring.isClosed():
+                return False
+            if not self.process.is_alive():
+                reactor.callFromThread(self.kernel.interface.error,
+                    'CPU worker process died!')
+                return False
+
+        found, count = result
+
+        # The worker gave up on this range when it went stale, and anything
+        # it found before then is no use.
+        if nr.unit.generation != self.kernel.interface.getGeneration():
+            self.qr.skipTiming()
+            return True
+
+        if count > len(found):
+            reactor.callFromThread(self.kernel.interface.error,
+                'Worker found %d nonces but only %d fit in the ring; '
+                'lower EXECUTIONTIME.' % (count, len(found)))
+        if found:
+            self.kernel.interface.queueNonces(nr, found)
+        return True
+
+    def mineThread(self):
+        pending = deque()
+        for wd in self.qr:
+            # Don't even start on a range that a new block has made stale.
+            if self.qr.isStale():
+                self.qr.skipTiming()
+                continue
+
+            self.ring.setGeneration(self.kernel.interface.getGeneration())
+            self.ring.put(wd)
+            pending.append(wd.nr)
+
+            # The first range just fills the pipeline; nothing has finished.
+            if len(pending) < self.ring.slots:
+                self.qr.skipTiming()
+                continue
+
+            if not self.collect(pending.popleft()):
+                return
+
+class MiningKernel(object):
+    """A Phoenix Miner-compatible kernel that hashes on the CPU with hashlib,
+    using one worker process per core to get around the GIL.
+    """
+
+    WORKERS = KernelOption(
+        'WORKERS', int, default=None,
+        help='How many worker processes to run (default: one per core)')
+    EXECUTIONTIME = KernelOption(
+        'EXECUTIONTIME', float, default=1.0, advanced=True,
+        help='Target number of seconds to spend on each NonceRange')
+
+    # This gets updated automatically by SVN.
+    REVISION = '$Rev$'
+
+    def __init__(self, interface):
+        self.interface = interface
+
+        if self.WORKERS is None:
+            self.WORKERS = multiprocessing.cpu_count()
+        self.WORKERS = max(1, self.WORKERS)
+
+        # Every worker blocks one reactor pool thread while waiting on its
+        # process, so the pool needs room for all of them.
+        reactor.suggestThreadPoolSize(self.WORKERS + 10)
+
+        self.workers = [Worker(self) for i in range(self.WORKERS)]
+
+        self.applyMeta()
+
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'multicpu r%s' % self.REVISION)
+        self.interface.setMeta('device', platform.processor() or 'CPU')
+        self.interface.setMeta('cores', self.WORKERS)
+
+    def workSize(self, time, size):
+        """Scale the range size so that each range takes about EXECUTIONTIME
+        seconds to hash.
+        """
+        if not time:
+            return 0x10000
+        return max(256, int(size * self.EXECUTIONTIME / time))
+
+    def start(self):
+        """Phoenix wants the kernel to start."""
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Phoenix wants this kernel to stop. The kernel is not necessarily
+        reusable, so it's safe to clean up as well.
+        """
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,230 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import multiprocessing
+import numpy as np
+import platform
+
+from struct import unpack
+from twisted.internet import reactor
+
+from minerutil.Midstate import calculateMidstate, K, A0, B0, C0, D0, E0, F0, \
+    G0, H0
+from QueueReader import QueueReader
+from KernelInterface import *
+
+MASK = 0xFFFFFFFF
+
+# These helpers accept either plain ints or uint32 lane arrays, so that every
+# value which does not depend on the nonce stays a Python int and is folded
+# into a single constant instead of being broadcast across all lanes.
+
+def rotr(x, n):
+    if isinstance(x, np.ndarray):
+        return (x >> n) | (x << (32 - n))
+    return ((x >> n) | (x << (32 - n))) & MASK
+
+def shr(x, n):
+    return x >> n
+
+def add(*terms):
+    constant = 0
+    lanes = None
+    for t in terms:
+        if isinstance(t, np.ndarray):
+            lanes = t + lanes if lanes is not None else t
+        else:
+            constant += t
+    constant &= MASK
+    if lanes is None:
+        return constant
+    if constant:
+        lanes = lanes + constant
+    return lanes
+
+def sha256Rounds(state, w, end, start=0):
+    """Runs SHA-256 rounds start through end-1 over state, expanding the
+    message schedule w in place as needed.
+    """
+    a,b,c,d,e,f,g,h = state
+    for i in range(start, end):
+        if i >= len(w):
+            w.append(add(
+                rotr(w[i-2], 17) ^ rotr(w[i-2], 19) ^ shr(w[i-2], 10),
+                w[i-7],
+                rotr(w[i-15], 7) ^ rotr(w[i-15], 18) ^ shr(w[i-15], 3),
+                w[i-16]))
+
+        t1 = add(h, rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25),
+            g ^ (e & (f ^ g)), K[i], w[i])
+        t2 = add(rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22),
+            (a & b) | (c & (a | b)))
+        a,b,c,d,e,f,g,h = add(t1, t2),a,b,c,add(d, t1),e,f,g
+    return [a,b,c,d,e,f,g,h]
+
+class KernelData(object):
+    """This class is a container for all the data required to evaluate a
+    single NonceRange. Everything here is independent of the nonce, so it is
+    computed once and shared by every lane.
+    """
+
+    def __init__(self, nonceRange):
+        data = unpack('III', nonceRange.unit.data[64:76])
+
+        # The first three rounds of the second block don't touch the nonce.
+        self.state = list(unpack('IIIIIIII', nonceRange.unit.midstate))
+        self.state2 = list(unpack('IIIIIIII',
+            calculateMidstate(nonceRange.unit.data[64:80] +
+                '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
+                nonceRange.unit.midstate, 3)))
+
+        # W16 and W17 are also nonce-independent, so the schedule is
+        # extended that far up-front. W3 is filled in per pass.
+        self.w = list(data) + [None, 0x80000000] + [0]*10 + [0x00000280]
+        self.w.append(add(data[0], rotr(data[1], 7) ^ rotr(data[1], 18) ^
+            shr(data[1], 3)))
+        self.w.append(add(data[1], rotr(data[2], 7) ^ rotr(data[2], 18) ^
+            shr(data[2], 3), 0x01100000))
+
+        self.nr = nonceRange
+
+    def hash7(self, nonces):
+        """Given a uint32 array of nonces, return the last word of the
+        double SHA-256 of each, as a uint32 array.
+        """
+        w = list(self.w)
+        w[3] = nonces
+        state = sha256Rounds(self.state2, w, 64, 3)
+
+        w = [add(x, y) for x,y in zip(self.state, state)]
+        w += [0x80000000] + [0]*6 + [0x00000100]
+
+        # The last word of the final hash is H7 plus the E register from round
+        # 60; rounds 61-63 only shift it along, so they are skipped.
+        state = sha256Rounds([A0, B0, C0, D0, E0, F0, G0, H0], w, 61)
+        return add(state[4], H0)
+
+class Lane(object):
+    """One lane thread, along with the CoreInterface and QueueReader that
+    feed it. NumPy lets go of the GIL inside each ufunc, so the threads only
+    contend while dispatching the next operation.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.core = kernel.interface.addCore()
+        self.qr = QueueReader(self.core, lambda nr: KernelData(nr),
+                                lambda x,y: kernel.workSize(x, y))
+
+    def start(self):
+        self.qr.start()
+        reactor.callInThread(self.mineThread)
+
+    def stop(self):
+        self.qr.stop()
+
+    def mineThread(self):
+        lanes = np.arange(self.kernel.LANES, dtype=np.uint32)
+        for data in self.qr:
+            for base in xrange(data.nr.base, data.nr.base + data.nr.size,
+                               self.kernel.LANES):
+                # Don't finish off a range that a new block has made stale.
+                if self.qr.isStale():
+                    self.qr.skipTiming()
+                    break
+                
+                nonces = lanes + np.uint32(base)
+                found = nonces[data.hash7(nonces) == 0]
+                if len(found):
+                    self.kernel.interface.queueNonces(data.nr,
+                        found.tolist(), self.kernel.hardwareError)
+
+class MiningKernel(object):
+    """A Phoenix Miner-compatible kernel that evaluates nonces on the CPU,
+    hashing many nonces at once as NumPy uint32 lanes, in one thread per
+    core.
+    """
+
+    THREADS = KernelOption(
+        'THREADS', int, default=None,
+        help='How many lane threads to run (default: one per core)')
+    LANES = KernelOption(
+        'LANES', int, default=0x4000, advanced=True,
+        help='How many nonces to hash per NumPy pass')
+    EXECUTIONTIME = KernelOption(
+        'EXECUTIONTIME', float, default=1.0, advanced=True,
+        help='Target number of seconds to spend on each NonceRange')
+
+    # This gets updated automatically by SVN.
+    REVISION = '$Rev$'
+
+    def __init__(self, interface):
+        self.interface = interface
+
+        if self.THREADS is None:
+            self.THREADS = multiprocessing.cpu_count()
+        self.THREADS = max(1, self.THREADS)
+
+        # The LANES option must be a power of 2 of at least 256, so that
+        # ranges can always be split evenly.
+        self.LANES = max(256, self.LANES)
+        self.LANES = 1 << (self.LANES.bit_length() - 1)
+        self.interface.setWorkFactor(self.LANES)
+
+        # Every lane thread runs in the reactor's pool for as long as the
+        # kernel does, so the pool needs room for all of them.
+        reactor.suggestThreadPoolSize(self.THREADS + 10)
+
+        self.lanes = [Lane(self) for i in range(self.THREADS)]
+
+        self.applyMeta()
+
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'numpycpu r%s' % self.REVISION)
+        self.interface.setMeta('device', platform.processor() or 'CPU')
+        self.interface.setMeta('cores', self.THREADS)
+
+    def workSize(self, time, size):
+        """Scale the range size so that each range takes about EXECUTIONTIME
+        seconds to hash.
+        """
+        if not time:
+            return self.LANES * 16
+        size = int(size * self.EXECUTIONTIME / time)
+        return max(self.LANES, size - size % self.LANES)
+
+    def start(self):
+        """Phoenix wants the kernel to start."""
+        for lane in self.lanes:
+            lane.start()
+
+    def stop(self):
+        """Phoenix wants this kernel to stop. The kernel is not necessarily
+        reusable, so it's safe to clean up as well.
+        """
+        for lane in self.lanes:
+            lane.stop()
+
+    def hardwareError(self, nonces):
+        """Called when nonces that NumPy found turn out to be wrong."""
+        self.interface.error('Unusual behavior from NumPy. '
+            'Hardware problem?')
@@ -87,6 +87,21 @@ __constant uint H[8] = {
 //Partial SHA calculations (used for begining and end)
 #define partround(n) {Vals[(7 + 128 - n) % 8]=(Vals[(7 + 128 - n) % 8]+W[n]);  Vals[(3 + 128 - n) % 8]+=Vals[(7 + 128 - n) % 8]; Vals[(7 + 128 - n) % 8]+=t1;}
 
+// Found nonces are normally stored in a slot picked from the nonce's own bits,
+// with the last item flagged, so two nonces sharing a slot overwrite each
+// other. With ATOMIC_OUTPUT, the last item is instead a counter that nonces are
+// appended through, and the host reads exactly that many back.
+#ifdef ATOMIC_OUTPUT
+	#pragma OPENCL EXTENSION cl_khr_global_int32_base_atomics : enable
+	#define SETFOUND(nonce) { uint slot = atomic_inc(&output[OUTPUT_SIZE]); if (slot < OUTPUT_SIZE) output[slot] = (nonce); }
+#else
+	#define SETFOUND(nonce) { output[OUTPUT_SIZE] = output[(nonce >> 2) & OUTPUT_MASK] = (nonce); }
+#endif
+
+// Reverses the bytes of a word, so that the hash words (which are big endian)
+// can be compared with the target (which is little endian).
+#define bswap32(x) (rotate((x) & 0x00FF00FFU, 24U) | rotate((x) & 0xFF00FF00U, 8U))
+
 __kernel 
 
 void search(	const uint state0, const uint state1, const uint state2, const uint state3,
@@ -97,6 +112,7 @@ void search(	const uint state0, const uint state1, const uint state2, const uint
 						const uint W2,
 						const uint W16, const uint W17,
 						const uint PreVal4, const uint T1,
+						const uint target,
 						__global uint * output)
 {
 
@@ -351,24 +367,36 @@ void search(	const uint state0, const uint state1, const uint state2, const uint
 	Vals[7] += H[7];
 
 #ifdef VECTORS
-	if (Vals[7].x  == 0)
-	{
-		uint nonce = W[3].x;
-		//Faster to shift the nonce by 4 probably due to 32 bit addressing and does not add more collisions
-		output[OUTPUT_SIZE] = output[(nonce >> 2) & OUTPUT_MASK] = nonce;
-		
-	}
-	 if (Vals[7].y == 0)
-	{
-		uint nonce = W[3].y;
-		output[OUTPUT_SIZE] = output[(nonce >> 2) & OUTPUT_MASK] = nonce;
-	}
+	if (Vals[7].x == 0 || Vals[7].y == 0)
 #else
 	if (Vals[7] == 0)
+#endif
 	{
-		uint nonce = W[3];
-		output[OUTPUT_SIZE] = output[(nonce >> 2) & OUTPUT_MASK] = nonce;
-	}
+		// The last word of the hash is zero, so finish enough of round 61 to
+		// get the word before it, and only report the nonce if that word also
+		// meets the target. This is rare enough to cost nothing.
+		u e = Vals[7] - H[7];
+		R(64 + 61);
+		u H6 = Vals[6] + Vals[2] + (rot(e, 26)^rot(e, 21)^rot(e, 7)) + Ch(e, Vals[0], Vals[1]) + K[61] + W[64 + 61] + H[6];
+
+#ifdef VECTORS
+		if (Vals[7].x == 0 && bswap32(H6.x) <= target)
+		{
+			uint nonce = W[3].x;
+			//Faster to shift the nonce by 4 probably due to 32 bit addressing and does not add more collisions
+			SETFOUND(nonce);
+		}
+		if (Vals[7].y == 0 && bswap32(H6.y) <= target)
+		{
+			uint nonce = W[3].y;
+			SETFOUND(nonce);
+		}
+#else
+		if (bswap32(H6) <= target)
+		{
+			uint nonce = W[3];
+			SETFOUND(nonce);
+		}
 #endif
+	}
 }
-
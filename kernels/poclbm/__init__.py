@@ -24,56 +24,56 @@ import numpy as np
 import os
 import math
 
+from collections import deque
 from hashlib import md5
 from struct import pack, unpack
+from time import time
 from twisted.internet import reactor
 
 from minerutil.Midstate import calculateMidstate
-from QueueReader import QueueReader
+from QueueReader import QueueReader, resizeExecution
+from WorkQueue import WorkUnit, NonceRange
+from BinaryCache import BinaryCache
+from DeviceProfiles import DeviceProfiles
 from KernelInterface import *
 from BFIPatcher import *
 
-class KernelData(object):
-    """This class is a container for all the data required for a single kernel 
-    execution.
+class UnitData(object):
+    """The part of KernelData that depends only on the WorkUnit. It is
+    computed once per unit and shared by every NonceRange taken from it.
     """
     
-    def __init__(self, nonceRange, core, vectors, aggression):
+    def __init__(self, unit):
         # Prepare some raw data, converting it into the form that the OpenCL
         # function expects.
-        data = np.array(
-               unpack('IIII', nonceRange.unit.data[64:]), dtype=np.uint32)
-        
-        # Vectors do twice the work per execution, so calculate accordingly...
-        rateDivisor = 2 if vectors else 1
-        
-        # get the number of iterations from the aggression and size
-        self.iterations = int((nonceRange.size / (1 << aggression)))
-        self.iterations = max(1, self.iterations)
-        
-        #set the size to pass to the kernel based on iterations and vectors
-        self.size = (nonceRange.size / rateDivisor) / self.iterations
-        
-        #compute bases for each iteration
-        self.base = [None] * self.iterations
-        for i in range(self.iterations):
-            self.base[i] = pack('I',
-                (nonceRange.base/rateDivisor) + (i * self.size))
+        data = np.array(unpack('IIII', unit.data[64:]), dtype=np.uint32)
         
         #set up state and precalculated static data
         self.state = np.array(
-            unpack('IIIIIIII', nonceRange.unit.midstate), dtype=np.uint32)
+            unpack('IIIIIIII', unit.midstate), dtype=np.uint32)
         self.state2 = np.array(unpack('IIIIIIII',
-            calculateMidstate(nonceRange.unit.data[64:80] +
+            calculateMidstate(unit.data[64:80] +
                 '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
-                nonceRange.unit.midstate, 3)), dtype=np.uint32)
+                unit.midstate, 3)), dtype=np.uint32)
         self.state2 = np.array(
             list(self.state2)[3:] + list(self.state2)[:3], dtype=np.uint32)
-        self.nr = nonceRange
+        
+        # The kernel only reports hashes whose last word is zero, and then
+        # compares the word before it against this. If the target's last word
+        # isn't zero, every one of those hashes meets it.
+        target = unpack('<8I', unit.target)
+        self.target = np.uint32(target[6] if not target[7] else 0xFFFFFFFF)
         
         self.f = np.zeros(8, np.uint32)
         self.calculateF(data)
     
+    @classmethod
+    def forUnit(cls, unit):
+        """Return the UnitData for a WorkUnit, computing it the first time."""
+        if unit.precomputed is None:
+            unit.precomputed = cls(unit)
+        return unit.precomputed
+    
     def calculateF(self, data):
         rotr = lambda x,y: x>>y | x<<(32-y)
         self.f[0] = np.uint32(data[0] + (rotr(data[1], 7) ^ rotr(data[1], 18) ^
@@ -96,48 +96,379 @@ class KernelData(object):
             rotr(self.state2[5], 13) ^ rotr(self.state2[5], 22)) +
             ((self.state2[5] & self.state2[6]) | (self.state2[7] &
             (self.state2[5] | self.state2[6]))))
+
+class KernelData(object):
+    """This class is a container for all the data required for a single kernel 
+    execution.
+    """
+    
+    def __init__(self, nonceRange, core, vectors, launch):
+        # Vectors do twice the work per execution, so calculate accordingly...
+        rateDivisor = 2 if vectors else 1
         
+        # The range is run in executions of launch nonces each, with the last
+        # one taking whatever is left.
+        self.size = []
+        self.base = []
+        for offset in range(0, nonceRange.size, launch):
+            self.size.append(min(launch, nonceRange.size - offset) /
+                             rateDivisor)
+            self.base.append(pack('I',
+                (nonceRange.base + offset) / rateDivisor))
+        self.iterations = len(self.size)
+        
+        # Everything else only depends on the WorkUnit.
+        unitData = UnitData.forUnit(nonceRange.unit)
+        self.state = unitData.state
+        self.state2 = unitData.state2
+        self.target = unitData.target
+        self.f = unitData.f
+        self.nr = nonceRange
         
-class MiningKernel(object):
-    """A Phoenix Miner-compatible kernel that uses the poclbm OpenCL kernel."""
+        
+def getDefines(interface, device, vectors, atomic, bfiInt, outputSize):
+    """Work out the compiler definitions to build the kernel with for a device.
+    Returns them along with the ATOMIC and BFI_INT settings the device can
+    actually use.
+    """
+    # These definitions are required for the kernel to function.
+    defines = ' -DOUTPUT_SIZE=' + str(outputSize)
+    defines += ' -DOUTPUT_MASK=' + str(outputSize - 1)
     
-    PLATFORM = KernelOption(
-        'PLATFORM', int, default=None,
-        help='The ID of the OpenCL platform to use')
-    DEVICE = KernelOption(
-        'DEVICE', int, default=None,
-        help='The ID of the OpenCL device to use')
-    VECTORS = KernelOption(
-        'VECTORS', bool, default=False, advanced=True,
-        help='Enable vector support in the kernel?')
-    FASTLOOP = KernelOption(
-        'FASTLOOP', bool, default=True, advanced=True,
-        help='Run iterative mining thread?')
-    AGGRESSION = KernelOption(
-        'AGGRESSION', int, default=4, advanced=True,
-        help='Exponential factor indicating how much work to run '
-        'per OpenCL execution')
-    WORKSIZE = KernelOption(
-        'WORKSIZE', int, default=None, advanced=True,
-        help='The worksize to use when executing CL kernels.')
-    BFI_INT = KernelOption(
-        'BFI_INT', bool, default=False, advanced=True,
-        help='Use the BFI_INT instruction for AMD/ATI GPUs.')
-    OUTPUT_SIZE = 0x100
+    # If the user wants to mine with vectors, enable the appropriate code
+    # in the kernel source.
+    if vectors:
+        defines += ' -DVECTORS'
     
-    # This gets updated automatically by SVN.
-    REVISION = '$Rev$'
+    # Atomic result appending needs the 32-bit global atomics, which are
+    # an extension on OpenCL 1.0 devices and core from 1.1 on.
+    if atomic:
+        if (device.extensions.find('cl_khr_global_int32_base_atomics')
+            != -1 or not device.version.startswith('OpenCL 1.0')):
+            defines += ' -DATOMIC_OUTPUT'
+        else:
+            interface.log('Warning: %s does not support global atomics, '
+                'ATOMIC disabled.' % device.name.replace('\x00',''))
+            atomic = False
     
-    def __init__(self, interface):
-        platforms = cl.get_platforms()
-        
-        # Initialize object attributes and retrieve command-line options...)
-        self.device = None
-        self.kernel = None
-        self.interface = interface
-        self.core = self.interface.addCore()
-        self.defines = ''
-        self.loopExponent = 0
+    # Some AMD devices support a special "bitalign" instruction that makes
+    # bitwise rotation (required for SHA-256) much faster.
+    if (device.extensions.find('cl_amd_media_ops') != -1):
+        defines += ' -DBITALIGN'
+        #enable the expierimental BFI_INT instruction optimization
+        if bfiInt:
+            defines += ' -DBFI_INT'
+    else:
+        #since BFI_INT requires cl_amd_media_ops, disable it
+        bfiInt = False
+    
+    return defines, atomic, bfiInt
+
+def kernelSource():
+    """Read the OpenCL source code in the kernel's directory."""
+    kernelFileDir, pyfile = os.path.split(__file__)
+    kernelFilePath = os.path.join(kernelFileDir, 'kernel.cl')
+    kernelFile = open(kernelFilePath, 'r')
+    kernel = kernelFile.read()
+    kernelFile.close()
+    return kernel
+
+def buildProgram(interface, cache, context, device, defines, bfiInt):
+    """Load the compiled kernel for a device from the cache, or compile it
+    (applying the BFI_INT patch if asked to) and cache the result. Returns the
+    built program, and whether it came from the cache.
+    """
+    kernel = kernelSource()
+    
+    # For fast startup, we cache the compiled OpenCL code. The name of the
+    # cache is determined as the hash of a few important,
+    # compilation-specific pieces of information.
+    m = md5()
+    m.update(device.platform.name)
+    m.update(device.platform.version)
+    m.update(device.name)
+    m.update(defines)
+    m.update(kernel)
+    cacheKey = m.hexdigest()
+    
+    binaryData = cache.get(cacheKey)
+    if binaryData is not None:
+        program = cl.Program(
+            context, [device], [binaryData]).build(defines)
+        return program, True
+    
+    compileStart = time()
+    program = cl.Program(context, kernel).build(defines)
+     
+    #apply BFI_INT if enabled
+    if bfiInt:
+        #patch the binary output from the compiler
+        patcher = BFIPatcher(interface)
+        binaryData = patcher.patch(program.binaries[0])
+        
+        interface.debug("Applied BFI_INT patch")
+        
+        #reload the kernel with the patched binary
+        program = cl.Program(context, [device], [binaryData]).build(defines)
+    
+    #write the kernel binaries to the cache
+    cache.put(cacheKey, program.binaries[0], time() - compileStart)
+    return program, False
+
+def openCache(interface, cacheDir, cacheSize):
+    """Open the compiled kernel cache in cacheDir (by default, the kernel's
+    own directory), holding up to cacheSize MB.
+    """
+    if cacheDir is None:
+        cacheDir = os.path.split(__file__)[0]
+    return BinaryCache(interface, os.path.expanduser(cacheDir),
+        cacheSize * 1024 * 1024)
+
+def listDevices():
+    """Return (platform ID, device ID, device name) for every OpenCL device.
+    This is used by phoenix.py --precompile.
+    """
+    devices = []
+    for i,p in enumerate(cl.get_platforms()):
+        for j,d in enumerate(p.get_devices()):
+            devices.append((i, j, d.name.replace('\x00','')))
+    return devices
+
+def precompile(interface, cacheDir, cacheSize, platform, device, vectors,
+               atomic, bfiInt):
+    """Compile and cache one variant of the kernel for a device ahead of time,
+    so that mining with it later starts right away. This is what phoenix.py
+    --precompile runs in each of its worker processes.
+    
+    Returns None if the device can't run the variant, or otherwise whether
+    it was already cached.
+    """
+    if cacheSize is None:
+        cacheSize = MiningKernel.__dict__['CACHESIZE'].default
+    
+    device = cl.get_platforms()[platform].get_devices()[device]
+    defines, usedAtomic, usedBfiInt = getDefines(interface, device, vectors,
+        atomic, bfiInt, MiningKernel.OUTPUT_SIZE)
+    if (usedAtomic, usedBfiInt) != (atomic, bfiInt):
+        return None
+    
+    context = cl.Context([device], None, None)
+    cache = openCache(interface, cacheDir, cacheSize)
+    program, cached = buildProgram(interface, cache, context, device, defines,
+        bfiInt)
+    return cached
+
+def profileKey(interface, device):
+    """The key a device's tuned profile is stored under. Like the name of a
+    cached binary, it includes a hash of the kernel source and the build
+    options (those tuning starts from), so that changing either means tuning
+    again.
+    """
+    defines = getDefines(interface, device, False, False, False,
+        MiningKernel.OUTPUT_SIZE)[0]
+    m = md5()
+    m.update(defines)
+    m.update(kernelSource())
+    return '%s|%s|poclbm %s' % (device.name.replace('\x00',''),
+        device.driver_version, m.hexdigest())
+
+def openProfiles(profilePath):
+    """Open the tuned device profiles in profilePath (by default,
+    profiles.json in the kernel's own directory).
+    """
+    if profilePath is None:
+        profilePath = os.path.join(os.path.split(__file__)[0],
+            'profiles.json')
+    return DeviceProfiles(os.path.expanduser(profilePath))
+
+def tune(interface, cacheDir, cacheSize, profilePath, platform, device,
+         maxLatency, sampleTime=0.5):
+    """Sweep VECTORS, BFI_INT, WORKSIZE and AGGRESSION on a device, hashing a
+    synthetic NonceRange, and store the fastest combination as the device's
+    profile. This is what phoenix.py --tune runs.
+    
+    VECTORS, BFI_INT and WORKSIZE are picked first at the default AGGRESSION.
+    AGGRESSION is then raised for as long as a single execution stays within
+    maxLatency seconds. The lowest AGGRESSION within 2% of the best
+    sustained hashrate wins, since anything higher only adds latency.
+    
+    Returns the profile, or None if no combination could be run at all.
+    """
+    if cacheSize is None:
+        cacheSize = MiningKernel.__dict__['CACHESIZE'].default
+    
+    device = cl.get_platforms()[platform].get_devices()[device]
+    context = cl.Context([device], None, None)
+    queue = cl.CommandQueue(context)
+    cache = openCache(interface, cacheDir, cacheSize)
+    
+    output = np.zeros(MiningKernel.OUTPUT_SIZE+1, np.uint32)
+    output_buf = cl.Buffer(context,
+        cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR, hostbuf=output)
+    
+    # Random data will practically never produce a share, so the output
+    # buffer never needs to be read back.
+    unit = WorkUnit()
+    unit.data = os.urandom(76) + '\x00'*4
+    unit.target = '\xff'*28 + '\x00'*4
+    unit.midstate = calculateMidstate(unit.data[:64])
+    
+    programs = {}
+    def getProgram(vectors, bfiInt):
+        if (vectors, bfiInt) not in programs:
+            defines, atomic, usedBfiInt = getDefines(interface, device,
+                vectors, False, bfiInt, MiningKernel.OUTPUT_SIZE)
+            if usedBfiInt != bfiInt:
+                programs[vectors, bfiInt] = None
+            else:
+                try:
+                    programs[vectors, bfiInt] = buildProgram(interface, cache,
+                        context, device, defines, bfiInt)[0]
+                except (cl.Error, PatchError), e:
+                    interface.debug(str(e))
+                    interface.log('VECTORS=%d BFI_INT=%d does not build' %
+                        (vectors, bfiInt))
+                    programs[vectors, bfiInt] = None
+        return programs[vectors, bfiInt]
+    
+    def measure(vectors, bfiInt, worksize, aggression):
+        """Returns (rate in khash/s, seconds per execution)."""
+        program = getProgram(vectors, bfiInt)
+        if program is None:
+            return None
+        maxSize = program.search.get_work_group_info(
+            cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+        if worksize > maxSize:
+            return None
+        
+        nr = NonceRange(unit, 0, 1 << (aggression + 16))
+        data = KernelData(nr, None, vectors, nr.size)
+        if data.size[0] % worksize:
+            return None
+        def launch():
+            program.search(queue, (data.size[0], ), (worksize, ),
+                data.state[0], data.state[1], data.state[2], data.state[3],
+                data.state[4], data.state[5], data.state[6], data.state[7],
+                data.state2[1], data.state2[2], data.state2[3],
+                data.state2[5], data.state2[6], data.state2[7],
+                data.base[0],
+                data.f[0], data.f[1], data.f[2], data.f[3],
+                data.f[4], data.f[5], data.f[6], data.f[7],
+                data.target,
+                output_buf)
+        
+        # Warm up, then time one execution on its own for the latency, and
+        # as many back to back as fit in sampleTime for the hashrate. Some
+        # drivers only refuse a combination once it's launched.
+        try:
+            launch()
+            queue.finish()
+            start = time()
+            launch()
+            queue.finish()
+            latency = time() - start
+            
+            count = max(2, min(1000, int(sampleTime / max(latency, 1e-6))))
+            start = time()
+            for i in range(count):
+                launch()
+            queue.finish()
+            rate = count * nr.size / (time() - start) / 1000
+        except cl.Error, e:
+            interface.debug(str(e))
+            interface.log('VECTORS=%d BFI_INT=%d WORKSIZE=%d AGGRESSION=%d '
+                'does not run' % (vectors, bfiInt, worksize, aggression))
+            return None
+        
+        interface.log('VECTORS=%d BFI_INT=%d WORKSIZE=%d AGGRESSION=%d: '
+            '%d khash/sec, %.1fms per execution' % (vectors, bfiInt,
+            worksize, aggression, rate, latency*1000))
+        return rate, latency
+    
+    maxSize = device.max_work_group_size
+    worksizes = [1 << i for i in range(5, 11) if (1 << i) <= maxSize]
+    worksizes = worksizes or [maxSize]
+    
+    # First the settings that change what runs on each nonce...
+    best = None
+    bfiInts = [False, True]
+    if device.extensions.find('cl_amd_media_ops') == -1:
+        bfiInts = [False]
+    aggression = 4
+    for vectors in (False, True):
+        for bfiInt in bfiInts:
+            for worksize in worksizes:
+                result = measure(vectors, bfiInt, worksize, aggression)
+                if result is not None and (best is None or
+                                           result[0] > best[0]):
+                    best = (result[0], result[1], vectors, bfiInt, worksize,
+                        aggression)
+    if best is None:
+        return None
+    
+    # ...then how much to run per execution.
+    rate, latency, vectors, bfiInt, worksize, aggression = best
+    results = {aggression: (rate, latency)}
+    for aggression in range(17):
+        if aggression not in results:
+            results[aggression] = measure(vectors, bfiInt, worksize,
+                aggression)
+        if results[aggression] is None:
+            del results[aggression]
+            break
+        if results[aggression][1] > maxLatency:
+            break
+    
+    usable = [a for a in results if results[a][1] <= maxLatency] or \
+        [min(results)]
+    bestRate = max(results[a][0] for a in usable)
+    aggression = min(a for a in usable if results[a][0] >= bestRate * 0.98)
+    rate, latency = results[aggression]
+    
+    profile = {'VECTORS': vectors, 'BFI_INT': bfiInt, 'WORKSIZE': worksize,
+        'AGGRESSION': aggression, 'rate': int(rate), 'latency': latency}
+    openProfiles(profilePath).put(profileKey(interface, device), profile)
+    return profile
+
+class Device(object):
+    """Everything needed to mine on one OpenCL device: its context, command
+    queue, compiled kernel and buffers, and the CoreInterface and QueueReader
+    that feed its mining thread from the shared WorkQueue.
+    """
+    
+    # With FASTLOOP, NonceRanges are made of as many executions as take about
+    # this many seconds, as long as ranges took before executions were sized
+    # by time.
+    RANGE_TIME = 0.25
+    
+    def __init__(self, kernel, device):
+        self.kernel = kernel
+        self.interface = kernel.interface
+        self.device = device
+        self.program = None
+        self.defines = None
+        
+        # Tunable options that weren't given come from the device's tuned
+        # profile if it has one, or otherwise the usual defaults.
+        profile = kernel.profiles.get(profileKey(self.interface, device)) or {}
+        def tunable(name, default):
+            value = getattr(kernel, name)
+            if value is None:
+                value = profile.get(name, default)
+            return value
+        if profile:
+            self.interface.log('Using tuned profile for %s' % self.getName())
+        
+        # These may be adjusted to suit the device, so each one gets a copy.
+        self.VECTORS = tunable('VECTORS', False)
+        self.FASTLOOP = kernel.FASTLOOP
+        self.EXECUTIONTIME = kernel.EXECUTIONTIME
+        self.AGGRESSION = tunable('AGGRESSION', 4)
+        self.WORKSIZE = tunable('WORKSIZE', None)
+        self.BFI_INT = tunable('BFI_INT', False)
+        self.ATOMIC = kernel.ATOMIC
+        self.PIPELINE = kernel.PIPELINE
+        self.OUTPUT_SIZE = kernel.OUTPUT_SIZE
         
         # Set the initial number of nonces to run per execution
         # 2^(16 + aggression)
@@ -146,48 +477,16 @@ class MiningKernel(object):
         self.AGGRESSION = max(16, self.AGGRESSION)
         self.size = 1 << self.AGGRESSION
         
+        # How many nonces each execution actually runs. This is only ever
+        # changed by workSize, and only if FASTLOOP is enabled.
+        self.launch = self.size
+        
+        self.core = self.interface.addCore()
+        
         # We need a QueueReader to efficiently provide our dedicated thread
         # with work.
         self.qr = QueueReader(self.core, lambda nr: self.preprocess(nr), 
-                                lambda x,y: self.size * 1 << self.loopExponent)
-        
-        # The platform selection must be valid to mine.
-        if self.PLATFORM >= len(platforms) or \
-            (self.PLATFORM is None and len(platforms) > 1):
-            self.interface.log(
-                'Wrong platform or more than one OpenCL platform found, '
-                'use PLATFORM=ID to select one of the following\n',
-                False, True)
-            
-            for i,p in enumerate(platforms):
-                self.interface.log('    [%d]\t%s' % (i, p.name), False, False)
-            
-            # Since the platform is invalid, we can't mine.
-            self.interface.fatal()
-            return
-        elif self.PLATFORM is None:
-            self.PLATFORM = 0
-            
-        devices = platforms[self.PLATFORM].get_devices()
-        
-        # The device selection must be valid to mine.
-        if self.DEVICE >= len(devices) or \
-            (self.DEVICE is None and len(devices) > 1):
-            self.interface.log(
-                'No device specified or device not found, '
-                'use DEVICE=ID to specify one of the following\n',
-                False, True)
-            
-            for i,d in enumerate(devices):
-                self.interface.log('    [%d]\t%s' % (i, d.name), False, False)
-        
-            # Since the device selection is invalid, we can't mine.
-            self.interface.fatal()
-            return
-        elif self.DEVICE is None:
-            self.DEVICE = 0
-        
-        self.device = devices[self.DEVICE]
+                                lambda x,y: self.workSize(x, y))
         
         # We need the appropriate kernel for this device...
         try:
@@ -197,99 +496,40 @@ class MiningKernel(object):
             return
         
         # Initialize a command queue to send commands to the device, and a
-        # buffer to collect results in...
+        # buffer to collect results in for every execution kept in flight...
         self.commandQueue = cl.CommandQueue(self.context)
-        self.output = np.zeros(self.OUTPUT_SIZE+1, np.uint32)
-        self.output_buf = cl.Buffer(
-            self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR,
-            hostbuf=self.output)
+        self.PIPELINE = max(1, self.PIPELINE)
+        self.output = []
+        self.output_buf = []
+        self.flag = []
+        for i in range(self.PIPELINE):
+            output = np.zeros(self.OUTPUT_SIZE+1, np.uint32)
+            self.output.append(output)
+            self.output_buf.append(cl.Buffer(self.context,
+                cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR,
+                hostbuf=output))
+            self.flag.append(np.zeros(1, np.uint32))
+        
+        # Output buffers are cleared by copying this over them on the device.
+        self.zeros_buf = cl.Buffer(self.context,
+            cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=np.zeros(self.OUTPUT_SIZE+1, np.uint32))
     
-        self.applyMeta()
-        
-    def applyMeta(self):
-        """Apply any kernel-specific metadata."""
-        self.interface.setMeta('kernel', 'poclbm r%s' % self.REVISION)
-        self.interface.setMeta('device', self.device.name.replace('\x00',''))
-        self.interface.setMeta('cores', self.device.max_compute_units)
+    def getName(self):
+        return self.device.name.replace('\x00','')
     
     def loadKernel(self, device):
         """Load the kernel and initialize the device."""
         self.context = cl.Context([device], None, None)
         
-        # These definitions are required for the kernel to function.
-        self.defines += (' -DOUTPUT_SIZE=' + str(self.OUTPUT_SIZE))
-        self.defines += (' -DOUTPUT_MASK=' + str(self.OUTPUT_SIZE - 1))
-        
-        # If the user wants to mine with vectors, enable the appropriate code
-        # in the kernel source.
-        if self.VECTORS:
-            self.defines += ' -DVECTORS'
-        
-        # Some AMD devices support a special "bitalign" instruction that makes
-        # bitwise rotation (required for SHA-256) much faster.
-        if (device.extensions.find('cl_amd_media_ops') != -1):
-            self.defines += ' -DBITALIGN'
-            #enable the expierimental BFI_INT instruction optimization
-            if self.BFI_INT:
-                self.defines += ' -DBFI_INT'
-        else:
-            #since BFI_INT requires cl_amd_media_ops, disable it
-            if self.BFI_INT:
-                self.BFI_INT = False
-        
-        # Locate and read the OpenCL source code in the kernel's directory.
-        kernelFileDir, pyfile = os.path.split(__file__)
-        kernelFilePath = os.path.join(kernelFileDir, 'kernel.cl')
-        kernelFile = open(kernelFilePath, 'r')
-        kernel = kernelFile.read()
-        kernelFile.close()
-        
-        # For fast startup, we cache the compiled OpenCL code. The name of the
-        # cache is determined as the hash of a few important,
-        # compilation-specific pieces of information.
-        m = md5()
-        m.update(device.platform.name)
-        m.update(device.platform.version)
-        m.update(device.name)
-        m.update(self.defines)
-        m.update(kernel)
-        cacheName = '%s.elf' % m.hexdigest()
-        
-        fileName = os.path.join(kernelFileDir, cacheName)
+        self.defines, self.ATOMIC, self.BFI_INT = getDefines(self.interface,
+            device, self.VECTORS, self.ATOMIC, self.BFI_INT, self.OUTPUT_SIZE)
         
         # Finally, the actual work of loading the kernel...
         try:
-            binary = open(fileName, 'rb')
-        except IOError: 
-            binary = None
-        
-        try:
-            if binary is None:
-                self.kernel = cl.Program(
-                    self.context, kernel).build(self.defines)
-                 
-                #apply BFI_INT if enabled
-                if self.BFI_INT:
-                    #patch the binary output from the compiler
-                    patcher = BFIPatcher(self.interface)
-                    binaryData = patcher.patch(self.kernel.binaries[0])
-                    
-                    self.interface.debug("Applied BFI_INT patch")
-                    
-                    #reload the kernel with the patched binary
-                    self.kernel = cl.Program(
-                        self.context, [device],
-                        [binaryData]).build(self.defines)
-                
-                #write the kernel binaries to file
-                binaryW = open(fileName, 'wb')
-                binaryW.write(self.kernel.binaries[0])
-                binaryW.close()
-            else:
-                binaryData = binary.read()
-                self.kernel = cl.Program(
-                    self.context, [device], [binaryData]).build(self.defines)
-                    
+            self.program, cached = buildProgram(self.interface,
+                self.kernel.cache, self.context, device, self.defines,
+                self.BFI_INT)
         except cl.LogicError:
             self.interface.fatal("Failed to compile OpenCL kernel!")
             return
@@ -297,14 +537,12 @@ class MiningKernel(object):
             self.interface.fatal('Failed to apply BFI_INT patch to kernel! '
                 'Is BFI_INT supported on this hardware?')
             return
-        finally:
-            if binary: binary.close()
        
         cl.unload_compiler()
         
         # If the user didn't specify their own worksize, use the maxium
         # supported by the device.
-        maxSize = self.kernel.search.get_work_group_info(
+        maxSize = self.program.search.get_work_group_info(
                   cl.kernel_work_group_info.WORK_GROUP_SIZE, self.device)
         
         if self.WORKSIZE is None:
@@ -315,71 +553,113 @@ class MiningKernel(object):
                                     + str(maxSize) + ', using default.')
             if self.WORKSIZE < 1:
                 self.interface.log('Warning: Invalid worksize, using default.')
-            
+        
             self.WORKSIZE = min(self.WORKSIZE, maxSize)
             self.WORKSIZE = max(self.WORKSIZE, 1)
             #if the worksize is not a power of 2, round down to the nearest one
             if (self.WORKSIZE & (self.WORKSIZE - 1)) != 0:   
-                self.WORKSIZE = 1 << int(math.floor(math.log(X)/math.log(2)))
-            
-        self.interface.setWorkFactor(self.WORKSIZE)
+                self.WORKSIZE = 1 << int(math.floor(
+                    math.log(self.WORKSIZE)/math.log(2)))
         
     def start(self):
-        """Phoenix wants the kernel to start."""
+        """Start mining on this device."""
         
         self.qr.start()
         reactor.callInThread(self.mineThread)
     
     def stop(self):
-        """Phoenix wants this kernel to stop. The kernel is not necessarily
-        reusable, so it's safe to clean up as well.
-        """
+        """Stop mining on this device."""
         self.qr.stop()
     
-    def updateIterations(self):
-        # Set up the number of internal iterations to run if FASTLOOP enabled
-        rate = self.core.getRate()
-         
-        if not (rate <= 0):
-            #calculate the number of iterations to run
-            EXP = max(0, (math.log(rate)/math.log(2)) - (self.AGGRESSION - 8))
-            #prevent switching between loop exponent sizes constantly
-            if EXP > self.loopExponent + 0.54:
-                EXP = round(EXP)
-            elif EXP < self.loopExponent - 0.65:
-                EXP = round(EXP)
-            else:
-                EXP = self.loopExponent
-                
-            self.loopExponent = int(max(0, EXP))
+    def workSize(self, time, size):
+        """Resize executions so that each takes about EXECUTIONTIME seconds,
+        and return how many nonces the next NonceRange should have.
+        Executions are kept to multiples of the worksize (twice that with
+        vectors), as OpenCL needs, and of 256, as the WorkQueue needs.
+        
+        A NonceRange is then as many executions as fit in RANGE_TIME, so a
+        short EXECUTIONTIME doesn't mean more ranges to fetch. A new block is
+        noticed between executions, so that's still all the time a stale
+        block keeps the device busy.
+        """
+        if not self.FASTLOOP:
+            return self.size
+        if not time:
+            return self.launch
         
-    def preprocess(self, nr):
-        if self.FASTLOOP:
-            self.updateIterations()
+        step = max(256, self.WORKSIZE * (2 if self.VECTORS else 1))
+        self.launch = resizeExecution(self.launch, step, self.EXECUTIONTIME,
+                                      time, size)
         
-        kd = KernelData(nr, self.core, self.VECTORS, self.AGGRESSION)
+        launches = max(1, int(self.RANGE_TIME / self.EXECUTIONTIME))
+        return min(self.launch * launches, 1 << 32)
+    
+    def preprocess(self, nr):
+        kd = KernelData(nr, self.core, self.VECTORS, self.launch)
         return kd
     
     def postprocess(self, output, nr):
         """Scans over a single buffer produced as a result of running the
-        OpenCL kernel on the device. This is done outside of the mining thread
-        for efficiency reasons.
+        OpenCL kernel on the device. This runs on the mining thread; the
+        nonces found are verified on the KernelInterface's own threads.
         """
-        # Iterate over only the first OUTPUT_SIZE items. Exclude the last item
-        # which is a duplicate of the most recently-found nonce.
-        for i in xrange(self.OUTPUT_SIZE):
-            if output[i]:   
-                if not self.interface.foundNonce(nr, int(output[i])):
-                    hash = self.interface.calculateHash(nr, int(output[i]))
-                    if not hash.endswith('\x00\x00\x00\x00'):
-                        self.interface.error('Unusual behavior from OpenCL. '
-                            'Hardware problem?')
+        if self.ATOMIC:
+            # The last item counts how many nonces were appended, which may be
+            # more than actually fit.
+            count = int(output[self.OUTPUT_SIZE])
+            if count > self.OUTPUT_SIZE:
+                reactor.callFromThread(self.interface.error,
+                    'Output buffer overflowed, %d results lost. Try lowering '
+                    'AGGRESSION.' % (count - self.OUTPUT_SIZE))
+            nonces = output[:min(count, self.OUTPUT_SIZE)].tolist()
+        else:
+            # Iterate over only the first OUTPUT_SIZE items. Exclude the last
+            # item which is a duplicate of the most recently-found nonce.
+            nonces = [x for x in output[:self.OUTPUT_SIZE] if x]
+        
+        self.interface.queueNonces(nr, nonces, self.hardwareError)
+    
+    def hardwareError(self, nonces):
+        """Called when nonces this device found turn out to be wrong."""
+        self.interface.error('Unusual behavior from OpenCL on %s. '
+            'Hardware problem?' % self.getName())
+    
+    def checkOutput(self, event, slot, nr):
+        """Wait for a queued execution's found flag to be read back and, only
+        if it is set, fetch the whole output buffer.
+        """
+        event.wait()
+        
+        # The OpenCL code will flag the last item in the output buffer when
+        # it finds a valid nonce. If that's the case, read the rest of the
+        # buffer, pick the nonces out of it and clean the buffer for the next
+        # pass.
+        if self.flag[slot][0]:
+            output = self.output[slot]
+            cl.enqueue_read_buffer(self.commandQueue, self.output_buf[slot],
+                output)
+            self.postprocess(output, nr)
+            
+            # The command queue is in-order, so this is done before the
+            # buffer is next used by the kernel.
+            cl.enqueue_copy_buffer(self.commandQueue, self.zeros_buf,
+                self.output_buf[slot])
     
     def mineThread(self):
+        # Executions that are queued on the device but haven't been checked
+        # yet, oldest first. Up to PIPELINE of them are kept in flight, so the
+        # device always has the next one ready while results are checked.
+        pending = deque()
+        slot = 0
         for data in self.qr:
             for i in range(data.iterations):
-                self.kernel.search(
-                    self.commandQueue, (data.size, ), (self.WORKSIZE, ),
+                # Don't finish off a range that a new block has made stale.
+                if self.qr.isStale():
+                    self.qr.skipTiming()
+                    break
+                
+                self.program.search(
+                    self.commandQueue, (data.size[i], ), (self.WORKSIZE, ),
                     data.state[0], data.state[1], data.state[2], data.state[3],
                     data.state[4], data.state[5], data.state[6], data.state[7],
                     data.state2[1], data.state2[2], data.state2[3],
@@ -387,19 +667,175 @@ class MiningKernel(object):
                     data.base[i],
                     data.f[0], data.f[1], data.f[2], data.f[3],
                     data.f[4], data.f[5], data.f[6], data.f[7],
-                    self.output_buf)
-                cl.enqueue_read_buffer(
-                    self.commandQueue, self.output_buf, self.output)
-                self.commandQueue.finish()
+                    data.target,
+                    self.output_buf[slot])
+                event = cl.enqueue_read_buffer(self.commandQueue,
+                    self.output_buf[slot], self.flag[slot],
+                    device_offset=self.OUTPUT_SIZE*4, is_blocking=False)
+                self.commandQueue.flush()
                 
-                # The OpenCL code will flag the last item in the output buffer
-                # when it finds a valid nonce. If that's the case, send it to
-                # the main thread for postprocessing and clean the buffer
-                # for the next pass.
-                if self.output[self.OUTPUT_SIZE]:
-                    reactor.callFromThread(self.postprocess, 
-                    self.output.copy(), data.nr)
-                    self.output.fill(0)
-                    cl.enqueue_write_buffer(
-                        self.commandQueue, self.output_buf, self.output)
- 
+                pending.append((event, slot, data.nr))
+                slot = (slot + 1) % self.PIPELINE
+                if len(pending) == self.PIPELINE:
+                    self.checkOutput(*pending.popleft())
+        
+        # Don't lose anything that was still in flight at shutdown.
+        while pending:
+            self.checkOutput(*pending.popleft())
+
+class MiningKernel(object):
+    """A Phoenix Miner-compatible kernel that uses the poclbm OpenCL kernel."""
+    
+    PLATFORM = KernelOption(
+        'PLATFORM', int, default=None,
+        help='The ID of the OpenCL platform to use')
+    DEVICE = KernelOption(
+        'DEVICE', str, default=None,
+        help='The ID of the OpenCL device to use, a comma-separated list of '
+        'IDs, or "all"')
+    VECTORS = KernelOption(
+        'VECTORS', bool, default=None, advanced=True,
+        help='Enable vector support in the kernel? (default: tuned, or off)')
+    FASTLOOP = KernelOption(
+        'FASTLOOP', bool, default=True, advanced=True,
+        help='Run iterative mining thread?')
+    EXECUTIONTIME = KernelOption(
+        'EXECUTIONTIME', float, default=0.03, advanced=True,
+        help='Target number of seconds for each OpenCL execution when '
+        'FASTLOOP is enabled')
+    AGGRESSION = KernelOption(
+        'AGGRESSION', int, default=None, advanced=True,
+        help='Exponential factor indicating how much work to run '
+        'per OpenCL execution, or to start with if FASTLOOP is enabled '
+        '(default: tuned, or 4)')
+    WORKSIZE = KernelOption(
+        'WORKSIZE', int, default=None, advanced=True,
+        help='The worksize to use when executing CL kernels. (default: '
+        'tuned, or the maximum)')
+    BFI_INT = KernelOption(
+        'BFI_INT', bool, default=None, advanced=True,
+        help='Use the BFI_INT instruction for AMD/ATI GPUs. (default: tuned, '
+        'or off)')
+    ATOMIC = KernelOption(
+        'ATOMIC', bool, default=False, advanced=True,
+        help='Append results through an atomic counter, so that no nonces '
+        'are lost to collisions in the output buffer.')
+    PIPELINE = KernelOption(
+        'PIPELINE', int, default=1, advanced=True,
+        help='How many executions to keep queued on the device. 2 or more '
+        'overlaps reading back results with the next execution.')
+    CACHEDIR = KernelOption(
+        'CACHEDIR', str, default=None, advanced=True,
+        help='Where to cache compiled kernels (default: the kernel\'s own '
+        'directory)')
+    CACHESIZE = KernelOption(
+        'CACHESIZE', int, default=64, advanced=True,
+        help='How many MB of compiled kernels to cache before the least '
+        'recently used are removed (0 disables the cache)')
+    PROFILES = KernelOption(
+        'PROFILES', str, default=None, advanced=True,
+        help='The file tuned device profiles are kept in (default: '
+        'profiles.json in the kernel\'s own directory)')
+    OUTPUT_SIZE = 0x100
+    
+    # This gets updated automatically by SVN.
+    REVISION = '$Rev$'
+    
+    def __init__(self, interface):
+        platforms = cl.get_platforms()
+        
+        # Initialize object attributes and retrieve command-line options...)
+        self.devices = []
+        self.interface = interface
+        
+        # The platform selection must be valid to mine.
+        if self.PLATFORM >= len(platforms) or \
+            (self.PLATFORM is None and len(platforms) > 1):
+            self.interface.log(
+                'Wrong platform or more than one OpenCL platform found, '
+                'use PLATFORM=ID to select one of the following\n',
+                False, True)
+            
+            for i,p in enumerate(platforms):
+                self.interface.log('    [%d]\t%s' % (i, p.name), False, False)
+            
+            # Since the platform is invalid, we can't mine.
+            self.interface.fatal()
+            return
+        elif self.PLATFORM is None:
+            self.PLATFORM = 0
+            
+        devices = platforms[self.PLATFORM].get_devices()
+        
+        # The device selection must be valid to mine.
+        selection = self.selectDevices(self.DEVICE, len(devices))
+        if selection is None:
+            self.interface.log(
+                'No device specified or device not found, '
+                'use DEVICE=ID, DEVICE=ID,ID,... or DEVICE=all to specify '
+                'from the following\n',
+                False, True)
+            
+            for i,d in enumerate(devices):
+                self.interface.log('    [%d]\t%s' % (i, d.name), False, False)
+        
+            # Since the device selection is invalid, we can't mine.
+            self.interface.fatal()
+            return
+        
+        # Compiled kernels are cached for fast startup. The cache is shared by
+        # all of the devices.
+        self.cache = openCache(self.interface, self.CACHEDIR, self.CACHESIZE)
+        self.profiles = openProfiles(self.PROFILES)
+        
+        # Every device blocks one reactor pool thread in its mining thread, so
+        # the pool needs room for all of them.
+        reactor.suggestThreadPoolSize(len(selection) + 10)
+        
+        self.devices = [Device(self, devices[i]) for i in selection]
+        
+        # Ranges are shared out by the one WorkQueue, so they have to divide
+        # evenly for every device. Worksizes are all powers of 2.
+        self.interface.setWorkFactor(
+            max(device.WORKSIZE for device in self.devices))
+    
+        self.applyMeta()
+    
+    def selectDevices(self, option, count):
+        """Turn the DEVICE option into a list of device IDs, or return None if
+        it doesn't select any of the count devices available.
+        """
+        if option is None:
+            return [0] if count == 1 else None
+        if option.strip().lower() == 'all':
+            return range(count) or None
+        
+        try:
+            selection = [int(x) for x in option.split(',')]
+        except ValueError:
+            return None
+        
+        for i in selection:
+            if not 0 <= i < count or selection.count(i) > 1:
+                return None
+        return selection
+        
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'poclbm r%s' % self.REVISION)
+        self.interface.setMeta('device',
+            ', '.join(device.getName() for device in self.devices))
+        self.interface.setMeta('cores',
+            sum(device.device.max_compute_units for device in self.devices))
+    
+    def start(self):
+        """Phoenix wants the kernel to start."""
+        for device in self.devices:
+            device.start()
+    
+    def stop(self):
+        """Phoenix wants this kernel to stop. The kernel is not necessarily
+        reusable, so it's safe to clean up as well.
+        """
+        for device in self.devices:
+            device.stop()
@@ -56,12 +56,28 @@ __constant uint K[64] = {
 // problems. (this is used 4 times, and likely optimized out by the compiler.)
 #define Ma2(x, y, z) ((y & z) | (x & (y | z)))
 
+// Found nonces are normally stored in a slot picked from the nonce's own bits,
+// with the last item flagged, so two nonces sharing a slot overwrite each
+// other. With ATOMIC_OUTPUT, the last item is instead a counter that nonces are
+// appended through, and the host reads exactly that many back.
+#ifdef ATOMIC_OUTPUT
+	#pragma OPENCL EXTENSION cl_khr_global_int32_base_atomics : enable
+	#define SETFOUND(nonce) { uint slot = atomic_inc(&output[OUTPUT_SIZE]); if (slot < OUTPUT_SIZE) output[slot] = (nonce); }
+#else
+	#define SETFOUND(nonce) { output[OUTPUT_SIZE] = output[(nonce) & OUTPUT_MASK] = (nonce); }
+#endif
+
+// Reverses the bytes of a word, so that the hash words (which are big endian)
+// can be compared with the target (which is little endian).
+#define bswap32(x) (rotate((x) & 0x00FF00FFU, 24U) | rotate((x) & 0xFF00FF00U, 8U))
+
 __kernel void search(	const uint state0, const uint state1, const uint state2, const uint state3,
 						const uint state4, const uint state5, const uint state6, const uint state7,
 						const uint B1, const uint C1, const uint D1,
 						const uint F1, const uint G1, const uint H1,
 						const uint base,
 						const uint fW0, const uint fW1, const uint fW2, const uint fW3, const uint fW15, const uint fW01r, const uint fcty_e, const uint fcty_e2,
+						const uint target,
 						__global uint * output)
 {
 	u W0, W1, W2, W3, W4, W5, W6, W7, W8, W9, W10, W11, W12, W13, W14, W15;
@@ -297,18 +313,36 @@ __kernel void search(	const uint state0, const uint state1, const uint state2, c
 	H+=0x5be0cd19U;
 
 #ifdef VECTORS
-	if (H.x == 0)
-	{
-		output[OUTPUT_SIZE] = output[nonce.x & OUTPUT_MASK] = nonce.x;
-	}
-	else if (H.y == 0)
-	{
-		output[OUTPUT_SIZE] = output[nonce.y & OUTPUT_MASK] = nonce.y;
-	}
+	if (H.x == 0 || H.y == 0)
 #else
 	if (H == 0)
+#endif
 	{
-		output[OUTPUT_SIZE] = output[nonce & OUTPUT_MASK] = nonce;
-	}
+		// The last word of the hash is zero, so finish enough of round 61 to
+		// get the word before it, and only report the nonce if that word also
+		// meets the target. This is rare enough to cost nothing.
+		// Rounds 57-60 skipped the parts that would never be used, so first
+		// recover the A register of round 57 from what is left.
+		u E60 = H - 0x5be0cd19U;
+		u A56 = E60 - D - (rotr(A, 6) ^ rotr(A, 11) ^ rotr(A, 25)) - Ch(A, B, C) - K[60] - W12;
+		u A57 = G + (rotr(A56, 2) ^ rotr(A56, 13) ^ rotr(A56, 22)) + Ma(B - F, A56, A - E);
+		W13 = W13 + (rotr(W14, 7) ^ rotr(W14, 18) ^ (W14 >> 3U)) + W6 + (rotr(W11, 17) ^ rotr(W11, 19) ^ (W11 >> 10U));
+		u H6 = A57 + C + (rotr(E60, 6) ^ rotr(E60, 11) ^ rotr(E60, 25)) + Ch(E60, A, B) + K[61] + W13 + 0x1f83d9abU;
+
+#ifdef VECTORS
+		if (H.x == 0 && bswap32(H6.x) <= target)
+		{
+			SETFOUND(nonce.x);
+		}
+		if (H.y == 0 && bswap32(H6.y) <= target)
+		{
+			SETFOUND(nonce.y);
+		}
+#else
+		if (bswap32(H6) <= target)
+		{
+			SETFOUND(nonce);
+		}
 #endif
-}
\ No newline at end of file
+	}
+}
@@ -19,10 +19,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+# The version bits that may ever be rolled, as per BIP 320.
+VERSION_MASK = 0x1fffe000
+
 class AssignedWork(object):
     data = None
     mask = None
     target = None
+    rollNTime = 0 # How many seconds ntime may be rolled forward.
+    versionMask = 0 # Which version bits may be rolled.
+    source = None # What results for this work should be sent to.
     
 class ClientBase(object):
     callbacksActive = True
@@ -40,4 +46,15 @@ class ClientBase(object):
         
         func = getattr(self.handler, 'on' + callback.capitalize(), None)
         if callable(func):
-            func(*args)
\ No newline at end of file
+            func(*args)
+    
+    def reportRange(self, nr):
+        """Called with every NonceRange handed out from this client's work.
+        Only clients that split hashing between servers need to know.
+        """
+    
+    def reportStale(self, nr):
+        """Called when results from a NonceRange of this client's work are
+        dropped because its block had passed. Only clients that keep track of
+        several servers need to know.
+        """
\ No newline at end of file
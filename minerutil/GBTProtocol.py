@@ -0,0 +1,476 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from hashlib import sha256
+from struct import pack, unpack
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from ClientBase import AssignedWork
+from RPCProtocol import RPCClient, RPCPoller
+from StratumProtocol import doubleHash, swapWords
+
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+def varInt(n):
+    if n < 0xfd:
+        return chr(n)
+    elif n <= 0xffff:
+        return '\xfd' + pack('<H', n)
+    elif n <= 0xffffffff:
+        return '\xfe' + pack('<I', n)
+    return '\xff' + pack('<Q', n)
+
+def readVarInt(data, i):
+    """Read the varInt at data[i], returning it along with the index just
+    past it.
+    """
+    if i >= len(data):
+        raise ValueError('Transaction ends early')
+    n = ord(data[i])
+    if n < 0xfd:
+        return n, i + 1
+    format, size = {0xfd: ('<H', 2), 0xfe: ('<I', 4), 0xff: ('<Q', 8)}[n]
+    if i + 1 + size > len(data):
+        raise ValueError('Transaction ends early')
+    return unpack(format, data[i+1:i+1+size])[0], i + 1 + size
+
+def pushData(data):
+    """A script push of up to 75 bytes."""
+    return chr(len(data)) + data
+
+def pushNumber(n):
+    """A script push of a non-negative number, as BIP 34 wants the height.
+    Like any script number, 0 to 16 are pushed with OP_0 and OP_1 to OP_16.
+    """
+    if n == 0:
+        return '\x00'
+    if n <= 16:
+        return chr(0x50 + n)
+    data = ''
+    while n:
+        data += chr(n & 0xff)
+        n >>= 8
+    if data and ord(data[-1]) & 0x80:
+        data += '\x00'
+    return pushData(data)
+
+def _bech32Polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            if (top >> i) & 1:
+                chk ^= generator[i]
+    return chk
+
+def payoutScript(payout):
+    """Turn what was given as the payout option into an output script. This
+    may be a Base58 (P2PKH or P2SH) address, a Bech32 segwit address, or a
+    script in hex.
+    """
+    # Bech32 and Bech32m segwit addresses...
+    hrp, separator, data = payout.lower().rpartition('1')
+    if hrp in ('bc', 'tb', 'bcrt'):
+        if all(c in BECH32 for c in data) and len(data) >= 8:
+            values = [BECH32.index(c) for c in data]
+            check = _bech32Polymod([ord(c) >> 5 for c in hrp] + [0] +
+                [ord(c) & 31 for c in hrp] + values)
+            version = values[0]
+            if check == (1 if version == 0 else 0x2bc830a3):
+                acc, bits, program = 0, 0, ''
+                for v in values[1:-6]:
+                    acc = acc << 5 | v
+                    bits += 5
+                    if bits >= 8:
+                        bits -= 8
+                        program += chr(acc >> bits & 0xff)
+                return (chr(0x50 + version if version else 0) +
+                        pushData(program))
+    
+    # Base58Check addresses...
+    if all(c in BASE58 for c in payout):
+        n = 0
+        for c in payout:
+            n = n * 58 + BASE58.index(c)
+        raw = ('%050x' % n).decode('hex')
+        if len(raw) == 25 and doubleHash(raw[:21])[:4] == raw[21:]:
+            if ord(raw[0]) in (0x05, 0xc4):
+                return '\xa9' + pushData(raw[1:21]) + '\x87'
+            return '\x76\xa9' + pushData(raw[1:21]) + '\x88\xac'
+    
+    # ...and failing those, a script in hex.
+    try:
+        return payout.decode('hex')
+    except (TypeError, ValueError):
+        raise ValueError('Unrecognized payout address: ' + payout)
+
+class BlockTemplate(object):
+    """A template from getblocktemplate, which any number of WorkUnits can be
+    made from by varying the extranonce in the coinbase.
+    
+    The coinbase is normally built here, paying the payout script. A pool
+    (BIP 23) may give its own coinbase instead, which the extranonce is then
+    appended to the script of.
+    """
+    
+    # What goes into the coinbase after the height and extranonce.
+    TAG = '/phoenix/'
+    
+    # The most a coinbase script may hold.
+    MAX_SCRIPT = 100
+    
+    # Room to leave in the script for the extranonce push.
+    EXTRANONCE_SIZE = 9
+    
+    def __init__(self, template, payout):
+        self.version = int(template['version'])
+        self.previous = template['previousblockhash'].decode('hex')
+        self.bits = int(template['bits'], 16)
+        self.time = int(template['curtime'])
+        self.height = int(template['height'])
+        self.target = template['target'].decode('hex')[::-1]
+        self.longpollid = template.get('longpollid')
+        self.workid = template.get('workid')
+        self.mutable = template.get('mutable', ['time', 'transactions',
+                                                'prevblock'])
+        self.commitment = template.get('default_witness_commitment')
+        if self.commitment:
+            self.commitment = self.commitment.decode('hex')
+        
+        if 'coinbasetxn' in template:
+            if 'coinbase/append' not in self.mutable:
+                raise ValueError('The pool\'s coinbase may not be changed')
+            self.useCoinbase(template['coinbasetxn']['data'].decode('hex'))
+        else:
+            if not payout:
+                raise ValueError('No payout script for the coinbase')
+            self.makeOutputs(int(template['coinbasevalue']), payout)
+        if len(self.scriptPrefix + self.scriptSuffix) + \
+           self.EXTRANONCE_SIZE > self.MAX_SCRIPT:
+            raise ValueError('No room in the coinbase for an extranonce')
+        
+        # The transactions never change, so neither does the branch of the
+        # merkle tree that the coinbase hashes up through.
+        self.transactions = [tx['data'].decode('hex')
+                             for tx in template.get('transactions', [])]
+        level = [None] + [(tx.get('txid') or tx['hash']).decode('hex')[::-1]
+                          for tx in template.get('transactions', [])]
+        self.branches = []
+        while len(level) > 1:
+            self.branches.append(level[1])
+            if len(level) % 2:
+                level.append(level[-1])
+            level = [None] + [doubleHash(level[i] + level[i+1])
+                              for i in range(2, len(level), 2)]
+    
+    def makeOutputs(self, value, payout):
+        """Lay out our own coinbase, paying the whole value to the payout
+        script.
+        """
+        outputs = [pack('<Q', value) + varInt(len(payout)) + payout]
+        if self.commitment:
+            outputs.append(pack('<Q', 0) + varInt(len(self.commitment)) +
+                           self.commitment)
+        
+        self.txVersion = pack('<I', 1)
+        self.prevout = '\x00'*32 + '\xff'*4
+        self.scriptPrefix = pushNumber(self.height)
+        self.scriptSuffix = pushData(self.TAG)
+        self.sequence = '\xff'*4
+        self.outputs = varInt(len(outputs)) + ''.join(outputs)
+        self.witness = ''
+        if self.commitment:
+            self.witness = varInt(1) + varInt(32) + '\x00'*32
+        self.lockTime = pack('<I', 0)
+    
+    def useCoinbase(self, tx):
+        """Take apart the coinbase a pool gave, so that the extranonce can be
+        appended to its script.
+        """
+        self.txVersion = tx[:4]
+        segwit = tx[4:6] == '\x00\x01'
+        i = 6 if segwit else 4
+        
+        inputs, i = readVarInt(tx, i)
+        if inputs != 1:
+            raise ValueError('A coinbase has exactly one input')
+        self.prevout = tx[i:i+36]
+        length, i = readVarInt(tx, i + 36)
+        self.scriptPrefix = tx[i:i+length]
+        self.scriptSuffix = ''
+        i += length
+        self.sequence = tx[i:i+4]
+        i += 4
+        
+        start = i
+        outputs, i = readVarInt(tx, i)
+        for n in range(outputs):
+            length, i = readVarInt(tx, i + 8)
+            i += length
+        self.outputs = tx[start:i]
+        if i + 4 > len(tx):
+            raise ValueError('Transaction ends early')
+        
+        self.witness = tx[i:-4] if segwit else ''
+        if not self.witness and self.commitment:
+            self.witness = varInt(1) + varInt(32) + '\x00'*32
+        self.lockTime = tx[-4:]
+    
+    def makeCoinbase(self, extranonce, witness=False):
+        """Build the coinbase transaction for the given extranonce, with the
+        witness if witness is set and the coinbase has one.
+        """
+        witness = witness and self.witness
+        script = self.scriptPrefix + pushData(extranonce) + self.scriptSuffix
+        
+        tx = self.txVersion
+        if witness:
+            tx += '\x00\x01'
+        tx += varInt(1) + self.prevout + varInt(len(script)) + script
+        tx += self.sequence + self.outputs
+        if witness:
+            tx += self.witness
+        return tx + self.lockTime
+    
+    def makeData(self, extranonce):
+        """Build the 80 bytes of getwork data for the given extranonce, with
+        a zero nonce.
+        """
+        root = doubleHash(self.makeCoinbase(extranonce))
+        for branch in self.branches:
+            root = doubleHash(root + branch)
+        header = (pack('<I', self.version) + self.previous[::-1] + root +
+                  pack('<III', self.time, self.bits, 0))
+        return swapWords(header)
+    
+    def makeBlock(self, data, extranonce):
+        """Serialize the whole block for a solved header, given as getwork
+        data.
+        """
+        return (swapWords(data) + varInt(len(self.transactions) + 1) +
+                self.makeCoinbase(extranonce, True) +
+                ''.join(self.transactions))
+
+class TemplateLongPoller(object):
+    """Waits on getblocktemplate's longpoll for the template to change,
+    reporting every new template to the root.
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        self.poller = RPCPoller(root) # For its own persistent connection.
+        self.longpollid = None
+        self.polling = False
+    
+    def start(self, longpollid):
+        """Begin waiting on the given longpoll ID, if we aren't already..."""
+        self.longpollid = longpollid
+        if self.polling:
+            return
+        self.polling = True
+        
+        self._request()
+    
+    def _request(self):
+        if self.polling:
+            d = self.poller.call('getblocktemplate',
+                [dict(self.root.TEMPLATE_REQUEST, longpollid=self.longpollid)])
+            d.addBoth(self._requestComplete)
+    
+    def stop(self):
+        """Stop polling. This TemplateLongPoller probably shouldn't be
+        reused.
+        """
+        self.polling = False
+    
+    def _requestComplete(self, x):
+        if not self.polling:
+            return
+        
+        if isinstance(x, failure.Failure):
+            # Don't hammer the server if it's having trouble.
+            reactor.callLater(self.root.LONGPOLL_RETRY, self._request)
+            return
+        
+        # The new template brings the next longpoll ID with it.
+        (headers, result) = x
+        self.root.handleWork(result, True, headers)
+        self._request()
+
+class GBTClient(RPCClient):
+    """Gets work with getblocktemplate rather than getwork. A template is
+    only fetched when it changes; all the work is made from it locally, with
+    each WorkUnit getting its own extranonce, and solved blocks are sent back
+    with submitblock.
+    
+    The server may be bitcoind, which needs a payout address for the
+    coinbase, or a pool (BIP 23) that hands out its own coinbase and takes
+    shares through submitblock at its own target.
+    """
+    
+    TEMPLATE_REQUEST = {'capabilities': ['coinbasevalue', 'coinbasetxn',
+                                         'coinbase/append', 'workid',
+                                         'longpoll'],
+                        'rules': ['segwit']}
+    LONGPOLL_RETRY = 15
+    
+    # How long the ntime of work may be rolled forward.
+    ROLLNTIME = 60
+    
+    def __init__(self, handler, url):
+        RPCClient.__init__(self, handler, url)
+        self.version = 'GBTClient/0.8'
+        self.poller.method = 'getblocktemplate'
+        self.poller.params = [self.TEMPLATE_REQUEST]
+        self.templatePoller = TemplateLongPoller(self)
+        
+        # A pool that gives its own coinbase doesn't need one.
+        try:
+            self.payout = payoutScript(self.params['payout'])
+        except (KeyError, ValueError):
+            self.payout = None
+        
+        self.template = None
+        self.units = {}
+        self.extranonce = 0
+        self.workPending = False
+    
+    def disconnect(self):
+        RPCClient.disconnect(self)
+        self.templatePoller.stop()
+    
+    def requestWork(self):
+        """Application needs work right now. It's made from the template on
+        the next pass of the reactor, since the WorkQueue asks for more while
+        storing work.
+        """
+        if self.template is None:
+            self.poller.ask()
+        elif not self.workPending:
+            self.workPending = True
+            reactor.callLater(0, self._sendWork)
+    
+    def handleWork(self, work, pushed=False, headers=None):
+        if work is None:
+            return
+        
+        if not self.saidConnected:
+            self.saidConnected = True
+            self.runCallback('connect')
+            self.useAskrate('askrate')
+        
+        if not self.payout and 'coinbasetxn' not in work:
+            self.runCallback('msg', 'Unrecognized payout address: %s' %
+                self.params.get('payout'))
+            return
+        
+        try:
+            template = BlockTemplate(work, self.payout)
+        except (KeyError, ValueError, TypeError):
+            self.runCallback('msg', 'Server gave an unusable block template')
+            return
+        
+        newBlock = (self.template is None or
+                    template.previous != self.template.previous)
+        if newBlock:
+            self.units = {}
+            if self.block != template.height:
+                self.block = template.height
+                self.runCallback('block', template.height)
+        self.template = template
+        
+        if template.longpollid is not None:
+            if not self.templatePoller.polling:
+                self.runCallback('longpoll', True)
+            self.templatePoller.start(template.longpollid)
+        
+        # New transactions can wait for the next unit, but a new block means
+        # everything out there is stale.
+        if newBlock:
+            self._sendWork(pushed)
+    
+    def handleHeaders(self, headers):
+        """getblocktemplate has its own longpoll, so getwork's headers don't
+        apply."""
+    
+    def _sendWork(self, pushed=False):
+        """Make a WorkUnit from the template with the next extranonce and
+        pass it on.
+        """
+        self.workPending = False
+        template = self.template
+        if template is None:
+            return
+        
+        extranonce = pack('<Q', self.extranonce)
+        self.extranonce += 1
+        
+        aw = AssignedWork()
+        aw.data = template.makeData(extranonce)
+        aw.target = template.target
+        aw.mask = 32
+        if 'time' in template.mutable or 'time/increment' in template.mutable:
+            aw.rollNTime = self.ROLLNTIME
+        
+        # The merkle root is enough to tell which template and extranonce a
+        # result came from.
+        self.units[aw.data[36:68]] = (template, extranonce)
+        
+        if pushed:
+            self.runCallback('push', aw)
+        self.runCallback('work', aw)
+    
+    def sendResult(self, result):
+        """Sends a solved block to the server, returning a Deferred that fires
+        with a bool to indicate whether or not it was accepted.
+        """
+        unit = self.units.get(result[36:68])
+        if unit is None:
+            return defer.succeed(False)
+        template, extranonce = unit
+        
+        # A pool (BIP 23) that gave a workid wants it back with the block.
+        params = [template.makeBlock(result, extranonce).encode('hex')]
+        if template.workid is not None:
+            params.append({'workid': template.workid})
+        d = self.poller.call('submitblock', params)
+        
+        def errback(*ignored):
+            return False # ANY error while turning in work is a Bad Thing(TM).
+        
+        # submitblock gives nothing back when it accepts a block, and the
+        # reason otherwise.
+        def callback(x):
+            try:
+                (headers, rejected) = x
+            except TypeError:
+                return False
+            if rejected:
+                self.runCallback('msg', 'Block rejected: %s' % rejected)
+            return not rejected
+        
+        d.addErrback(errback)
+        d.addCallback(callback)
+        return d
@@ -21,6 +21,11 @@
 
 import struct
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Some SHA-256 constants...
 K = [
      0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
@@ -105,4 +110,70 @@ def calculateMidstate(data, state=None, rounds=None):
         g = addu32(g, G0)
         h = addu32(h, H0)
     
-    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
\ No newline at end of file
+    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
+
+def calculateMidstates(data, states=None, rounds=None):
+    """The batch form of calculateMidstate. Given a sequence of 64-byte
+    blocks, and optionally a sequence of 32-byte states to start each one
+    from, return a list with the midstate of every block. The blocks are
+    compressed together as NumPy uint32 lanes, which is far quicker than
+    calling calculateMidstate on each of them. Without NumPy, it does just
+    that instead.
+    """
+    data = list(data)
+    if states is not None:
+        states = list(states)
+        if len(states) != len(data):
+            raise ValueError('there must be one state for every block')
+    
+    if np is None:
+        if states is None:
+            states = [None] * len(data)
+        return [calculateMidstate(d, s, rounds) for d,s in zip(data, states)]
+    
+    if not data:
+        return []
+    for d in data:
+        if len(d) != 64:
+            raise ValueError('data must be 64 bytes long')
+    
+    # Each word of the blocks becomes one array, holding that word for every
+    # block.
+    n = len(data)
+    w = list(np.frombuffer(''.join(data), dtype='<u4').reshape(n, 16).T
+        .astype(np.uint32))
+    
+    initial = [np.uint32(x) for x in (A0, B0, C0, D0, E0, F0, G0, H0)]
+    if states is not None:
+        for s in states:
+            if len(s) != 32:
+                raise ValueError('state must be 32 bytes long')
+        a,b,c,d,e,f,g,h = np.frombuffer(''.join(states),
+            dtype='<u4').reshape(n, 8).T.astype(np.uint32)
+    else:
+        a,b,c,d,e,f,g,h = [np.repeat(x, n) for x in initial]
+    
+    rotr = lambda x,p: (x >> np.uint32(p)) | (x << np.uint32(32-p))
+    shr = lambda x,p: x >> np.uint32(p)
+    
+    consts = K if rounds is None else K[:rounds]
+    for i,k in enumerate(consts):
+        if i >= 16:
+            s0 = rotr(w[i-15],7) ^ rotr(w[i-15],18) ^ shr(w[i-15],3)
+            s1 = rotr(w[i-2],17) ^ rotr(w[i-2],19) ^ shr(w[i-2],10)
+            w.append(w[i-16] + s0 + w[i-7] + s1)
+        
+        s0 = rotr(a,2) ^ rotr(a,13) ^ rotr(a,22)
+        s1 = rotr(e,6) ^ rotr(e,11) ^ rotr(e,25)
+        ma = (a&b) ^ (a&c) ^ (b&c)
+        ch = (e&f) ^ ((~e)&g)
+        
+        t1 = h + w[i] + np.uint32(k) + ch + s1
+        a,b,c,d,e,f,g,h = t1 + ma + s0,a,b,c,d + t1,e,f,g
+    
+    result = [a,b,c,d,e,f,g,h]
+    if rounds is None:
+        result = [x + y for x,y in zip(result, initial)]
+    
+    packed = np.array(result, dtype='<u4').T.tostring()
+    return [packed[i*32:(i+1)*32] for i in range(n)]
@@ -0,0 +1,486 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import urlparse
+from time import time
+from twisted.internet import reactor, task
+
+from ClientBase import ClientBase
+
+class Pool(object):
+    """One of the servers a PoolManager can mine for, along with what's been
+    seen of its health. The Pool is the handler for its own client, and
+    passes the client's callbacks on to the manager.
+    """
+    
+    # How much each new sample counts towards the running averages.
+    SMOOTHING = 0.1
+    
+    def __init__(self, manager, index, url, opener):
+        self.manager = manager
+        self.index = index
+        parsed = urlparse.urlparse(url)
+        self.name = parsed.hostname or url
+        if parsed.port:
+            self.name += ':%d' % parsed.port
+        
+        self.weight = 0
+        self.connected = False
+        self.working = False # Whether it has given work since connecting.
+        self.failed = False # Whether it has failed since connecting.
+        self.longpoll = False
+        self.block = None
+        self.askedAt = None # When the pending request for work was made.
+        self.lastWork = None # The newest AssignedWork, for a quick switch.
+        self.lastWorkTime = None
+        self.healthySince = None
+        self.faulted = False # Whether anything has gone wrong with it yet.
+        
+        # Nonces handed out from this pool's work: a count that's halved now
+        # and then for scheduling, and one since the last rate report.
+        self.hashes = 0
+        self.recentHashes = 0
+        
+        # Running averages: seconds to answer a request for work, and the
+        # fractions of requests that failed, of results that got rejected and
+        # of results found too late to send.
+        self.latency = None
+        self.errorRate = 0.0
+        self.rejectRate = 0.0
+        self.staleRate = 0.0
+        
+        self.client = opener(url, self)
+    
+    def _sample(self, average, value):
+        if average is None:
+            return value
+        return average + (value - average)*self.SMOOTHING
+    
+    def connect(self):
+        self.client.connect()
+    
+    def requestWork(self):
+        # Logging in can take a while, so requests are only timed once the
+        # pool has shown that it's handing out work.
+        if self.askedAt is None and self.working:
+            self.askedAt = time()
+        self.client.requestWork()
+    
+    def reportStale(self):
+        self.staleRate = self._sample(self.staleRate, 1.0)
+    
+    def sendResult(self, result):
+        self.staleRate = self._sample(self.staleRate, 0.0)
+        d = self.client.sendResult(result)
+        def callback(accepted):
+            self.rejectRate = self._sample(self.rejectRate,
+                                           0.0 if accepted else 1.0)
+            return accepted
+        d.addCallback(callback)
+        return d
+    
+    def stallTime(self):
+        """How long a request for work may go unanswered before the pool
+        counts as stalled: a few times its usual latency, but never less
+        than STALL_TIME.
+        """
+        return max(self.manager.STALL_TIME,
+                   (self.latency or 0.0)*self.manager.STALL_FACTOR)
+    
+    def problem(self, now):
+        """Say what, if anything, is wrong with this pool right now. A pool
+        that is still connecting is given the benefit of the doubt until it
+        fails.
+        """
+        if self.askedAt is not None and now - self.askedAt > self.stallTime():
+            return 'no work after %.1fs' % (now - self.askedAt)
+        if not self.connected and self.failed:
+            return 'not connected'
+        if self.errorRate > self.manager.MAX_ERROR_RATE:
+            return '%d%% of requests failing' % (self.errorRate*100)
+        if self.rejectRate > self.manager.MAX_REJECT_RATE:
+            return '%d%% of results rejected' % (self.rejectRate*100)
+        if self.staleRate > self.manager.MAX_STALE_RATE:
+            return '%d%% of results stale' % (self.staleRate*100)
+        return None
+    
+    def isHealthy(self, now):
+        return self.connected and self.problem(now) is None
+    
+    def isReady(self, now):
+        """Whether the pool may be switched to without a problem with the
+        current one. After a fault, it has to stay healthy for a while first.
+        """
+        return self.healthySince is not None and (not self.faulted or
+            now - self.healthySince >= self.manager.FAILBACK_TIME)
+    
+    def score(self, now):
+        """Lower is better. Seconds of latency, plus a second for every 10%
+        of errors, rejects or stales, plus however long the pool is overdue.
+        """
+        score = (self.latency or 0.0) + (self.errorRate + self.rejectRate +
+                                         self.staleRate)*10
+        if self.askedAt is not None:
+            score += max(0.0, now - self.askedAt - self.stallTime())
+        if not self.connected:
+            score += 100
+        return score
+    
+    # Callbacks from the client...
+    def onConnect(self):
+        self.connected = True
+        self.failed = False
+        self.manager._poolCallback(self, 'connect')
+    def onDisconnect(self):
+        self._failed()
+        self.manager._poolCallback(self, 'disconnect')
+    def onFailure(self):
+        self._failed()
+        self.manager._poolCallback(self, 'failure')
+    def onBlock(self, block):
+        self.block = block
+        self.manager._poolCallback(self, 'block', block)
+    def onMsg(self, msg):
+        self.manager._poolCallback(self, 'msg', msg)
+    def onWork(self, work):
+        work.source = self
+        now = time()
+        if self.askedAt is not None:
+            self.latency = self._sample(self.latency, now - self.askedAt)
+            self.askedAt = None
+        self.errorRate = self._sample(self.errorRate, 0.0)
+        self.working = True
+        self.lastWork = work
+        self.lastWorkTime = now
+        self.manager._poolCallback(self, 'work', work)
+    def onLongpoll(self, lp):
+        self.longpoll = lp
+        self.manager._poolCallback(self, 'longpoll', lp)
+    def onPush(self, work):
+        work.source = self
+        self.manager._poolCallback(self, 'push', work)
+    
+    def _failed(self):
+        self.connected = False
+        self.working = False
+        self.failed = True
+        self.askedAt = None
+        self.lastWork = None
+        self.errorRate = self._sample(self.errorRate, 1.0)
+
+class PoolManager(ClientBase):
+    """Stands in for a single client while mining for several pools.
+    
+    By default the pools are failed over between in order: only the active
+    pool's work and callbacks reach the handler, but every other pool stays
+    connected and is asked for work now and then, so that it is known to be
+    healthy and has fresh work ready when the active pool degrades. The
+    manager fails back to a more preferred pool once it has been healthy for
+    a while.
+    
+    Given weights, the manager instead splits hashing between every healthy
+    pool with a nonzero weight, asking whichever is furthest behind its share
+    for the next work. Pools without weight are only failed over to when
+    none of the others are healthy.
+    """
+    
+    # How often the pools' health is checked, in seconds.
+    CHECK_INTERVAL = 0.25
+    
+    # A request for work may go unanswered for STALL_FACTOR times the pool's
+    # average latency, or STALL_TIME seconds if that's longer, before the
+    # pool counts as stalled.
+    STALL_TIME = 5
+    STALL_FACTOR = 4
+    
+    # How often standby pools are asked for work, in seconds.
+    STANDBY_INTERVAL = 15
+    
+    # How old a standby pool's work may be and still be mined on right away
+    # after switching to it.
+    WORK_FRESHNESS = 30
+    
+    # How long a pool that has had a fault has to stay healthy before it is
+    # switched back to.
+    FAILBACK_TIME = 60
+    
+    # Past these fractions of failed requests or rejected results, a pool
+    # counts as degraded.
+    MAX_ERROR_RATE = 0.5
+    MAX_REJECT_RATE = 0.25
+    MAX_STALE_RATE = 0.25
+    
+    # How often the split of hashing between pools is reported, in seconds.
+    RATE_INTERVAL = 30
+    
+    # While splitting by weight, work is cut down to about UNIT_TIME seconds
+    # of hashing, so that the split can follow the weights closely. Until
+    # the hashrate is known, units have 2**START_MASK nonces, and they never
+    # have fewer than 2**MIN_MASK.
+    UNIT_TIME = 5
+    START_MASK = 24
+    MIN_MASK = 16
+    
+    def __init__(self, handler, urls, opener, weights=None):
+        self.handler = handler
+        self.pools = [Pool(self, i, url, opener) for i, url in enumerate(urls)]
+        self.balanced = bool(weights)
+        for pool, weight in zip(self.pools, weights or []):
+            pool.weight = weight
+        
+        # The pools work is currently coming from; the first is the active
+        # one, which is the only one when failing over.
+        self.rotation = ([pool for pool in self.pools if pool.weight > 0] or
+                         self.pools[:1])
+        self.active = self.rotation[0]
+        self.block = None
+        
+        # Nonces handed out per second, across every pool.
+        self.rate = None
+        self.dispatched = 0
+        self.lastRateReport = time()
+        
+        self.checkCall = task.LoopingCall(self.check)
+        self.standbyCall = task.LoopingCall(self.pollStandby)
+        self.rateCall = task.LoopingCall(self.reportRates)
+    
+    def connect(self):
+        """Connect to every pool at once."""
+        for pool in self.pools:
+            pool.connect()
+        self.checkCall.start(self.CHECK_INTERVAL, now=False)
+        self.standbyCall.start(self.STANDBY_INTERVAL, now=False)
+        if self.balanced:
+            self.rateCall.start(self.RATE_INTERVAL, now=False)
+    
+    def disconnect(self):
+        self._deactivateCallbacks()
+        for call in (self.checkCall, self.standbyCall, self.rateCall):
+            if call.running:
+                call.stop()
+        for pool in self.pools:
+            pool.client.disconnect()
+    
+    def setMeta(self, var, value):
+        for pool in self.pools:
+            pool.client.setMeta(var, value)
+    
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        for pool in self.pools:
+            pool.client.setVersion(shortname, longname, version, author)
+    
+    def requestWork(self):
+        self.schedule().requestWork()
+    
+    def sendResult(self, result):
+        """Results normally go straight to the Pool their work came from;
+        this is only for ones that can't be traced back.
+        """
+        return self.active.sendResult(result)
+    
+    def reportRange(self, nr):
+        """Count a NonceRange against the pool its WorkUnit came from."""
+        pool = nr.unit.source
+        if isinstance(pool, Pool):
+            pool.hashes += nr.size
+            pool.recentHashes += nr.size
+        self.dispatched += nr.size
+    
+    def reportStale(self, nr):
+        """Count a result that was found too late against its pool."""
+        pool = nr.unit.source
+        if isinstance(pool, Pool):
+            pool.reportStale()
+    
+    def schedule(self):
+        """Pick the pool in rotation that is furthest behind its share of
+        the hashing.
+        """
+        if len(self.rotation) == 1:
+            return self.rotation[0]
+        weight = float(sum(pool.weight for pool in self.rotation))
+        hashes = float(sum(pool.hashes for pool in self.rotation)) or 1.0
+        return max(self.rotation,
+            key=lambda pool: pool.weight/weight - pool.hashes/hashes)
+    
+    def unitMask(self):
+        """How many bits of nonce a WorkUnit keeps while splitting by weight.
+        """
+        if not self.rate:
+            return self.START_MASK
+        nonces = int(self.rate*self.UNIT_TIME)
+        return max(self.MIN_MASK, min(32, nonces.bit_length()))
+    
+    def pollStandby(self):
+        """Keep the standby pools' connections warm and their work fresh."""
+        for pool in self.pools:
+            if pool not in self.rotation:
+                pool.requestWork()
+    
+    def reportRates(self):
+        """Tell the handler how fast each pool's work has been handed out,
+        in khash/sec, and let the scheduler start to forget the past.
+        """
+        now = time()
+        elapsed = max(now - self.lastRateReport, 1e-3)
+        self.lastRateReport = now
+        
+        rates = []
+        for pool in self.pools:
+            rates.append((pool.name, pool.recentHashes/elapsed/1000.0))
+            pool.recentHashes = 0
+            pool.hashes //= 2
+        self.runCallback('rates', rates)
+    
+    def check(self):
+        """Follow the hashrate, and change which pools work comes from if
+        any have degraded or recovered.
+        """
+        now = time()
+        rate = self.dispatched/self.CHECK_INTERVAL
+        self.dispatched = 0
+        if self.rate:
+            self.rate += (rate - self.rate)*Pool.SMOOTHING
+        elif rate:
+            self.rate = rate
+        
+        for pool in self.pools:
+            if pool.problem(now) is not None:
+                pool.faulted = True
+            if not pool.isHealthy(now):
+                pool.healthySince = None
+            elif pool.healthySince is None:
+                pool.healthySince = now
+        
+        if self.balanced:
+            change = self.balance(now)
+        else:
+            change = self.failover(now)
+        if change is not None:
+            self.setRotation(*change)
+    
+    def fallback(self, now):
+        """The pool to fail over to: the most preferred healthy one, or
+        failing that, whichever connected pool scores best.
+        """
+        healthy = [pool for pool in self.pools if pool.healthySince is not None]
+        if healthy:
+            return healthy[0]
+        candidates = [pool for pool in self.pools if pool.connected]
+        if candidates:
+            best = min(candidates, key=lambda pool: pool.score(now))
+            if best.score(now) < self.active.score(now):
+                return best
+        return None
+    
+    def failover(self, now):
+        """Decide whether to switch to another pool. Returns the new rotation
+        and the reason for it, or None to stay put.
+        """
+        for pool in self.pools[:self.active.index]:
+            if pool.isReady(now):
+                return [pool], 'preferred pool is available'
+        
+        problem = self.active.problem(now)
+        if problem is None:
+            return None
+        pool = self.fallback(now)
+        if pool is None or pool is self.active:
+            return None
+        return [pool], problem
+    
+    def balance(self, now):
+        """Decide which weighted pools to split hashing between. Pools stay
+        in rotation until they develop a problem, and join it once they are
+        ready. Returns the new rotation and the reason for it, or None to
+        stay put.
+        """
+        rotation = [pool for pool in self.pools if pool.weight > 0 and
+            (pool.problem(now) is None if pool in self.rotation else
+             pool.isReady(now))]
+        
+        # With none of the weighted pools usable, fail over as usual.
+        if not rotation:
+            rotation = [pool for pool in self.rotation
+                        if pool.problem(now) is None]
+        if not rotation:
+            pool = self.fallback(now)
+            rotation = [pool] if pool is not None else self.rotation
+        if rotation == self.rotation:
+            return None
+        
+        problems = ['%s: %s' % (pool.name, pool.problem(now))
+                    for pool in self.rotation if pool not in rotation and
+                    pool.problem(now) is not None]
+        return rotation, '; '.join(problems) or 'more pools available'
+    
+    def setRotation(self, rotation, reason):
+        """Start taking work from the pools in rotation, and drop any work
+        from the pools that left it. When the active pool changes, its
+        latest work goes straight to the handler if it's recent enough, so
+        that mining carries on without waiting on a new request.
+        """
+        dropped = [pool for pool in self.rotation if pool not in rotation]
+        self.rotation = rotation
+        for pool in dropped:
+            self.runCallback('drop', pool)
+        self.runCallback('switch', rotation, reason)
+        
+        pool = rotation[0]
+        if pool is not self.active:
+            self.active = pool
+            if pool.block is not None and pool.block != self.block:
+                self.block = pool.block
+                self.runCallback('block', pool.block)
+            self.runCallback('connect')
+            if (pool.lastWork is not None and
+                time() - pool.lastWorkTime < self.WORK_FRESHNESS):
+                work, pool.lastWork = pool.lastWork, None
+                self._passWork(work)
+        self.requestWork()
+    
+    def _passWork(self, work):
+        # Work that gets rolled or is too big would keep hashing going to
+        # one pool for too long while splitting by weight.
+        if self.balanced and len(self.rotation) > 1:
+            work.mask = min(work.mask, self.unitMask())
+            work.rollNTime = 0
+            work.versionMask = 0
+        self.runCallback('work', work)
+    
+    def _poolCallback(self, pool, callback, *args):
+        """Pass a pool's callback on to the handler. Work, blocks and
+        messages come from every pool in rotation, and the rest only from
+        the active one. Anything else is only recorded.
+        """
+        if callback == 'work':
+            if pool in self.rotation:
+                self._passWork(*args)
+        elif callback == 'block':
+            if pool in self.rotation and args[0] != self.block:
+                self.block = args[0]
+                self.runCallback('block', *args)
+        elif callback in ('push', 'msg'):
+            if pool in self.rotation:
+                self.runCallback(callback, *args)
+        elif pool is self.active:
+            self.runCallback(callback, *args)
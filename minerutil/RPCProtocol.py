@@ -32,7 +32,7 @@ from twisted.internet import defer, reactor, protocol, error
 from twisted.internet.protocol import Protocol
 from twisted.python import failure
 
-from ClientBase import ClientBase, AssignedWork
+from ClientBase import ClientBase, AssignedWork, VERSION_MASK
 
 class StringBodyProducer(object):
     """Something Twisted itself needs..."""
@@ -73,6 +73,10 @@ class RPCPoller(object):
         self.askInterval = None
         self.askCall = None
         self.currentlyAsking = False
+        
+        # What ask() calls. Other work sources may change these.
+        self.method = 'getwork'
+        self.params = []
     
     def setInterval(self, interval):
         """Change the interval at which to poll the getwork() function."""
@@ -105,7 +109,7 @@ class RPCPoller(object):
         self.currentlyAsking = True
         self._stopCall()
         
-        d = self.call('getwork')
+        d = self.call(self.method, self.params)
         
         def errback(failure):
             if not self.currentlyAsking:
@@ -127,7 +131,7 @@ class RPCPoller(object):
                 (headers, result) = x
             except TypeError:
                 return
-            self.root.handleWork(result)
+            self.root.handleWork(result, headers=headers)
             self.root.handleHeaders(headers)
             self._startCall()
         # Minor bug in the #3420 patch; you can't start new requests during
@@ -156,7 +160,8 @@ class RPCPoller(object):
             Headers({
                 'Authorization': [self.root.auth],
                 'User-Agent': [self.root.version],
-                'Content-Type': ['application/json']
+                'Content-Type': ['application/json'],
+                'X-Mining-Extensions': ['rollntime version-rolling']
             }), StringBodyProducer(body))
         
         d = defer.Deferred()
@@ -241,11 +246,14 @@ class LongPoller(object):
             return
         
         self._request()
-        self.root.handleWork(result, True)
+        self.root.handleWork(result, True, response.headers)
 
 class RPCClient(ClientBase):
     """The actual root of the whole RPC client system."""
     
+    # How long work may be rolled for when X-Roll-NTime doesn't say.
+    ROLLNTIME_EXPIRE = 60
+    
     def __init__(self, handler, url):
         self.handler = handler
         self.url = '%s://%s:%d%s' % (url.scheme, url.hostname,
@@ -328,7 +336,7 @@ class RPCClient(ClientBase):
             askrate = defaults.get(variable, 10)
         self.poller.setInterval(askrate)
     
-    def handleWork(self, work, pushed=False):
+    def handleWork(self, work, pushed=False, headers=None):
         
         if work is None:
             return;
@@ -352,10 +360,42 @@ class RPCClient(ClientBase):
         aw.data = work['data'].decode('hex')[:80]
         aw.target = work['target'].decode('hex')
         aw.mask = work.get('mask', 32)
+        if headers is not None:
+            aw.rollNTime = self.parseRollNTime(headers)
+            aw.versionMask = self.parseVersionMask(headers)
         if pushed:
             self.runCallback('push', aw)
         self.runCallback('work', aw)
     
+    @classmethod
+    def parseRollNTime(cls, headers):
+        """Work out from X-Roll-NTime how many seconds the server lets us roll
+        the ntime of its work forward. Plain "Y" doesn't say, in which case
+        ROLLNTIME_EXPIRE is assumed.
+        """
+        rollntime = (headers.getRawHeaders('X-Roll-NTime') or [''])[0]
+        rollntime = rollntime.strip().lower()
+        if rollntime.startswith('expire='):
+            try:
+                return max(0, int(rollntime[7:]))
+            except ValueError:
+                return 0
+        elif rollntime in ('y', 'yes', '1', 'true'):
+            return cls.ROLLNTIME_EXPIRE
+        return 0
+    
+    @classmethod
+    def parseVersionMask(cls, headers):
+        """Work out from X-Version-Mask (hex, like Stratum's) which version
+        bits the server lets us roll. Only the bits BIP 320 leaves free are
+        ever rolled.
+        """
+        mask = (headers.getRawHeaders('X-Version-Mask') or [''])[0]
+        try:
+            return int(mask.strip(), 16) & VERSION_MASK
+        except ValueError:
+            return 0
+    
     def handleHeaders(self, headers):
         blocknum = headers.getRawHeaders('X-Blocknum') or ['']
         try:
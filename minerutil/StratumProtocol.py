@@ -0,0 +1,334 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+from hashlib import sha256
+from struct import pack, unpack
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+
+from ClientBase import *
+
+def doubleHash(data):
+    return sha256(sha256(data).digest()).digest()
+
+def swapWords(data):
+    """Reverse the bytes of every 32-bit word, which converts between a block
+    header and the word order that getwork (and so Phoenix) uses.
+    """
+    return pack('>%dI' % (len(data)/4), *unpack('<%dI' % (len(data)/4), data))
+
+def targetFromDifficulty(difficulty):
+    """Turn a share difficulty into a 256-bit little-endian target."""
+    target = int(0xffff * 2**208 / difficulty)
+    target = min(target, 2**256 - 1)
+    return ('%064x' % target).decode('hex')[::-1]
+
+class StratumJob(object):
+    """The parameters of one mining.notify, which any number of WorkUnits can
+    be made from by varying extranonce2.
+    """
+    
+    def __init__(self, params):
+        (self.id, prevhash, self.coinb1, self.coinb2, branches, version,
+            nbits, ntime, self.clean) = params[:9]
+        self.prevhash = prevhash.decode('hex')
+        self.coinb1 = self.coinb1.decode('hex')
+        self.coinb2 = self.coinb2.decode('hex')
+        self.branches = [b.decode('hex') for b in branches]
+        self.version = int(version, 16)
+        self.nbits = int(nbits, 16)
+        self.ntime = int(ntime, 16)
+    
+    def makeData(self, extranonce):
+        """Build the 80 bytes of getwork data for the given extranonce1 and
+        extranonce2, with a zero nonce.
+        """
+        root = doubleHash(self.coinb1 + extranonce + self.coinb2)
+        for branch in self.branches:
+            root = doubleHash(root + branch)
+        
+        # Stratum already sends the previous hash in getwork word order.
+        return (pack('>I', self.version) + self.prevhash + swapWords(root) +
+                pack('>III', self.ntime, self.nbits, 0))
+
+class StratumClientProtocol(LineReceiver, ClientBase):
+    """The actual connection to a Stratum server. Probably not a good idea to
+    use this directly, use StratumClient instead.
+    """
+    
+    delimiter = '\n'
+    MAX_LENGTH = 1 << 20
+    
+    def connectionMade(self):
+        self.factory.connection = self
+        self.nextId = 1
+        self.requests = {}
+        
+        # Version rolling is asked for first, so the mask is known before
+        # any work is handed out. Servers that don't know about it just
+        # reply with an error.
+        self.call('mining.configure', [['version-rolling'],
+            {'version-rolling.mask': '%08x' % self.factory.VERSION_MASK,
+             'version-rolling.min-bit-count': 2}]
+            ).addCallback(self.factory._configured)
+        self.call('mining.subscribe', [self.factory.version]
+            ).addCallback(self.factory._subscribed)
+        self.call('mining.authorize', [self.factory.username,
+            self.factory.password]).addCallback(self.factory._authorized)
+    
+    def connectionLost(self, reason):
+        self.factory._connectionLost()
+        for d in self.requests.values():
+            d.callback(None)
+        self.requests = {}
+    
+    def call(self, method, params):
+        """Send a request, returning a Deferred that fires with its result,
+        or None if it failed.
+        """
+        d = defer.Deferred()
+        self.requests[self.nextId] = d
+        self.sendLine(json.dumps({'id': self.nextId, 'method': method,
+            'params': params}))
+        self.nextId += 1
+        return d
+    
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        
+        if message.get('method'):
+            function = getattr(self.factory,
+                'on_' + message['method'].replace('.', '_'), None)
+            if function is not None:
+                try:
+                    function(message.get('params') or [])
+                except (ValueError, TypeError, IndexError):
+                    pass
+        else:
+            d = self.requests.pop(message.get('id'), None)
+            if d is not None:
+                d.callback(None if message.get('error')
+                           else message.get('result'))
+
+class StratumClient(ReconnectingClientFactory, ClientBase):
+    """This class implements an outbound connection to a Stratum server.
+    
+    Work is made locally from the jobs the server sends out: every WorkUnit
+    gets its own extranonce2, and with it its own coinbase and merkle root.
+    """
+    
+    protocol = StratumClientProtocol
+    maxDelay = 60
+    initialDelay = 0.2
+    
+    # The version bits we offer to roll.
+    VERSION_MASK = VERSION_MASK
+    
+    connection = None
+    
+    def __init__(self, handler, host, port, username, password):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.version = 'StratumClient/0.8'
+        
+        self._reset()
+    
+    def _reset(self):
+        """Forget everything about the last connection."""
+        self.job = None
+        self.jobs = {}
+        self.units = {}
+        self.extranonce1 = None
+        self.extranonce2Size = 4
+        self.extranonce2 = 0
+        self.target = targetFromDifficulty(1)
+        self.versionMask = 0
+        self.authorized = False
+        self.workPending = False
+    
+    def buildProtocol(self, addr):
+        p = self.protocol()
+        p.factory = self
+        p.handler = self.handler
+        return p
+    
+    def clientConnectionFailed(self, connector, reason):
+        self.runCallback('failure')
+    
+        return ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+    
+    def _connectionLost(self):
+        if self.authorized:
+            self.runCallback('disconnect')
+        else:
+            self.runCallback('failure')
+        self.connection = None
+        self._reset()
+    
+    def connect(self):
+        """Tells the StratumClient to connect if it hasn't already."""
+        
+        reactor.connectTCP(self.host, self.port, self)
+    
+    def disconnect(self):
+        """Tells the StratumClient to disconnect or stop connecting.
+        The StratumClient shouldn't be used again.
+        """
+        
+        self._deactivateCallbacks()
+        
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
+        
+        self.stopTrying()
+    
+    def setMeta(self, var, value):
+        """Stratum has no meta. Ignore."""
+    
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        if version is not None:
+            self.version = '%s/%s' % (shortname, version)
+        else:
+            self.version = shortname
+    
+    # Replies to our own requests...
+    def _configured(self, result):
+        if isinstance(result, dict) and result.get('version-rolling'):
+            try:
+                self.versionMask = (int(result['version-rolling.mask'], 16) &
+                                    self.VERSION_MASK)
+            except (KeyError, ValueError, TypeError):
+                self.versionMask = 0
+    
+    def _subscribed(self, result):
+        try:
+            self.extranonce1 = result[1].decode('hex')
+            self.extranonce2Size = int(result[2])
+        except (IndexError, ValueError, TypeError):
+            self.connection.transport.loseConnection()
+            return
+        self._sendWork()
+    
+    def _authorized(self, result):
+        if not result:
+            self.runCallback('msg', 'Stratum server rejected our login')
+            self.connection.transport.loseConnection()
+            return
+        self.authorized = True
+        self.resetDelay()
+        self.runCallback('connect')
+        self._sendWork()
+    
+    # Notifications from the server...
+    def on_mining_notify(self, params):
+        job = StratumJob(params)
+        first = self.job is None
+        if job.clean:
+            self.jobs = {}
+            self.units = {}
+        self.jobs[job.id] = job
+        self.job = job
+        
+        # A clean job means everything we handed out before is stale, so new
+        # work has to go out right away. So does the first job, since any
+        # request for work made before it was dropped.
+        if job.clean:
+            self._sendWork(True)
+        elif first:
+            self._sendWork()
+    
+    def on_mining_set_difficulty(self, params):
+        difficulty = float(params[0])
+        if difficulty > 0:
+            self.target = targetFromDifficulty(difficulty)
+    
+    def on_mining_set_version_mask(self, params):
+        self.versionMask = int(params[0], 16) & self.VERSION_MASK
+    
+    def on_client_show_message(self, params):
+        self.runCallback('msg', unicode(params[0]))
+    
+    def requestWork(self):
+        """Application needs work right now. It's made on the next pass of
+        the reactor, since the WorkQueue asks for more while storing work.
+        """
+        if not self.workPending:
+            self.workPending = True
+            reactor.callLater(0, self._sendWork)
+    
+    def _sendWork(self, pushed=False):
+        """Make a WorkUnit from the current job with the next extranonce2
+        and pass it on.
+        """
+        self.workPending = False
+        if (self.job is None or self.extranonce1 is None or
+            not self.authorized):
+            return
+        
+        extranonce2 = ('%0*x' % (self.extranonce2Size*2, self.extranonce2)
+                       ).decode('hex')[-self.extranonce2Size:]
+        self.extranonce2 = (self.extranonce2 + 1) % (1 <<
+                                                     (8*self.extranonce2Size))
+        
+        aw = AssignedWork()
+        aw.data = self.job.makeData(self.extranonce1 + extranonce2)
+        aw.target = self.target
+        aw.mask = 32
+        aw.versionMask = self.versionMask
+        
+        # The merkle root is enough to tell which job and extranonce2 a
+        # result came from.
+        self.units[aw.data[36:68]] = (self.job, extranonce2)
+        
+        if pushed:
+            self.runCallback('push', aw)
+        self.runCallback('work', aw)
+    
+    def sendResult(self, result):
+        """Submit a work result to the server. Returns a deferred which
+        provides a True/False depending on whether or not the server
+        accepted the work.
+        """
+        unit = self.units.get(result[36:68])
+        if self.connection is None or unit is None:
+            return defer.succeed(False)
+        job, extranonce2 = unit
+        
+        params = [self.username, job.id, extranonce2.encode('hex'),
+                  result[68:72].encode('hex'), result[76:80].encode('hex')]
+        if self.versionMask:
+            version, = unpack('>I', result[0:4])
+            params.append('%08x' % (version & self.versionMask))
+        
+        d = self.connection.call('mining.submit', params)
+        d.addCallback(lambda accepted: bool(accepted))
+        return d
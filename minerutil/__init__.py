@@ -23,6 +23,9 @@ import urlparse
 
 from MMPProtocol import MMPClient
 from RPCProtocol import RPCClient
+from StratumProtocol import StratumClient
+from GBTProtocol import GBTClient
+from PoolManager import PoolManager
 
 def openURL(url, handler):
     """Parses a URL and opens a connection using the appropriate client."""
@@ -38,7 +41,32 @@ def openURL(url, handler):
         
         return client
     elif parsed.scheme.lower() in ['http', 'https']:
+        # Work comes from getblocktemplate instead of getwork if there's an
+        # address for the coinbase to pay out to, or if asked for with ;gbt
+        # (for pools that give their own coinbase).
+        params = dict(urlparse.parse_qsl(parsed.params, True))
+        if 'payout' in params or 'gbt' in params:
+            return GBTClient(handler, parsed)
         return RPCClient(handler, parsed)
+    elif parsed.scheme.lower() == 'stratum+tcp':
+        return StratumClient(handler, parsed.hostname or 'localhost',
+            parsed.port or 3333, parsed.username or '',
+            parsed.password or '')
     else:
         raise ValueError('Unknown protocol: ' + parsed.scheme)
-    
\ No newline at end of file
+    
+def openURLs(urls, handler, weights=None):
+    """Opens a connection for a list of URLs. A single URL gets its client
+    directly; more than one are failed over between by a PoolManager, in the
+    order given, or have hashing split between them if given weights.
+    """
+    
+    if weights is not None:
+        if len(weights) != len(urls):
+            raise ValueError('Give one weight for every URL')
+        if min(weights) < 0 or not sum(weights):
+            raise ValueError('Weights must not be negative, and not all 0')
+    
+    if len(urls) == 1:
+        return openURL(urls[0], handler)
+    return PoolManager(handler, urls, openURL, weights)
@@ -22,13 +22,16 @@
 # THE SOFTWARE.
 
 import imp
+import multiprocessing
 from sys import exit
+from time import time
 from twisted.internet import reactor
 from optparse import OptionParser
 
 import minerutil
 from ConsoleLogger import ConsoleLogger
 from WorkQueue import WorkQueue
+from GetworkServer import GetworkServer
 from Miner import Miner
 
 class CommandLineOptions(object):
@@ -38,7 +41,7 @@ class CommandLineOptions(object):
     
     def __init__(self):
         self.parsedSettings = None
-        self.url = None
+        self.urls = None
         
         self.logger = None
         self.connection = None
@@ -50,28 +53,55 @@ class CommandLineOptions(object):
         self._parse()
     
     def _parse(self):
-        parser = OptionParser(usage="%prog -u URL [-k kernel] [kernel params]")
+        parser = OptionParser(usage="%prog -u URL [-k kernel] [kernel params]\n"
+            "       %prog -u URL --serve [HOST:]PORT\n"
+            "       %prog --precompile [-k kernel,...] [kernel params]\n"
+            "       %prog --tune [-k kernel,...] [kernel params]")
         parser.add_option("-v", "--verbose", action="store_true",
             dest="verbose", default=False, help="show debug messages")
         parser.add_option("--statusfile", dest="statusfile", help="write to a status file")
         parser.add_option('--blkfound', dest='blkfound', help='command to run when a block is found')
         parser.add_option("-k", "--kernel", dest="kernel", default="poclbm",
             help="the name of the kernel to use")
-        parser.add_option("-u", "--url", dest="url", default=None,
-            help="the URL of the mining server to work for [REQUIRED]")
+        parser.add_option("-u", "--url", dest="url", action="append",
+            default=None,
+            help="the URL of the mining server to work for [REQUIRED]; give "
+            "more than once to fail over to the others in order")
+        parser.add_option("-w", "--weights", dest="weights", default=None,
+            help="comma-separated weights to split hashing between the URLs "
+            "by, e.g. 70,20,10; URLs weighted 0 are only failed over to")
+        parser.add_option("--serve", dest="serve", default=None,
+            metavar="[HOST:]PORT",
+            help="instead of mining, serve getwork (with longpoll) to other "
+            "miners on this port, handing each its own work from -u")
         parser.add_option("-q", "--queuesize", dest="queuesize", type="int",
             default=1, help="how many work units to keep queued at all times")
         parser.add_option("-a", "--avgsamples", dest="avgsamples", type="int",
             default=10,
             help="how many samples to use for hashrate average")
+        parser.add_option("--precompile", action="store_true",
+            dest="precompile", default=False,
+            help="compile and cache every variant of the kernel(s) for every "
+            "device, then exit; comma-separated lists are accepted for -k and "
+            "the PLATFORM, DEVICE, VECTORS, BFI_INT and ATOMIC params")
+        parser.add_option("--tune", action="store_true", dest="tune",
+            default=False,
+            help="find the fastest VECTORS, BFI_INT, WORKSIZE and AGGRESSION "
+            "for every device and save them as profiles that later runs use "
+            "automatically, then exit")
+        parser.add_option("--tunelatency", dest="tunelatency", type="float",
+            default=0.1,
+            help="the longest a single kernel execution may take when tuning, "
+            "in seconds (default 0.1)")
         
         self.parsedSettings, args = parser.parse_args()
         
-        if self.parsedSettings.url is None:
+        if self.parsedSettings.url is None and \
+            not (self.parsedSettings.precompile or self.parsedSettings.tune):
             parser.print_usage()
             exit()
         else:
-            self.url = self.parsedSettings.url
+            self.urls = self.parsedSettings.url
         
         for arg in args:
             self._kernelOption(arg)
@@ -96,21 +126,26 @@ class CommandLineOptions(object):
     def makeConnection(self, requester):
         if not self.connection:
             try:
-                self.connection = minerutil.openURL(self.url, requester)
+                weights = self.parsedSettings.weights
+                if weights is not None:
+                    weights = [float(x) for x in weights.split(',')]
+                self.connection = minerutil.openURLs(self.urls, requester,
+                                                     weights)
             except ValueError, e:
                 print(e)
                 exit()
         return self.connection
     
     def makeKernel(self, requester):
-        if not self.kernel:
-            module = self.parsedSettings.kernel
+        if not self.kernel and self.parsedSettings.serve:
+            host, sep, port = self.parsedSettings.serve.rpartition(':')
             try:
-                file, filename, smt = imp.find_module(module, ['kernels'])
-            except ImportError:
-                print("Could not locate the specified kernel!")
+                self.kernel = GetworkServer(requester, int(port), host)
+            except ValueError:
+                print('Invalid port to serve on: %s' % port)
                 exit()
-            kernelModule = imp.load_module(module, file, filename, smt)
+        if not self.kernel:
+            kernelModule = loadKernelModule(self.parsedSettings.kernel)
             self.kernel = kernelModule.MiningKernel(requester)
         return self.kernel
     
@@ -119,8 +154,196 @@ class CommandLineOptions(object):
             self.queue = WorkQueue(requester, self)
         return self.queue
 
+def loadKernelModule(module):
+    try:
+        file, filename, smt = imp.find_module(module, ['kernels'])
+    except ImportError:
+        print("Could not locate the specified kernel!")
+        exit()
+    return imp.load_module(module, file, filename, smt)
+
+class OfflineInterface(object):
+    """Stands in for the KernelInterface while kernels are compiled or tuned
+    ahead of time, when there is no Miner to report to.
+    """
+    
+    def __init__(self, verbose, prefix):
+        self.verbose = verbose
+        self.prefix = prefix
+    
+    def debug(self, msg):
+        if self.verbose:
+            self.log(msg)
+    
+    def log(self, msg, withTimestamp=True, withIdentifier=True):
+        print('%s %s' % (self.prefix, msg))
+    
+    def error(self, msg=None):
+        if msg is not None:
+            self.log(msg)
+
+def listOption(kernelOptions, name, type, default):
+    """Read a kernel parameter that may be given as a comma-separated list of
+    values, for --precompile and --tune. Raises ValueError if it's malformed.
+    """
+    given = kernelOptions.get(name)
+    if given is None:
+        return default
+    if type == bool:
+        return sorted(set(x.strip().lower() in
+            ('t', 'true', 'on', '1', 'y', 'yes') for x in given.split(',')))
+    return [type(x) for x in given.split(',')]
+
+def deviceFilter(kernelOptions):
+    """Return a function that tells whether a device (by platform and device
+    ID) was selected with the PLATFORM and DEVICE parameters. Both default to
+    every device. Raises ValueError if either is malformed.
+    """
+    platforms = listOption(kernelOptions, 'PLATFORM', int, None)
+    devices = kernelOptions.get('DEVICE')
+    if devices is not None and devices.strip().lower() != 'all':
+        devices = [int(x) for x in devices.split(',')]
+    else:
+        devices = None
+    return lambda platform, device: ((platforms is None or
+        platform in platforms) and (devices is None or device in devices))
+
+def listDevicesJob(kernel):
+    return loadKernelModule(kernel).listDevices()
+
+def precompileJob(job):
+    """Runs in a worker process, and compiles a single kernel variant for a
+    single device. Returns the job with a description of the outcome.
+    """
+    (kernel, platform, device, name, vectors, atomic, bfiInt, cacheDir,
+        cacheSize, verbose) = job
+    interface = OfflineInterface(verbose,
+        '[%d:%d %s %s]' % (platform, device, name, kernel))
+    
+    start = time()
+    try:
+        cached = loadKernelModule(kernel).precompile(interface, cacheDir,
+            cacheSize, platform, device, vectors, atomic, bfiInt)
+    except Exception, e:
+        # Build failures carry the whole compiler log; -v shows it.
+        interface.debug(str(e))
+        message = str(e).strip().split('\n')[0]
+        return job, 'failed: %s' % (message or e.__class__.__name__)
+    
+    if cached is None:
+        return job, 'not supported by this device'
+    elif cached:
+        return job, 'already cached'
+    return job, 'compiled in %.2fs' % (time() - start)
+
+def precompile(options):
+    """Compile every requested variant of every requested kernel for every
+    OpenCL device, in parallel, so that the kernel cache is warm when mining
+    starts. Returns the number of variants that failed to compile.
+    """
+    settings = options.parsedSettings
+    kernelOptions = options.kernelOptions
+    
+    try:
+        selected = deviceFilter(kernelOptions)
+        variants = [(vectors, atomic, bfiInt)
+            for vectors in listOption(kernelOptions, 'VECTORS', bool,
+                                      [False, True])
+            for atomic in listOption(kernelOptions, 'ATOMIC', bool,
+                                     [False, True])
+            for bfiInt in listOption(kernelOptions, 'BFI_INT', bool,
+                                     [False, True])]
+        cacheSize = listOption(kernelOptions, 'CACHESIZE', int, [None])[0]
+    except ValueError, e:
+        print('Invalid kernel parameter: %s' % e)
+        return 1
+    cacheDir = kernelOptions.get('CACHEDIR')
+    
+    # OpenCL is only ever touched inside the pool, since some implementations
+    # don't survive being initialized before a fork.
+    pool = multiprocessing.Pool()
+    
+    jobs = []
+    for kernel in settings.kernel.split(','):
+        if not hasattr(loadKernelModule(kernel), 'precompile'):
+            print('The %s kernel has nothing to precompile.' % kernel)
+            continue
+        for platform, device, name in pool.apply(listDevicesJob, (kernel,)):
+            if not selected(platform, device):
+                continue
+            for vectors, atomic, bfiInt in variants:
+                jobs.append((kernel, platform, device, name, vectors, atomic,
+                    bfiInt, cacheDir, cacheSize, settings.verbose))
+    
+    print('Precompiling %d kernel variants...' % len(jobs))
+    failed = 0
+    for job, outcome in pool.imap_unordered(precompileJob, jobs):
+        (kernel, platform, device, name, vectors, atomic, bfiInt) = job[:7]
+        flags = [flag for flag, enabled in (('VECTORS', vectors),
+            ('ATOMIC', atomic), ('BFI_INT', bfiInt)) if enabled]
+        print('[%d:%d %s] %s %s: %s' % (platform, device, name, kernel,
+            ' '.join(flags) or '(defaults)', outcome))
+        if outcome.startswith('failed'):
+            failed += 1
+    
+    pool.close()
+    pool.join()
+    return failed
+
+def tune(options):
+    """Tune every requested kernel on every OpenCL device, one device at a
+    time so they don't disturb each other's measurements, and store the
+    results as device profiles for later runs. Returns the number of devices
+    that couldn't be tuned.
+    """
+    settings = options.parsedSettings
+    kernelOptions = options.kernelOptions
+    
+    try:
+        selected = deviceFilter(kernelOptions)
+        cacheSize = listOption(kernelOptions, 'CACHESIZE', int, [None])[0]
+    except ValueError, e:
+        print('Invalid kernel parameter: %s' % e)
+        return 1
+    cacheDir = kernelOptions.get('CACHEDIR')
+    profilePath = kernelOptions.get('PROFILES')
+    
+    failed = 0
+    for kernel in settings.kernel.split(','):
+        kernelModule = loadKernelModule(kernel)
+        if not hasattr(kernelModule, 'tune'):
+            print('The %s kernel has nothing to tune.' % kernel)
+            continue
+        for platform, device, name in kernelModule.listDevices():
+            if not selected(platform, device):
+                continue
+            interface = OfflineInterface(settings.verbose,
+                '[%d:%d %s %s]' % (platform, device, name, kernel))
+            interface.log('Tuning...')
+            try:
+                profile = kernelModule.tune(interface, cacheDir, cacheSize,
+                    profilePath, platform, device, settings.tunelatency)
+            except (IOError, OSError), e:
+                interface.log('Could not save profile: %s' % e)
+                failed += 1
+                continue
+            if profile is None:
+                interface.log('No settings could be run on this device')
+                failed += 1
+                continue
+            interface.log('Best: VECTORS=%d BFI_INT=%d WORKSIZE=%d '
+                'AGGRESSION=%d (%d khash/sec, %.1fms per execution)' %
+                (profile['VECTORS'], profile['BFI_INT'], profile['WORKSIZE'],
+                profile['AGGRESSION'], profile['rate'],
+                profile['latency']*1000))
+    return failed
+
 if __name__ == '__main__':
     options = CommandLineOptions()
+    if options.parsedSettings.precompile:
+        exit(1 if precompile(options) else 0)
+    if options.parsedSettings.tune:
+        exit(1 if tune(options) else 0)
     miner = Miner()
     miner.start(options)
     
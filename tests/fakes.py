@@ -0,0 +1,135 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Stand-ins for the parts of Phoenix that the units under test talk to."""
+
+import os
+from struct import pack
+from twisted.internet import defer
+
+from minerutil.ClientBase import ClientBase, AssignedWork
+from WorkQueue import WorkQueue
+
+# The genesis block's header, in getwork's word order. Its nonce, as Phoenix
+# reads it, is GENESIS_NONCE.
+GENESIS = ('01000000' + '00'*32 + '3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3'
+    '888a51323a9fb8aa4b1e5e4a' + '29ab5f49' + 'ffff001d' + '1dac2b7c'
+    ).decode('hex')
+GENESIS = ''.join(GENESIS[i:i+4][::-1] for i in range(0, 80, 4))
+GENESIS_NONCE = 497822588
+
+# A target that any hash ending in 32 zero bits meets.
+DIFFICULTY_1 = '\xff'*28 + '\x00'*4
+
+def makeWork(block='\x00'*32, data=None, target=DIFFICULTY_1, mask=32):
+    """An AssignedWork for the given previous block, with a random merkle
+    root unless the whole header is given.
+    """
+    work = AssignedWork()
+    work.data = data or (pack('>I', 1) + block + os.urandom(40) +
+                         '\x00'*4)
+    work.target = target
+    work.mask = mask
+    return work
+
+class FakeConnection(ClientBase):
+    """A client that never touches the network, and records what it's
+    asked to do.
+    """
+    
+    def __init__(self, url=None, handler=None, accept=True):
+        self.url = url
+        self.handler = handler
+        self.accept = accept
+        self.requests = 0
+        self.results = []
+    
+    def connect(self):
+        pass
+    def disconnect(self):
+        pass
+    def setMeta(self, var, value):
+        pass
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        pass
+    def requestWork(self):
+        self.requests += 1
+    def sendResult(self, result):
+        self.results.append(result)
+        return defer.succeed(self.accept)
+
+class FakeLogger(object):
+    """Records what the Miner would have shown."""
+    
+    def __init__(self):
+        self.messages = []
+        self.found = []
+    
+    def log(self, message, *args, **kwargs):
+        self.messages.append(message)
+    def reportDebug(self, message):
+        self.messages.append(message)
+    def reportFound(self, hash, accepted, diff=0.0):
+        self.found.append(accepted)
+    def reportVerifyQueue(self, depth, stalls):
+        pass
+
+class FakeOptions(object):
+    
+    def __init__(self, logger, queueSize=1, kernelOptions=None):
+        self.logger = logger
+        self.queueSize = queueSize
+        self.kernelOptions = kernelOptions or {}
+    
+    def getQueueSize(self):
+        return self.queueSize
+    def getAvgSamples(self):
+        return 10
+    def makeLogger(self, requester, miner):
+        return self.logger
+
+class FakeMiner(object):
+    """Enough of a Miner for a WorkQueue and a KernelInterface, with a
+    FakeConnection for the server.
+    """
+    
+    def __init__(self, queueSize=1, kernelOptions=None):
+        self.logger = FakeLogger()
+        self.options = FakeOptions(self.logger, queueSize, kernelOptions)
+        self.connection = FakeConnection()
+        self.queue = WorkQueue(self, self.options)
+        self.idle = True
+        self.cores = []
+        self.work = []
+    
+    def onWork(self, work):
+        # As the Miner does when it's its connection's handler.
+        self.work.append(work)
+        self.queue.storeWork(work)
+    def reportIdle(self, idle):
+        self.idle = idle
+    def _addCore(self, core):
+        self.cores.append(core)
+    def updateAverage(self):
+        pass
+    def updateLatency(self):
+        pass
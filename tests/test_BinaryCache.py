@@ -0,0 +1,134 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+from twisted.trial import unittest
+
+from BinaryCache import BinaryCache
+
+class FakeInterface(object):
+    
+    def __init__(self):
+        self.messages = []
+    
+    def debug(self, message):
+        self.messages.append(message)
+
+class BinaryCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.interface = FakeInterface()
+    
+    def open(self, maxSize=1024):
+        return BinaryCache(self.interface, self.directory, maxSize)
+    
+    def age(self, cache, key, seconds):
+        """Make an entry look like it was last used seconds ago."""
+        path = cache._path(key)
+        mtime = os.stat(path).st_mtime - seconds
+        os.utime(path, (mtime, mtime))
+    
+    def test_roundTrip(self):
+        cache = self.open()
+        self.assertIdentical(cache.get('kernel'), None)
+        cache.put('kernel', 'binary', 1.5)
+        self.assertEqual(cache.get('kernel'), 'binary')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.compileTime, 1.5)
+    
+    def test_evictsLeastRecentlyUsed(self):
+        """Once the cache is too big, the entries used longest ago go
+        first, and reading an entry counts as using it.
+        """
+        cache = self.open(250)
+        cache.put('a', 'a'*100)
+        cache.put('b', 'b'*100)
+        self.age(cache, 'a', 20)
+        self.age(cache, 'b', 10)
+        self.assertEqual(cache.get('a'), 'a'*100)
+        
+        cache.put('c', 'c'*100)
+        self.assertEqual(cache.get('a'), 'a'*100)
+        self.assertIdentical(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 'c'*100)
+    
+    def test_evictsDownToSize(self):
+        cache = self.open(250)
+        for i, key in enumerate('abcde'):
+            cache.put(key, key*100)
+            self.age(cache, key, 100 - i)
+        cache.evict()
+        kept = [key for key in 'abcde' if os.path.exists(cache._path(key))]
+        self.assertEqual(kept, ['d', 'e'])
+    
+    def test_atomicReplace(self):
+        """An entry is replaced as a whole: a reader that already opened the
+        old one reads all of it, later readers get all of the new one, and
+        no temporary files are left behind.
+        """
+        cache = self.open()
+        cache.put('kernel', 'old'*100)
+        reader = open(cache._path('kernel'), 'rb')
+        try:
+            cache.put('kernel', 'new'*100)
+            self.assertEqual(reader.read(), 'old'*100)
+        finally:
+            reader.close()
+        self.assertEqual(cache.get('kernel'), 'new'*100)
+        self.assertEqual(os.listdir(self.directory),
+                         ['kernel' + BinaryCache.SUFFIX])
+    
+    def test_unwritable(self):
+        """A cache that can't be written to just doesn't cache."""
+        open(self.directory, 'w').close()
+        cache = self.open()
+        cache.put('kernel', 'binary')
+        self.assertIdentical(cache.get('kernel'), None)
+        self.assertTrue(self.interface.messages)
+    
+    def test_failedWrite(self):
+        """A binary that can't be written in full is never renamed into the
+        cache, and its temporary file is removed.
+        """
+        class FullDisk(object):
+            def __init__(self, fd, mode):
+                self.f = realFdopen(fd, mode)
+            def write(self, data):
+                self.f.write(data[:len(data)//2])
+                raise IOError('No space left on device')
+            def close(self):
+                self.f.close()
+        realFdopen = os.fdopen
+        self.patch(os, 'fdopen', FullDisk)
+        
+        cache = self.open()
+        cache.put('kernel', 'binary'*100)
+        self.assertIdentical(cache.get('kernel'), None)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertTrue(self.interface.messages)
+    
+    def test_disabled(self):
+        cache = self.open(0)
+        cache.put('kernel', 'binary')
+        self.assertIdentical(cache.get('kernel'), None)
+        self.assertFalse(os.path.exists(self.directory))
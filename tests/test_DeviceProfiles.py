@@ -0,0 +1,131 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import imp
+import json
+import os
+from twisted.trial import unittest
+
+from DeviceProfiles import DeviceProfiles
+
+try:
+    import pyopencl
+except ImportError:
+    phatk = None
+else:
+    # Loaded the way phoenix.py loads kernels, before trial moves into its
+    # temporary directory.
+    phatk = imp.load_module('phatk', *imp.find_module('phatk',
+        [os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernels')]))
+
+class FakeDevice(object):
+    """Just what a kernel reads from a pyopencl Device to key its profile."""
+    
+    def __init__(self, name='Fake Device\x00', driver='1.0'):
+        self.name = name
+        self.driver_version = driver
+        self.extensions = ''
+        self.version = 'OpenCL 1.2'
+
+class DeviceProfilesTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = os.path.join(os.path.abspath(self.mktemp()),
+                                 'profiles.json')
+        os.mkdir(os.path.dirname(self.path))
+        self.profiles = DeviceProfiles(self.path)
+    
+    def test_roundTrip(self):
+        """Profiles are stored and loaded by key, alongside each other."""
+        self.assertIdentical(self.profiles.get('a'), None)
+        self.profiles.put('a', {'VECTORS': True, 'WORKSIZE': 128})
+        self.profiles.put('b', {'VECTORS': False})
+        
+        profiles = DeviceProfiles(self.path)
+        self.assertEqual(profiles.get('a'), {'VECTORS': True, 'WORKSIZE': 128})
+        self.assertEqual(profiles.get('b'), {'VECTORS': False})
+        
+        self.profiles.put('a', {'WORKSIZE': 64})
+        self.assertEqual(profiles.get('a'), {'WORKSIZE': 64})
+        self.assertEqual(profiles.get('b'), {'VECTORS': False})
+    
+    def test_badFile(self):
+        """A file that isn't a JSON object holds no profiles, and is replaced
+        by the next one stored.
+        """
+        for contents in ('{"a": ', '[1, 2]'):
+            f = open(self.path, 'w')
+            f.write(contents)
+            f.close()
+            self.assertIdentical(self.profiles.get('a'), None)
+        self.profiles.put('a', {})
+        self.assertEqual(json.load(open(self.path)), {'a': {}})
+    
+    def test_atomicReplace(self):
+        """The file is written beside the old one and renamed over it, so
+        a failed save leaves the old file whole and no temporary file behind.
+        """
+        self.profiles.put('a', {'WORKSIZE': 128})
+        directory = os.path.dirname(self.path)
+        
+        renames = []
+        def rename(source, destination):
+            renames.append((os.path.dirname(source), destination))
+            raise OSError('no room')
+        self.patch(os, 'rename', rename)
+        self.assertRaises(OSError, self.profiles.put, 'b', {})
+        
+        self.assertEqual(renames, [(directory, self.path)])
+        self.assertEqual(os.listdir(directory), ['profiles.json'])
+        self.assertEqual(self.profiles.get('a'), {'WORKSIZE': 128})
+        self.assertIdentical(self.profiles.get('b'), None)
+    
+    def test_unwritable(self):
+        """A profile that can't be saved raises."""
+        profiles = DeviceProfiles(os.path.join(self.path, 'missing', 'x'))
+        self.assertRaises((IOError, OSError), profiles.put, 'a', {})
+
+class ProfileKeyTest(unittest.TestCase):
+    
+    if phatk is None:
+        skip = 'PyOpenCL is not installed'
+    
+    def key(self, device):
+        return phatk.profileKey(None, device)
+    
+    def test_key(self):
+        """The key names the device and driver, and hashes the kernel source
+        with its base build options, so a new driver or kernel revision
+        means tuning again.
+        """
+        key = self.key(FakeDevice())
+        name, driver, kernel = key.split('|')
+        self.assertEqual((name, driver), ('Fake Device', '1.0'))
+        self.assertTrue(kernel.startswith('phatk '))
+        self.assertEqual(self.key(FakeDevice()), key)
+        
+        self.assertNotEqual(self.key(FakeDevice(name='Other')), key)
+        self.assertNotEqual(self.key(FakeDevice(driver='1.1')), key)
+        source = phatk.kernelSource()
+        self.patch(phatk, 'kernelSource', lambda: source + '\n')
+        self.assertNotEqual(self.key(FakeDevice()), key)
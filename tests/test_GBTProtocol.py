@@ -0,0 +1,264 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+import os
+from struct import pack
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+import minerutil
+from minerutil.GBTProtocol import GBTClient, pushData, pushNumber, readVarInt
+from minerutil.StratumProtocol import doubleHash, swapWords
+
+TRANSACTIONS = [os.urandom(60 + i) for i in range(3)]
+COMMITMENT = '6a24aa21a9ed' + os.urandom(32).encode('hex')
+PAYOUT = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+PAYOUT_SCRIPT = '0014751e76e8199196d454941c45d1b3a323f1433bd6'.decode('hex')
+
+def makeTemplate(**kwargs):
+    template = {'version': 0x20000000,
+                'previousblockhash': '11'*32,
+                'bits': '207fffff',
+                'curtime': 1700000000,
+                'height': 5,
+                'coinbasevalue': 5000000000,
+                'target': '7fffff' + '00'*29,
+                'default_witness_commitment': COMMITMENT,
+                'transactions': [{'data': tx.encode('hex'),
+                                  'txid': doubleHash(tx)[::-1].encode('hex')}
+                                 for tx in TRANSACTIONS]}
+    template.update(kwargs)
+    return template
+
+def splitCoinbase(tx):
+    """Take apart a coinbase from a submitted block, giving its script, its
+    outputs, its witness, the hash of it without the witness, and its size.
+    """
+    segwit = tx[4:6] == '\x00\x01'
+    i = 6 if segwit else 4
+    inputs, i = readVarInt(tx, i)
+    length, i = readVarInt(tx, i + 36)
+    script = tx[i:i+length]
+    i += length + 4
+    start = i
+    outputs, i = readVarInt(tx, i)
+    for n in range(outputs):
+        length, i = readVarInt(tx, i + 8)
+        i += length
+    outputs, end = tx[start:i], i
+    if segwit:
+        items, i = readVarInt(tx, i)
+        for n in range(items):
+            length, i = readVarInt(tx, i)
+            i += length
+    stripped = tx[:4] + tx[6 if segwit else 4:end] + tx[i:i+4]
+    return script, outputs, tx[end:i], doubleHash(stripped), i + 4
+
+class BlockChecker(object):
+    """Reads a block back the way a node would, and says whether it's
+    consistent with the template it was made from.
+    """
+    
+    def __init__(self, block):
+        self.header = block[:80]
+        count, i = readVarInt(block, 80)
+        (self.script, self.outputs, self.witness, txid,
+         size) = splitCoinbase(block[i:])
+        self.transactions = block[i+size:]
+        
+        level = [txid] + [doubleHash(tx) for tx in TRANSACTIONS]
+        while len(level) > 1:
+            if len(level) % 2:
+                level.append(level[-1])
+            level = [doubleHash(level[i] + level[i+1])
+                     for i in range(0, len(level), 2)]
+        self.root = level[0]
+        self.count = count
+
+class TemplateServer(resource.Resource):
+    """A bitcoind or pool that hands out the same template to everyone, and
+    keeps every block submitted.
+    """
+    isLeaf = True
+    
+    def __init__(self, template, reject=None):
+        resource.Resource.__init__(self)
+        self.template = template
+        self.reject = reject
+        self.submitted = []
+    
+    def render_POST(self, request):
+        call = json.loads(request.content.read())
+        if call['method'] == 'getblocktemplate':
+            result = self.template
+        elif call['method'] == 'submitblock':
+            self.submitted.append(call['params'])
+            result = self.reject
+        else:
+            result = None
+        return json.dumps({'result': result, 'error': None, 'id': call['id']})
+
+class Handler(object):
+    
+    def __init__(self):
+        self.work = defer.Deferred()
+        self.messages = []
+    
+    def onWork(self, work):
+        if not self.work.called:
+            self.work.callback(work)
+    def onMsg(self, message):
+        self.messages.append(message)
+
+class PushNumberTest(unittest.TestCase):
+    
+    def test_smallNumbersUseOpcodes(self):
+        """BIP 34 heights up to 16 are pushed with OP_1 to OP_16."""
+        self.assertEqual(pushNumber(0), '\x00')
+        self.assertEqual(pushNumber(1), '\x51')
+        self.assertEqual(pushNumber(16), '\x60')
+    
+    def test_largerNumbers(self):
+        self.assertEqual(pushNumber(17), '\x01\x11')
+        self.assertEqual(pushNumber(127), '\x01\x7f')
+        self.assertEqual(pushNumber(128), '\x02\x80\x00')
+        self.assertEqual(pushNumber(1000), '\x02\xe8\x03')
+        self.assertEqual(pushNumber(500000), '\x03\x20\xa1\x07')
+
+class GBTClientTest(unittest.TestCase):
+    
+    def startServer(self, template, reject=None, params=';payout=' + PAYOUT):
+        self.server = TemplateServer(template, reject)
+        self.listener = reactor.listenTCP(0, server.Site(self.server),
+                                          interface='127.0.0.1')
+        self.handler = Handler()
+        self.client = minerutil.openURL('http://u:p@127.0.0.1:%d/%s' %
+            (self.listener.getHost().port, params), self.handler)
+        self.assertIsInstance(self.client, GBTClient)
+        self.client.connect()
+        return self.handler.work
+    
+    def tearDown(self):
+        self.client.disconnect()
+        # The poller's workaround for idle connections leaves a timer behind.
+        for call in reactor.getDelayedCalls():
+            if call.func.__name__ == 'idleFix':
+                call.cancel()
+        for agent in (self.client.poller.agent,
+                      self.client.templatePoller.poller.agent):
+            for protocols in agent._protocolCache.values():
+                for protocol in protocols:
+                    protocol.transport.loseConnection()
+        
+        # Let the connections close before the reactor is checked.
+        d = defer.maybeDeferred(self.listener.stopListening)
+        def wait(ignored):
+            d = defer.Deferred()
+            reactor.callLater(0, d.callback, None)
+            return d
+        return d.addCallback(wait)
+    
+    def submit(self, work):
+        return self.client.sendResult(pack('<76sI', work.data[:76], 12345))
+    
+    def test_solo(self):
+        """Work from bitcoind has a BIP 34 coinbase paying the payout address,
+        and makes whole blocks that match its header.
+        """
+        def gotWork(work):
+            header = swapWords(work.data)
+            self.assertEqual(header[4:36], ('11'*32).decode('hex'))
+            d = self.submit(work)
+            d.addCallback(self.assertTrue)
+            d.addCallback(lambda ignored: header)
+            return d
+        def check(header):
+            [params] = self.server.submitted
+            self.assertEqual(len(params), 1)
+            block = BlockChecker(params[0].decode('hex'))
+            self.assertEqual(block.header[:76], header[:76])
+            self.assertEqual(block.header[36:68], block.root)
+            self.assertEqual(block.count, len(TRANSACTIONS) + 1)
+            self.assertEqual(block.transactions, ''.join(TRANSACTIONS))
+            
+            # The height is OP_5, then the extranonce and tag are pushed.
+            self.assertEqual(block.script[0], '\x55')
+            self.assertEqual(block.script[1], '\x08')
+            self.assertEqual(block.script[10:], pushData('/phoenix/'))
+            
+            self.assertIn(PAYOUT_SCRIPT, block.outputs)
+            self.assertIn(COMMITMENT.decode('hex'), block.outputs)
+            self.assertEqual(block.witness, '\x01\x20' + '\x00'*32)
+        d = self.startServer(makeTemplate())
+        d.addCallback(gotWork)
+        d.addCallback(check)
+        return d
+    
+    def test_pool(self):
+        """A pool's own coinbase gets the extranonce appended to its script,
+        and its workid goes back with every share.
+        """
+        script = pushNumber(300000) + pushData('pool')
+        outputs = '\x01' + pack('<Q', 2500000000) + \
+            pushData('\x51')
+        coinbase = (pack('<I', 1) + '\x01' + '\x00'*32 + '\xff'*4 +
+                    chr(len(script)) + script + '\xff'*4 + outputs +
+                    pack('<I', 0))
+        template = makeTemplate(workid='share-7',
+            coinbasetxn={'data': coinbase.encode('hex')},
+            mutable=['time', 'coinbase/append'])
+        del template['coinbasevalue']
+        del template['default_witness_commitment']
+        
+        def gotWork(work):
+            d = self.submit(work)
+            d.addCallback(self.assertFalse)
+            return d
+        def check(ignored):
+            [params] = self.server.submitted
+            self.assertEqual(params[1], {'workid': 'share-7'})
+            block = BlockChecker(params[0].decode('hex'))
+            self.assertEqual(block.header[36:68], block.root)
+            self.assertEqual(block.script[:len(script)], script)
+            self.assertEqual(len(block.script), len(script) + 9)
+            self.assertEqual(block.outputs, outputs)
+            self.assertEqual(block.witness, '')
+            self.assertEqual(self.handler.messages,
+                             ['Block rejected: high-hash'])
+        d = self.startServer(template, 'high-hash', ';gbt')
+        d.addCallback(gotWork)
+        d.addCallback(check)
+        return d
+    
+    def test_unknownResult(self):
+        """Results for work the client never made aren't sent anywhere."""
+        def gotWork(work):
+            d = self.client.sendResult(os.urandom(80))
+            d.addCallback(self.assertFalse)
+            d.addCallback(lambda ignored: self.assertEqual(
+                self.server.submitted, []))
+            return d
+        d = self.startServer(makeTemplate())
+        d.addCallback(gotWork)
+        return d
@@ -0,0 +1,168 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+from StringIO import StringIO
+from twisted.internet import reactor
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from GetworkServer import GetworkServer, GetworkResource
+from KernelInterface import KernelInterface
+from tests.fakes import FakeMiner, makeWork, GENESIS, GENESIS_NONCE
+
+class GetworkServerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.miner = FakeMiner(queueSize=2)
+        self.server = GetworkServer(KernelInterface(self.miner), 0,
+                                    '127.0.0.1')
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.listener.getHost().port
+        self.agent = Agent(reactor)
+    
+    def tearDown(self):
+        return self.server.stop()
+    
+    def call(self, params=[], extensions=None, path='/'):
+        """Make a getwork call as a downstream miner would, and fire with
+        its result.
+        """
+        headers = Headers({'Content-Type': ['application/json']})
+        if extensions:
+            headers.addRawHeader('X-Mining-Extensions', extensions)
+        body = json.dumps({'method': 'getwork', 'params': params, 'id': 1})
+        d = self.agent.request('POST', self.url + path, headers,
+                               FileBodyProducer(StringIO(body)))
+        d.addCallback(readBody)
+        d.addCallback(lambda body: json.loads(body)['result'])
+        return d
+    
+    def submit(self, data, nonce):
+        result = data[:76] + chr(nonce & 0xff) + chr(nonce >> 8 & 0xff) + \
+            chr(nonce >> 16 & 0xff) + chr(nonce >> 24) + '\x00'*48
+        return self.call([result.encode('hex')])
+    
+    def store(self, *works):
+        for work in works:
+            self.miner.queue.storeWork(work)
+    
+    def test_plainGetsWholeUnits(self):
+        """Plain getwork gets a different whole unit every time, with
+        everything a miner needs to hash it.
+        """
+        first, second = makeWork(), makeWork()
+        self.store(first, second)
+        
+        def check(results):
+            data = [r['data'].decode('hex') for r in results]
+            self.assertEqual(data[0][:80], first.data)
+            self.assertEqual(data[1][:80], second.data)
+            for r, work in zip(results, (first, second)):
+                self.assertEqual(len(r['data']), 256)
+                self.assertEqual(r['target'], work.target.encode('hex'))
+                self.assertEqual(len(r['midstate']), 64)
+                self.assertEqual(len(r['hash1']), 128)
+                self.assertNotIn('noncerange', r)
+        d = self.call()
+        d.addCallback(lambda r: self.call().addCallback(lambda s: [r, s]))
+        d.addCallback(check)
+        return d
+    
+    def test_splitUnitsStayWithNoncerange(self):
+        """Miners with noncerange share a unit, in adjacent ranges, and a
+        plain miner never gets that unit.
+        """
+        split, whole = makeWork(), makeWork()
+        self.store(split, whole)
+        
+        results = []
+        d = self.call(extensions='noncerange')
+        d.addCallback(results.append)
+        d.addCallback(lambda ignored: self.call(extensions='noncerange'))
+        d.addCallback(results.append)
+        d.addCallback(lambda ignored: self.call())
+        d.addCallback(results.append)
+        def check(ignored):
+            self.assertEqual(results[0]['data'][:160], split.data.encode('hex'))
+            self.assertEqual(results[1]['data'][:160], split.data.encode('hex'))
+            self.assertEqual(results[0]['noncerange'], '000000003fffffff')
+            self.assertEqual(results[1]['noncerange'], '400000007fffffff')
+            self.assertEqual(results[2]['data'][:160], whole.data.encode('hex'))
+        d.addCallback(check)
+        return d
+    
+    def test_submit(self):
+        """A good result is passed upstream once, and the upstream's answer
+        goes back to the miner. Duplicates, bad nonces and results for
+        unknown work never reach the upstream.
+        """
+        self.store(makeWork(data=GENESIS[:76] + '\x00'*4))
+        results = []
+        d = self.call()
+        d.addCallback(lambda ignored: self.submit(GENESIS, GENESIS_NONCE))
+        d.addCallback(results.append)
+        d.addCallback(lambda ignored: self.submit(GENESIS, GENESIS_NONCE))
+        d.addCallback(results.append)
+        d.addCallback(lambda ignored: self.submit(GENESIS, GENESIS_NONCE+1))
+        d.addCallback(results.append)
+        d.addCallback(lambda ignored: self.submit('\x01'*80, 0))
+        d.addCallback(results.append)
+        def check(ignored):
+            self.assertEqual(results, [True, False, False, False])
+            self.assertEqual(self.miner.connection.results,
+                             [GENESIS[:76] + GENESIS[76:80]])
+        d.addCallback(check)
+        return d
+    
+    def test_longPoll(self):
+        """A long poll is answered with work for the next block once it
+        comes out.
+        """
+        self.store(makeWork('\x01'*32))
+        newBlock = makeWork('\x02'*32)
+        d = self.call(path=self.server.LONGPOLL_PATH)
+        reactor.callLater(0.1, self.store, newBlock)
+        d.addCallback(lambda r: self.assertEqual(r['data'][:160],
+                                                 newBlock.data.encode('hex')))
+        return d
+    
+    def test_hungUp(self):
+        """Nothing is written to a miner that hangs up before its work is
+        ready.
+        """
+        request = DummyRequest([''])
+        request.method = 'POST'
+        request.path = '/'
+        request.content = StringIO(json.dumps({'method': 'getwork',
+                                               'params': [], 'id': 1}))
+        resource = GetworkResource(self.server)
+        self.assertEqual(resource.render(request), NOT_DONE_YET)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.store(makeWork())
+        self.assertTrue(request.finished)
+        self.assertEqual(request.written, [])
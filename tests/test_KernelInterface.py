@@ -0,0 +1,106 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from struct import pack
+from twisted.trial import unittest
+
+from KernelInterface import KernelInterface
+from WorkQueue import WorkUnit, NonceRange
+from tests.fakes import FakeMiner, GENESIS, GENESIS_NONCE, DIFFICULTY_1
+
+# The genesis block's hash, as calculateHash returns it.
+GENESIS_HASH = ('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8c'
+    'e26f').decode('hex')[::-1]
+
+def target(value):
+    """A 256-bit little endian target from an integer."""
+    return ''.join(pack('<Q', value >> shift & (2**64 - 1))
+                   for shift in range(0, 256, 64))
+
+def makeRange(target):
+    unit = WorkUnit()
+    unit.data = GENESIS
+    unit.target = target
+    return NonceRange(unit, 0, 2**32)
+
+class VerifyTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.interface = KernelInterface(FakeMiner())
+    
+    def test_hash(self):
+        """calculateHash gives the genesis block's well-known hash."""
+        self.assertEqual(self.interface.calculateHash(makeRange(DIFFICULTY_1),
+            GENESIS_NONCE), GENESIS_HASH)
+    
+    def test_winner(self):
+        """A nonce that meets the target is a winner, along with its hash,
+        even if the kernel set bits outside of the 32-bit space.
+        """
+        nr = makeRange(DIFFICULTY_1)
+        for nonce in (GENESIS_NONCE, GENESIS_NONCE | 2**32):
+            winners, invalid = self.interface.verifyNonces(nr, [nonce])
+            self.assertEqual(winners, [(GENESIS_NONCE, GENESIS_HASH)])
+            self.assertEqual(invalid, [])
+        self.assertTrue(self.interface.checkTarget(GENESIS_HASH,
+                                                   nr.unit.target))
+    
+    def test_difficultyOneOnly(self):
+        """A hash that ends in 32 zero bits but is above the target is
+        neither a winner nor invalid. The comparison agrees with checkTarget
+        right at the boundary.
+        """
+        hash = int(GENESIS_HASH[::-1].encode('hex'), 16)
+        for value, wins in ((hash - 1, False), (hash, True)):
+            nr = makeRange(target(value))
+            winners, invalid = self.interface.verifyNonces(nr, [GENESIS_NONCE])
+            self.assertEqual(bool(winners), wins)
+            self.assertEqual(invalid, [])
+            self.assertEqual(self.interface.checkTarget(GENESIS_HASH,
+                                                        nr.unit.target), wins)
+    
+    def test_hardwareError(self):
+        """A nonce whose hash doesn't even meet difficulty 1 is invalid."""
+        nr = makeRange(DIFFICULTY_1)
+        hash = self.interface.calculateHash(nr, GENESIS_NONCE + 1)
+        self.assertFalse(self.interface.checkTarget(hash, DIFFICULTY_1))
+        winners, invalid = self.interface.verifyNonces(nr,
+            [GENESIS_NONCE + 1, GENESIS_NONCE])
+        self.assertEqual(invalid, [GENESIS_NONCE + 1])
+        self.assertEqual([nonce for nonce, hash in winners], [GENESIS_NONCE])
+    
+    def test_difficulty(self):
+        """The unit's difficulty is the pool's difficulty 1 target over its
+        own, worked out the first time it's verified against.
+        """
+        nr = makeRange(DIFFICULTY_1)
+        self.assertIdentical(nr.unit.difficulty, None)
+        self.interface.verifyNonces(nr, [])
+        self.assertAlmostEqual(nr.unit.difficulty, 0xffff/65536.0, 12)
+        
+        nr = makeRange(target(0xffff << 208))
+        self.interface.verifyNonces(nr, [])
+        self.assertEqual(nr.unit.difficulty, 1.0)
+        
+        nr = makeRange(target(0xffff << 200))
+        self.interface.verifyNonces(nr, [])
+        self.assertEqual(nr.unit.difficulty, 256.0)
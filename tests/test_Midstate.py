@@ -0,0 +1,79 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+from twisted.trial import unittest
+
+from minerutil import Midstate
+from minerutil.Midstate import calculateMidstate, calculateMidstates
+
+class BatchTest(unittest.TestCase):
+    """calculateMidstates has to agree with calculateMidstate, which stays
+    the reference.
+    """
+    
+    COUNT = 37
+    
+    def setUp(self):
+        self.blocks = [os.urandom(64) for i in range(self.COUNT)]
+        self.states = [os.urandom(32) for i in range(self.COUNT)]
+    
+    def check(self, states=None, rounds=None):
+        expected = [calculateMidstate(block, state, rounds) for block, state
+                    in zip(self.blocks, states or [None]*self.COUNT)]
+        self.assertEqual(calculateMidstates(self.blocks, states, rounds),
+                         expected)
+    
+    def test_midstates(self):
+        """Full midstates from the initial state."""
+        self.check()
+    
+    def test_fromStates(self):
+        """Blocks can each start from their own state, as the second block
+        of a header does.
+        """
+        self.check(self.states)
+    
+    def test_partialRounds(self):
+        """The states after only some rounds, without the final addition,
+        which is what the kernels precompute.
+        """
+        for rounds in (1, 3, 16, 17, 63, 64):
+            self.check(rounds=rounds)
+            self.check(self.states, rounds)
+    
+    def test_withoutNumPy(self):
+        """Without NumPy it falls back on calculateMidstate."""
+        self.patch(Midstate, 'np', None)
+        self.check()
+        self.check(self.states, 3)
+    
+    def test_edges(self):
+        """No blocks, any iterable, and malformed input."""
+        self.assertEqual(calculateMidstates([]), [])
+        self.assertEqual(calculateMidstates(iter(self.blocks[:1])),
+                         [calculateMidstate(self.blocks[0])])
+        self.assertRaises(ValueError, calculateMidstates, self.blocks,
+                          self.states[1:])
+        self.assertRaises(ValueError, calculateMidstates, ['\x00'*63])
+        self.assertRaises(ValueError, calculateMidstates, self.blocks[:1],
+                          ['\x00'*31])
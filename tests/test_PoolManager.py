@@ -0,0 +1,185 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from time import time
+from twisted.trial import unittest
+
+from minerutil.PoolManager import PoolManager
+from KernelInterface import KernelInterface
+from tests.fakes import FakeConnection, FakeMiner, makeWork, GENESIS, \
+    GENESIS_NONCE
+
+class Handler(object):
+    """Stands in for the Miner."""
+    
+    def __init__(self):
+        self.work = []
+        self.switches = []
+    def onWork(self, work):
+        self.work.append(work)
+    def onSwitch(self, pools, reason):
+        self.switches.append(([pool.name for pool in pools], reason))
+
+class FailoverTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.handler = Handler()
+        self.manager = PoolManager(self.handler,
+            ['http://a:1/', 'http://b:2/'], FakeConnection)
+        self.primary, self.backup = self.manager.pools
+    
+    def connect(self, pool):
+        pool.onConnect()
+        pool.onWork(makeWork())
+    
+    def test_connectingIsNotAStall(self):
+        """A pool that hasn't given work yet isn't timed, however slow its
+        login is, so a faster backup doesn't take over.
+        """
+        self.manager.requestWork()
+        self.assertIdentical(self.primary.askedAt, None)
+        self.connect(self.backup)
+        self.manager.check()
+        self.assertIdentical(self.manager.active, self.primary)
+        self.assertEqual(self.handler.switches, [])
+    
+    def test_stallFloor(self):
+        """Requests taking longer than usual, but less than STALL_TIME, are
+        not a stall.
+        """
+        self.connect(self.primary)
+        self.connect(self.backup)
+        self.manager.requestWork()
+        self.primary.askedAt = time() - self.manager.STALL_TIME + 1
+        self.manager.check()
+        self.assertIdentical(self.manager.active, self.primary)
+        
+        self.primary.askedAt = time() - self.manager.STALL_TIME - 1
+        self.manager.check()
+        self.assertIdentical(self.manager.active, self.backup)
+        self.assertEqual(self.handler.switches[0][0], ['b:2'])
+    
+    def test_stallFollowsLatency(self):
+        """A pool that's always slow gets STALL_FACTOR times its usual
+        latency before it counts as stalled.
+        """
+        self.connect(self.primary)
+        self.primary.latency = self.manager.STALL_TIME
+        self.assertEqual(self.primary.stallTime(),
+            self.manager.STALL_TIME*self.manager.STALL_FACTOR)
+        self.primary.askedAt = time() - self.manager.STALL_TIME*2
+        self.assertIdentical(self.primary.problem(time()), None)
+    
+    def test_failure(self):
+        """A pool whose connection fails is failed over at once."""
+        self.connect(self.primary)
+        self.connect(self.backup)
+        self.primary.onFailure()
+        self.manager.check()
+        self.assertIdentical(self.manager.active, self.backup)
+        self.assertEqual(self.handler.switches[0][1], 'not connected')
+    
+    def test_staleRate(self):
+        """Stale results count against a pool's score, and enough of them
+        count as a problem.
+        """
+        self.connect(self.primary)
+        self.connect(self.backup)
+        before = self.primary.score(time())
+        self.primary.reportStale()
+        self.assertTrue(self.primary.score(time()) > before)
+        for i in range(5):
+            self.primary.reportStale()
+        self.assertEqual(self.primary.problem(time()),
+            '%d%% of results stale' % (self.primary.staleRate*100))
+        self.manager.check()
+        self.assertIdentical(self.manager.active, self.backup)
+
+class WeightedTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.miner = FakeMiner()
+        self.manager = PoolManager(self.miner,
+            ['http://a:1/', 'http://b:2/'], FakeConnection, weights=[3, 1])
+        self.miner.connection = self.manager
+        self.heavy, self.light = self.manager.pools
+        for pool in self.manager.pools:
+            pool.onConnect()
+    
+    def hashUnit(self):
+        """Ask for work, have the pool that was asked give it, and take all
+        of its nonces as one range.
+        """
+        requests = [pool.client.requests for pool in self.manager.pools]
+        self.manager.requestWork()
+        asked = [pool for pool, before in zip(self.manager.pools, requests)
+                 if pool.client.requests > before]
+        self.assertEqual(len(asked), 1)
+        asked[0].onWork(makeWork())
+        ranges = []
+        self.miner.queue.fetchRange(2**32).addCallback(ranges.append)
+        self.assertEqual(ranges[0].size, 2**self.manager.START_MASK)
+        return ranges[0]
+    
+    def test_splitByWeight(self):
+        """Work is asked for from each pool in proportion to its weight, and
+        the nonces handed out are counted against the pool they came from.
+        """
+        self.assertEqual(self.manager.rotation, [self.heavy, self.light])
+        ranges = [self.hashUnit() for i in range(40)]
+        
+        sources = [nr.unit.source for nr in ranges]
+        self.assertEqual(sources.count(self.heavy), 30)
+        self.assertEqual(sources.count(self.light), 10)
+        self.assertEqual(self.heavy.hashes, 30*2**self.manager.START_MASK)
+        self.assertEqual(self.light.hashes, 10*2**self.manager.START_MASK)
+        
+        # Work is cut down so that no one pool gets too long a turn.
+        for work in self.miner.work:
+            self.assertEqual(work.mask, self.manager.START_MASK)
+            self.assertEqual(work.rollNTime, 0)
+    
+    def test_resultsGoToSource(self):
+        """A result goes back to the pool its work came from, not to the
+        active pool.
+        """
+        self.light.onWork(makeWork(data=GENESIS))
+        self.assertIdentical(self.manager.active, self.heavy)
+        
+        ranges = []
+        self.miner.queue.fetchRange().addCallback(ranges.append)
+        self.assertIdentical(ranges[0].unit.source, self.light)
+        
+        accepted = []
+        kernel = KernelInterface(self.miner)
+        d = kernel.submitNonce(ranges[0], GENESIS_NONCE)
+        d.addCallback(accepted.append)
+        self.assertEqual(accepted, [True])
+        self.assertEqual(len(self.light.client.results), 1)
+        self.assertEqual(self.light.client.results[0][:76], GENESIS[:76])
+        self.assertEqual(self.heavy.client.results, [])
+    
+    def test_untracedResult(self):
+        """Results that can't be traced to a pool go to the active one."""
+        self.manager.sendResult(GENESIS)
+        self.assertEqual(self.heavy.client.results, [GENESIS])
+        self.assertEqual(self.light.client.results, [])
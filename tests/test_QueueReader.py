@@ -0,0 +1,64 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from twisted.trial import unittest
+
+from QueueReader import resizeExecution
+
+class ResizeExecutionTest(unittest.TestCase):
+    
+    # A device that hashes this many nonces a second.
+    RATE = 37e6
+    
+    def simulate(self, launch, step, executionTime, samples):
+        """Feed back how long the simulated device takes at each size."""
+        sizes = [launch]
+        for i in range(samples):
+            launch = resizeExecution(launch, step, executionTime,
+                                     launch / self.RATE, launch)
+            sizes.append(launch)
+        return sizes
+    
+    def test_converges(self):
+        """From far too small or far too big, executions settle on about
+        executionTime, always as a multiple of step.
+        """
+        for start in (256, 1 << 31):
+            sizes = self.simulate(start, 384, 0.03, 20)
+            for size in sizes[1:]:
+                self.assertEqual(size % 384, 0)
+            self.assertTrue(abs(sizes[-1]/self.RATE - 0.03) < 384/self.RATE)
+    
+    def test_damped(self):
+        """A sample four times too slow only halves the execution."""
+        launch = resizeExecution(1 << 20, 256, 0.03, 0.12, 1 << 20)
+        self.assertEqual(launch, 1 << 19)
+    
+    def test_bounds(self):
+        """Executions are never less than one step, or more than 2**32
+        nonces.
+        """
+        self.assertEqual(resizeExecution(256, 1024, 0.03, 1000.0, 256), 1024)
+        self.assertEqual(resizeExecution(1 << 32, 256, 1.0, 1e-6, 1 << 32),
+                         1 << 32)
+        self.assertEqual(resizeExecution(1 << 32, 384, 1.0, 1e-6, 1 << 32),
+                         384 * ((1 << 32) // 384))
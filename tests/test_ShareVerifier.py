@@ -0,0 +1,136 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import threading
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from ShareVerifier import ShareVerifier
+
+class Collector(object):
+    """Keeps what the verifier calls back with, and fires once it has been
+    called back expected times.
+    """
+    
+    def __init__(self, expected):
+        self.expected = expected
+        self.results = []
+        self.threads = set()
+        self.done = defer.Deferred()
+    
+    def __call__(self, nr, nonces, result, *args):
+        self.threads.add(threading.current_thread())
+        self.results.append((nr, nonces, result, args))
+        if len(self.results) == self.expected:
+            self.done.callback(self.results)
+
+def evens(nr, nonces):
+    return [nonce for nonce in nonces if nonce % 2 == 0]
+
+def waitFor(condition, timeout=5):
+    """Wait on the reactor until condition() is true."""
+    d = defer.Deferred()
+    deadline = reactor.seconds() + timeout
+    def poll():
+        if condition():
+            d.callback(None)
+        elif reactor.seconds() > deadline:
+            d.errback(AssertionError('timed out waiting'))
+        else:
+            reactor.callLater(0.01, poll)
+    poll()
+    return d
+
+class ShareVerifierTest(unittest.TestCase):
+    
+    def test_results(self):
+        """Verification happens off the reactor, and the results come back
+        on it, with whatever else was passed along.
+        """
+        collector = Collector(2)
+        verifier = ShareVerifier(evens, collector, threads=2)
+        verifier.put('first', [1, 2, 3, 4], 'a')
+        verifier.put('second', iter([5, 6]), 'b', 'c')
+        def check(results):
+            self.assertEqual(sorted(results), [
+                ('first', [1, 2, 3, 4], [2, 4], ('a',)),
+                ('second', [5, 6], [6], ('b', 'c'))])
+            self.assertEqual(collector.threads,
+                             set([threading.current_thread()]))
+        return collector.done.addCallback(check)
+    
+    def test_backpressure(self):
+        """Once maxDepth batches are waiting, put blocks until there's room,
+        and every time it has to is counted as a stall, even when several
+        kernels stall at once.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        def slowVerify(nr, nonces):
+            started.set()
+            release.wait(5)
+            return nonces
+        collector = Collector(7)
+        verifier = ShareVerifier(slowVerify, collector, threads=1,
+                                 maxDepth=2)
+        
+        # The first batch holds up the only thread, the next two fill the
+        # queue, and the rest have to wait.
+        verifier.put(0, [0])
+        self.assertTrue(started.wait(5))
+        verifier.put(1, [1])
+        verifier.put(2, [2])
+        self.assertEqual(verifier.depth(), 2)
+        self.assertEqual(verifier.stalls, 0)
+        
+        blocked = [threading.Thread(target=verifier.put, args=(nr, [nr]))
+                   for nr in range(3, 7)]
+        for thread in blocked:
+            thread.start()
+        for thread in blocked:
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        self.assertEqual(verifier.stalls, 4)
+        
+        release.set()
+        d = waitFor(lambda: not any(t.is_alive() for t in blocked))
+        d.addCallback(lambda ignored: collector.done)
+        d.addCallback(lambda results: self.assertEqual(
+            sorted(nr for nr, nonces, result, args in results), range(7)))
+        return d
+    
+    def test_badBatch(self):
+        """A batch that fails to verify is logged and dropped, without
+        taking the thread down.
+        """
+        def verify(nr, nonces):
+            if nr == 'bad':
+                raise ValueError(nr)
+            return nonces
+        collector = Collector(1)
+        verifier = ShareVerifier(verify, collector)
+        verifier.put('bad', [1])
+        verifier.put('good', [2])
+        def check(results):
+            self.assertEqual(results, [('good', [2], [2], ())])
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        return collector.done.addCallback(check)
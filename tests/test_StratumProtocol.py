@@ -0,0 +1,274 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+from struct import pack
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import LineReceiver
+from twisted.trial import unittest
+
+from minerutil.StratumProtocol import (StratumClient, doubleHash,
+                                       targetFromDifficulty)
+from tests.fakes import GENESIS, GENESIS_NONCE
+
+# The genesis coinbase, split around 8 bytes of its input's previous hash
+# (all zeros) so that extranonce1 and an extranonce2 of 0 put it back
+# together.
+COINBASE = ('01000000010000000000000000000000000000000000000000000000000000000'
+    '000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f3230'
+    '3039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e6420626169'
+    '6c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe55'
+    '48271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f355'
+    '04e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+COINB1, COINB2 = COINBASE[:34], COINBASE[50:]
+EXTRANONCE1 = '00000000'
+
+def genesisJob(id='genesis', clean=True):
+    return [id, '00'*32, COINB1, COINB2, [], '00000001', '1d00ffff',
+            '495fab29', clean]
+
+class FakeStratumServer(LineReceiver):
+    """A pool that answers the handshake, sends out whatever the test has
+    queued, and checks shares against the genesis job.
+    """
+    delimiter = '\n'
+    
+    def connectionMade(self):
+        self.factory.connection = self
+    
+    def connectionLost(self, reason):
+        self.factory.lost.callback(None)
+    
+    def reply(self, id, result):
+        self.sendLine(json.dumps({'id': id, 'result': result,
+                                  'error': None}))
+    
+    def notify(self, method, params):
+        self.sendLine(json.dumps({'id': None, 'method': method,
+                                  'params': params}))
+    
+    def lineReceived(self, line):
+        call = json.loads(line)
+        method, params = call['method'], call['params']
+        self.factory.calls.append((method, params))
+        if method == 'mining.configure':
+            self.reply(call['id'], self.factory.configured)
+        elif method == 'mining.subscribe':
+            self.reply(call['id'], [[['mining.notify', '1']], EXTRANONCE1, 4])
+        elif method == 'mining.authorize':
+            self.reply(call['id'], True)
+            for notification in self.factory.notifications:
+                self.notify(*notification)
+        elif method == 'mining.submit':
+            self.reply(call['id'], self.check(params))
+    
+    def check(self, params):
+        """Rebuild the header a share is for, and see if it hashes under
+        difficulty 1.
+        """
+        user, job, extranonce2, ntime, nonce = params[:5]
+        version = 1
+        if len(params) > 5:
+            version |= int(params[5], 16)
+        root = doubleHash((COINB1 + EXTRANONCE1 + extranonce2 + COINB2
+                           ).decode('hex'))
+        header = (pack('<I', version) + '\x00'*32 + root +
+                  pack('<III', int(ntime, 16), 0x1d00ffff, int(nonce, 16)))
+        return doubleHash(header)[-4:] == '\x00'*4
+
+class Handler(object):
+    
+    def __init__(self):
+        self.works = []
+        self.waiting = []
+    
+    def nextWork(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+    
+    def onWork(self, work):
+        self.works.append(work)
+        if self.waiting:
+            self.waiting.pop(0).callback(work)
+
+class StratumClientTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.factory = protocol.ServerFactory()
+        self.factory.protocol = FakeStratumServer
+        self.factory.calls = []
+        self.factory.configured = {'version-rolling': True,
+                                   'version-rolling.mask': 'ffffffff'}
+        self.factory.notifications = [('mining.notify', genesisJob())]
+        self.factory.lost = defer.Deferred()
+        self.listener = reactor.listenTCP(0, self.factory,
+                                          interface='127.0.0.1')
+        self.handler = Handler()
+        self.client = StratumClient(self.handler, '127.0.0.1',
+            self.listener.getHost().port, 'worker', 'secret')
+    
+    def tearDown(self):
+        self.client.disconnect()
+        d = defer.maybeDeferred(self.listener.stopListening)
+        d.addCallback(lambda ignored: self.factory.lost)
+        return d
+    
+    def connect(self):
+        d = self.handler.nextWork()
+        self.client.connect()
+        return d
+    
+    def jobArrives(self, id):
+        """Fires once the client has the job with the given ID."""
+        d = defer.Deferred()
+        def poll():
+            if self.client.job is not None and self.client.job.id == id:
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, poll)
+        poll()
+        return d
+    
+    def submit(self, work, nonce=GENESIS_NONCE):
+        return self.client.sendResult(pack('<76sI', work.data[:76], nonce))
+    
+    def test_handshake(self):
+        """Version rolling is configured before subscribing, and both come
+        before authorizing.
+        """
+        def check(work):
+            methods = [method for method, params in self.factory.calls]
+            self.assertEqual(methods, ['mining.configure', 'mining.subscribe',
+                                       'mining.authorize'])
+            self.assertEqual(self.factory.calls[0][1][0], ['version-rolling'])
+            self.assertEqual(self.factory.calls[2][1], ['worker', 'secret'])
+        return self.connect().addCallback(check)
+    
+    def test_genesis(self):
+        """A job made of the genesis block's coinbase gives its header."""
+        def check(work):
+            self.assertEqual(work.data[:76], GENESIS[:76])
+            self.assertEqual(work.data[76:80], '\x00'*4)
+            self.assertEqual(work.target, targetFromDifficulty(1))
+            self.assertEqual(work.target[::-1].encode('hex'),
+                             '00000000ffff' + '00'*26)
+        return self.connect().addCallback(check)
+    
+    def test_setDifficulty(self):
+        """Work follows the difficulty the server last set."""
+        self.factory.notifications.insert(0, ('mining.set_difficulty', [4]))
+        def gotWork(work):
+            self.assertEqual(work.target, targetFromDifficulty(4))
+            d = self.handler.nextWork()
+            self.factory.connection.notify('mining.set_difficulty', [0.5])
+            self.factory.connection.notify('mining.notify',
+                                           genesisJob('easier'))
+            return d
+        def check(work):
+            self.assertEqual(work.target, targetFromDifficulty(0.5))
+        return self.connect().addCallback(gotWork).addCallback(check)
+    
+    def test_versionMask(self):
+        """Only the bits both sides allow are rolled, the server may change
+        them later, and rolled bits are sent back with shares.
+        """
+        def gotWork(work):
+            self.assertEqual(work.versionMask, StratumClient.VERSION_MASK)
+            d = self.handler.nextWork()
+            self.factory.connection.notify('mining.set_version_mask',
+                                           ['00006000'])
+            self.factory.connection.notify('mining.notify',
+                                           genesisJob('masked'))
+            return d
+        def gotMaskedWork(work):
+            self.assertEqual(work.versionMask, 0x6000)
+            data = pack('>I', 1 | 0x2000) + work.data[4:76]
+            d = self.client.sendResult(pack('<76sI', data, 0))
+            d.addCallback(lambda ignored: self.factory.calls[-1][1])
+            return d
+        def check(params):
+            self.assertEqual(params[5], '00002000')
+        d = self.connect()
+        d.addCallback(gotWork)
+        d.addCallback(gotMaskedWork)
+        d.addCallback(check)
+        return d
+    
+    def test_noVersionRolling(self):
+        """A server that won't roll versions gets shares without them."""
+        self.factory.configured = None
+        def gotWork(work):
+            self.assertEqual(work.versionMask, 0)
+            d = self.submit(work)
+            d.addCallback(self.assertTrue)
+            d.addCallback(lambda ignored: self.factory.calls[-1][1])
+            return d
+        return self.connect().addCallback(gotWork).addCallback(
+            lambda params: self.assertEqual(len(params), 5))
+    
+    def test_submit(self):
+        """Shares are turned in against the job and extranonce2 their work
+        was made from, even once a newer job is out.
+        """
+        works = []
+        def gotWork(work):
+            works.append(work)
+            d = self.handler.nextWork()
+            self.factory.connection.notify('mining.notify',
+                ['newer', '11'*32, COINB1, COINB2, [], '00000001',
+                 '1d00ffff', '495fab2a', False])
+            self.jobArrives('newer').addCallback(
+                lambda ignored: self.client.requestWork())
+            return d
+        def gotNewerWork(work):
+            works.append(work)
+            self.assertNotEqual(work.data[:76], works[0].data[:76])
+            results = [self.submit(works[0]), self.submit(works[0], 1),
+                       self.submit(works[1])]
+            return defer.gatherResults(results)
+        def check(results):
+            self.assertEqual(results, [True, False, False])
+            shares = [params for method, params in self.factory.calls
+                      if method == 'mining.submit']
+            self.assertEqual([share[1] for share in shares],
+                             ['genesis', 'genesis', 'newer'])
+            self.assertEqual(shares[0][2], '00000000')
+            self.assertEqual(shares[0][3], '495fab29')
+            # Stratum gives the nonce as the number the block has.
+            self.assertEqual(shares[0][4], '%08x' % 2083236893)
+            self.assertEqual(shares[2][3], '495fab2a')
+        d = self.connect()
+        d.addCallback(gotWork)
+        d.addCallback(gotNewerWork)
+        d.addCallback(check)
+        return d
+    
+    def test_unknownResult(self):
+        """Results for work the client never made aren't sent anywhere."""
+        def gotWork(work):
+            d = self.client.sendResult('\x01'*80)
+            d.addCallback(self.assertFalse)
+            d.addCallback(lambda ignored: self.assertNotIn('mining.submit',
+                [method for method, params in self.factory.calls]))
+            return d
+        return self.connect().addCallback(gotWork)
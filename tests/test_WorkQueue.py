@@ -0,0 +1,240 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+from struct import pack, unpack
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+import WorkQueue
+from KernelInterface import KernelInterface
+from QueueReader import QueueReader
+from minerutil.Midstate import calculateMidstate
+from minerutil.RPCProtocol import RPCClient
+from tests.fakes import FakeMiner, makeWork
+
+def version(unit):
+    return unpack('>I', unit.data[0:4])[0]
+
+def ntime(unit):
+    return unpack('>I', unit.data[68:72])[0]
+
+class RollingTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(WorkQueue, 'time', lambda: self.now)
+        self.miner = FakeMiner(queueSize=4)
+        self.queue = self.miner.queue
+    
+    def store(self, rollNTime=0, versionMask=0):
+        work = makeWork()
+        work.data = pack('>I', 0x20000000) + work.data[4:68] + \
+            pack('>I', 1700000000) + work.data[72:]
+        work.rollNTime = rollNTime
+        work.versionMask = versionMask
+        self.queue.storeWork(work)
+        return work
+    
+    def take(self, count):
+        return [self.queue.getNext() for i in range(count)]
+    
+    def test_ntimeOnly(self):
+        """Rolling ntime changes only the ntime word, a second at a time,
+        and keeps the template's midstate.
+        """
+        work = self.store(rollNTime=10)
+        units = self.take(4)
+        self.assertEqual(units[0].data, work.data)
+        for offset, unit in enumerate(units):
+            self.assertEqual(unit.data[:68], work.data[:68])
+            self.assertEqual(unit.data[72:], work.data[72:])
+            self.assertEqual(ntime(unit), 1700000000 + offset)
+            self.assertEqual(unit.midstate, units[0].midstate)
+        self.assertEqual(self.miner.connection.requests, 0)
+    
+    def test_versionBits(self):
+        """Every allowed version is used before ntime moves on, and only
+        the version word and (later) the ntime word change.
+        """
+        work = self.store(rollNTime=1, versionMask=0x6000)
+        units = self.take(4) + self.take(4)
+        versions = [version(unit) for unit in units]
+        self.assertEqual(versions[:4], [0x20000000, 0x20002000, 0x20004000,
+                                        0x20006000])
+        self.assertEqual(versions[4:], versions[:4])
+        self.assertEqual([ntime(unit) - 1700000000 for unit in units],
+                         [0]*4 + [1]*4)
+        for unit in units:
+            self.assertEqual(unit.data[4:68], work.data[4:68])
+            self.assertEqual(unit.midstate, calculateMidstate(unit.data[:64]))
+    
+    def test_windowEnds(self):
+        """ntime is never rolled past the window the server gave, after
+        which more work is asked for.
+        """
+        self.store(rollNTime=2)
+        units = self.take(3)
+        self.assertEqual([ntime(unit) - 1700000000 for unit in units],
+                         [0, 1, 2])
+        self.assertIdentical(self.queue.template, None)
+        self.assertTrue(self.miner.connection.requests)
+    
+    def test_expires(self):
+        """Nothing is rolled from a template once it has expired."""
+        self.store(rollNTime=30)
+        self.take(4)
+        self.now += 30
+        requests = self.miner.connection.requests
+        self.queue.refill()
+        self.assertIdentical(self.queue.template, None)
+        self.assertEqual(len(self.queue.queue), 0)
+        self.assertEqual(self.miner.connection.requests, requests + 1)
+    
+    def test_versionOnlyExpires(self):
+        """Work that may only have its version rolled still expires after
+        ROLL_EXPIRE.
+        """
+        self.store(versionMask=0x1fffe000)
+        self.take(4)
+        self.assertNotIdentical(self.queue.template, None)
+        self.now += WorkQueue.WorkQueue.ROLL_EXPIRE
+        self.queue.refill()
+        self.assertIdentical(self.queue.template, None)
+    
+    def test_noRolling(self):
+        """Work that may not be rolled is used once."""
+        self.store()
+        self.assertEqual(len(self.queue.queue), 1)
+        self.assertIdentical(self.queue.template, None)
+        self.assertTrue(self.miner.connection.requests)
+
+class StaleTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.miner = FakeMiner(queueSize=2)
+        self.queue = self.miner.queue
+        self.interface = KernelInterface(self.miner)
+        self.qr = QueueReader(self.interface.addCore())
+    
+    def tearDown(self):
+        self.qr.stop()
+    
+    def test_newBlock(self):
+        """A new block bumps the generation, which makes the range a
+        kernel already took stale, while more work on the same block
+        doesn't.
+        """
+        self.queue.storeWork(makeWork('\x01'*32))
+        self.qr.start()
+        nr = self.qr.next()
+        generation = nr.unit.generation
+        self.assertEqual(generation, self.interface.getGeneration())
+        self.assertFalse(self.qr.isStale())
+        
+        self.queue.storeWork(makeWork('\x01'*32))
+        self.assertEqual(self.interface.getGeneration(), generation)
+        self.assertFalse(self.qr.isStale())
+        
+        self.queue.storeWork(makeWork('\x02'*32))
+        self.assertEqual(self.interface.getGeneration(), generation + 1)
+        self.assertEqual(nr.unit.generation, generation)
+        self.assertTrue(self.qr.isStale())
+        self.assertTrue(self.queue.isRangeStale(nr))
+        
+        # Once the kernel drops the range, there's nothing left to be stale.
+        self.qr.skipTiming()
+        self.assertFalse(self.qr.isStale())
+
+class VersionMaskHeaderTest(unittest.TestCase):
+    
+    def parse(self, *values):
+        headers = Headers()
+        for value in values:
+            headers.addRawHeader('X-Version-Mask', value)
+        return RPCClient.parseVersionMask(headers)
+    
+    def test_grant(self):
+        """A getwork server grants version rolling with X-Version-Mask, but
+        only the BIP 320 bits are ever rolled.
+        """
+        self.assertEqual(self.parse('00006000'), 0x6000)
+        self.assertEqual(self.parse('ffffffff'), 0x1fffe000)
+    
+    def test_noGrant(self):
+        self.assertEqual(self.parse(), 0)
+        self.assertEqual(self.parse('yes'), 0)
+
+class MidstateCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.patch(WorkQueue.WorkQueue, 'MIDSTATE_CACHE_SIZE', 3)
+        self.queue = FakeMiner(queueSize=2).queue
+        self.blocks = [makeWork().data for i in range(4)]
+    
+    def counts(self):
+        return self.queue.midstateHits, self.queue.midstateMisses
+    
+    def test_hitAndMiss(self):
+        """Headers that share their first 64 bytes share a midstate, which
+        is only calculated for the first of them.
+        """
+        data = self.blocks[0]
+        self.assertEqual(self.queue.getMidstate(data),
+                         calculateMidstate(data[:64]))
+        self.assertEqual(self.counts(), (0, 1))
+        
+        other = data[:64] + '\xff'*16
+        self.assertEqual(self.queue.getMidstate(other),
+                         calculateMidstate(data[:64]))
+        self.assertEqual(self.counts(), (1, 1))
+        
+        self.queue.getMidstate(self.blocks[1])
+        self.assertEqual(self.counts(), (1, 2))
+    
+    def test_storeWork(self):
+        """storeWork goes through the cache."""
+        work = makeWork()
+        self.queue.storeWork(work)
+        work.data = work.data[:64] + '\x00'*16
+        self.queue.storeWork(work)
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(self.queue.queue[0].midstate,
+                         self.queue.queue[1].midstate)
+    
+    def test_eviction(self):
+        """Past MIDSTATE_CACHE_SIZE, the least recently used midstate is
+        forgotten first.
+        """
+        a, b, c, d = self.blocks
+        for data in (a, b, c, a, d):
+            self.queue.getMidstate(data)
+        self.assertEqual(self.counts(), (1, 4))
+        self.assertEqual(len(self.queue.midstates), 3)
+        self.assertEqual(self.queue.midstates.keys(),
+                         [c[:64], a[:64], d[:64]])
+        
+        self.queue.getMidstate(a)
+        self.assertEqual(self.counts(), (2, 4))
+        self.queue.getMidstate(b)
+        self.assertEqual(self.counts(), (2, 5))
+        self.assertEqual(self.queue.midstates.keys(),
+                         [d[:64], a[:64], b[:64]])
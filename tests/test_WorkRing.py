@@ -0,0 +1,171 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import imp
+import multiprocessing
+import os
+from struct import pack, unpack
+from twisted.trial import unittest
+
+from WorkQueue import WorkUnit, NonceRange
+from WorkRing import WorkRing, WorkDescriptor
+from tests.fakes import GENESIS, GENESIS_NONCE, DIFFICULTY_1
+
+# Loaded the way phoenix.py loads kernels, before trial moves into its
+# temporary directory.
+multicpu = imp.load_module('multicpu', *imp.find_module('multicpu',
+    [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                  'kernels')]))
+
+def makeDescriptor(base=0, size=256, target=DIFFICULTY_1):
+    unit = WorkUnit()
+    unit.data = GENESIS
+    unit.target = target
+    return WorkDescriptor.fromRange(NonceRange(unit, base, size))
+
+def worker(ring, count):
+    """Answer count descriptors with base and base+size-1, from another
+    process.
+    """
+    for i in range(count):
+        index, wd = ring.get()
+        ring.finish(index, [wd.base, wd.base + wd.size - 1])
+
+class WorkRingTest(unittest.TestCase):
+    
+    def test_descriptor(self):
+        """The header crosses the ring in SHA-256 byte order."""
+        wd = makeDescriptor(512, 256)
+        self.assertEqual(wd.header, pack('>19I', *unpack('<19I',
+                                                          GENESIS[:76])))
+        self.assertEqual(wd.header[:4], '\x01\x00\x00\x00')
+        
+        ring = WorkRing()
+        ring.put(wd)
+        index, got = ring.get()
+        self.assertEqual(index, 0)
+        for field in ('header', 'target', 'base', 'size', 'generation'):
+            self.assertEqual(getattr(got, field), getattr(wd, field))
+    
+    def test_wrapAround(self):
+        """Slots are reused in order once collected, and results always
+        come back with the descriptor they belong to.
+        """
+        ring = WorkRing(slots=2)
+        indices = []
+        for n in range(5):
+            ring.put(makeDescriptor(n*256))
+            index, wd = ring.get()
+            indices.append(index)
+            ring.finish(index, [wd.base])
+            self.assertEqual(ring.collect(), ([n*256], 1))
+        self.assertEqual(indices, [0, 1, 0, 1, 0])
+    
+    def test_inFlight(self):
+        """Both slots can be outstanding at once, and are collected oldest
+        first. A full ring has no free slot to put into.
+        """
+        ring = WorkRing(slots=2)
+        ring.put(makeDescriptor(0))
+        ring.put(makeDescriptor(256))
+        self.assertFalse(ring.free.acquire(False))
+        first, second = ring.get(), ring.get()
+        ring.finish(second[0], [2])
+        ring.finish(first[0], [1])
+        self.assertEqual(ring.collect(), ([1], 1))
+        self.assertEqual(ring.collect(), ([2], 1))
+        self.assertEqual(ring.collect(0.01), None)
+    
+    def test_tooManyResults(self):
+        """Only maxResults nonces fit, but the count says how many there
+        were.
+        """
+        ring = WorkRing(maxResults=4)
+        ring.put(makeDescriptor())
+        index, wd = ring.get()
+        ring.finish(index, range(10))
+        self.assertEqual(ring.collect(), ([0, 1, 2, 3], 10))
+    
+    def test_close(self):
+        """Closing wakes up both sides and tells them to stop."""
+        ring = WorkRing()
+        ring.close()
+        self.assertTrue(ring.isClosed())
+        self.assertEqual(ring.get(), None)
+        self.assertEqual(ring.collect(), None)
+    
+    def test_acrossProcesses(self):
+        """A forked worker sees what's put into the ring, and the producer
+        sees what it writes back, with the ring wrapping around.
+        """
+        ring = WorkRing(slots=2)
+        process = multiprocessing.Process(target=worker, args=(ring, 6))
+        process.start()
+        try:
+            results = []
+            for n in range(6):
+                ring.put(makeDescriptor(n*1024, 1024))
+                if n:
+                    results.append(ring.collect(5))
+            results.append(ring.collect(5))
+        finally:
+            process.join(5)
+        self.assertEqual(results, [([n*1024, n*1024 + 1023], 2)
+                                   for n in range(6)])
+
+class HashWorkerTest(unittest.TestCase):
+    
+    def hash(self, wd, generation=0):
+        """Have the multicpu kernel's worker hash one descriptor in another
+        process, and return what it hands back.
+        """
+        ring = WorkRing()
+        ring.setGeneration(generation)
+        process = multiprocessing.Process(target=multicpu.hashWorker,
+                                          args=(ring,))
+        process.start()
+        try:
+            ring.put(wd)
+            return ring.collect(5)
+        finally:
+            ring.close()
+            process.join(5)
+    
+    def test_found(self):
+        """The worker finds the genesis block's nonce."""
+        self.assertEqual(self.hash(makeDescriptor(GENESIS_NONCE - 100)),
+                         ([GENESIS_NONCE], 1))
+    
+    def test_target(self):
+        """Nonces that only meet difficulty 1 don't cross back."""
+        # Just below the genesis block's own hash.
+        target = ('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a'
+                  '8ce26e').decode('hex')[::-1]
+        self.assertEqual(self.hash(makeDescriptor(GENESIS_NONCE - 100,
+                                                  target=target)), ([], 0))
+    
+    def test_stale(self):
+        """The worker gives up on a range from an old generation instead of
+        hashing all of it.
+        """
+        wd = makeDescriptor(GENESIS_NONCE - 100, 2**28)
+        self.assertEqual(self.hash(wd, generation=1), ([], 0))
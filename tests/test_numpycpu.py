@@ -0,0 +1,78 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import imp
+import os
+from hashlib import sha256
+from struct import pack, unpack
+from twisted.trial import unittest
+
+from minerutil.Midstate import calculateMidstate
+from WorkQueue import WorkUnit, NonceRange
+from tests.fakes import GENESIS, GENESIS_NONCE, DIFFICULTY_1
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    # Loaded the way phoenix.py loads kernels, before trial moves into its
+    # temporary directory.
+    numpycpu = imp.load_module('numpycpu', *imp.find_module('numpycpu',
+        [os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernels')]))
+
+def lastWord(nonce):
+    """The last word of the genesis block's hash with another nonce, the
+    slow way.
+    """
+    header = pack('>19I', *unpack('<19I', GENESIS[:76])) + pack('>I', nonce)
+    return unpack('>I', sha256(sha256(header).digest()).digest()[28:])[0]
+
+class HashTest(unittest.TestCase):
+    
+    if np is None:
+        skip = 'NumPy is not installed'
+    
+    def setUp(self):
+        unit = WorkUnit()
+        unit.data = GENESIS
+        unit.target = DIFFICULTY_1
+        unit.midstate = calculateMidstate(GENESIS[:64])
+        self.data = numpycpu.KernelData(NonceRange(unit, 0, 2**32))
+    
+    def test_genesis(self):
+        """Only the genesis block's own nonce hashes to a zero last word."""
+        nonces = np.arange(256, dtype=np.uint32) + np.uint32(GENESIS_NONCE -
+                                                             100)
+        found = nonces[self.data.hash7(nonces) == 0]
+        self.assertEqual(found.tolist(), [GENESIS_NONCE])
+    
+    def test_lastWord(self):
+        """Stopping the second hash at round 60 still gives the last word of
+        the full hash, for every nonce.
+        """
+        nonces = np.array([0, 1, 0x7fffffff, 0xffffffff, GENESIS_NONCE] +
+                          [unpack('<I', os.urandom(4))[0] for i in range(59)],
+                          dtype=np.uint32)
+        self.assertEqual(self.data.hash7(nonces).tolist(),
+                         [lastWord(nonce) for nonce in nonces.tolist()])